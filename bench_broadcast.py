@@ -0,0 +1,88 @@
+"""廣播寫入效能比較：逐筆 sendall (舊做法) vs. 共用編碼 + 合併寫入 (sendmsg)
+
+用法: python bench_broadcast.py --clients 50 --messages 200 --burst 20
+"""
+import argparse
+import socket
+import threading
+import time
+
+import newserver
+
+
+class CountingSocket:
+    "包一層 socket，記錄送出用了幾次系統呼叫"
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def sendall(self, data):
+        self.calls += 1
+        self.sock.sendall(data)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self.sock.sendmsg(buffers)
+
+
+def drain(sock, total):
+    got = 0
+    while got < total:
+        got += len(sock.recv(1 << 20))
+
+
+def make_frames(count, size):
+    return [newserver.encode_packet({'type': 5,
+                                     'nickname': 'bench',
+                                     'message': 'x' * size,
+                                     'time': '2025/01/01 00:00'}) for _ in range(count)]
+
+
+def run(mode, clients, frames, burst):
+    pairs = [socket.socketpair() for _ in range(clients)]
+    total = sum(len(f) for f in frames)
+    readers = [threading.Thread(target=drain, args=(b, total)) for _, b in pairs]
+    for t in readers: t.start()
+    senders = [CountingSocket(a) for a, _ in pairs]
+
+    start = time.perf_counter()
+    if mode == 'before':
+        # 舊做法：每則訊息對每個客戶端各呼叫一次 sendall
+        for data in frames:
+            for s in senders:
+                s.sendall(data)
+    else:
+        # 新做法：同一份 bytes 放進每個人的佇列，writer 一次取出並合併寫入
+        outboxes = [newserver.Outbox(lambda: None) for _ in senders]
+        for i in range(0, len(frames), burst):
+            for data in frames[i:i + burst]:
+                for box in outboxes:
+                    box.put(data)
+            for box, s in zip(outboxes, senders):
+                newserver.send_frames(s, box.take_all())
+    elapsed = time.perf_counter() - start
+
+    for t in readers: t.join()
+    for a, b in pairs:
+        a.close()
+        b.close()
+    return elapsed, sum(s.calls for s in senders)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--size', type=int, default=80, help='每則訊息的文字長度')
+    parser.add_argument('--burst', type=int, default=20, help='writer 每次醒來時累積了幾則訊息')
+    args = parser.parse_args()
+
+    frames = make_frames(args.messages, args.size)
+    print(f"{args.messages} 則訊息 x {args.clients} 個客戶端 (每次累積 {args.burst} 則)")
+    results = {}
+    for mode in ('before', 'after'):
+        elapsed, calls = run(mode, args.clients, frames, args.burst)
+        results[mode] = elapsed
+        print(f"{mode:>6}: {elapsed * 1000:8.1f} ms  系統呼叫 {calls:7d} 次")
+    print(f"加速: {results['before'] / results['after']:.1f}x")
@@ -0,0 +1,62 @@
+"""封包編碼比較：各種封包在 json / binary 下的大小與編碼、解碼時間
+
+用法: python bench_codec.py --image-kb 2048 --repeat 200
+"""
+import argparse
+import io
+import os
+import time
+
+import chat_codec
+
+NAMES = [f'user{i:03d}' for i in range(500)]
+
+
+def samples(image_kb):
+    "(名稱, 封包)；圖片欄位放原始 bytes，由 codec 決定要不要轉 base64"
+    return [
+        ('type 5 chat', {'type': 5, 'nickname': 'user001', 'room': 'lobby',
+                         'message': '今天晚餐吃什麼? meeting 改到明天', 'time': '2025/01/01 12:00'}),
+        ('type 6 delta', {'type': 6, 'op': 'join', 'nickname': 'user042', 'seq': 1234}),
+        ('type 6 users', {'type': 6, 'users': NAMES, 'seq': 1234}),
+        ('type 9 thumb', {'type': 9, 'nickname': 'user001', 'room': 'lobby', 'thumb_data': os.urandom(20 * 1024),
+                          'image_hash': '0' * 64, 'image_size': 1 << 20, 'width': 1920, 'height': 1080,
+                          'time': '2025/01/01 12:00'}),
+        ('type 11 chunk', {'type': 11, 'id': 'd1', 'seq': 3, 'data': os.urandom(64 * 1024)}),
+        (f'type 9 {image_kb}KB', {'type': 9, 'nickname': 'user001', 'room': 'lobby',
+                                  'image_data': os.urandom(image_kb * 1024), 'time': '2025/01/01 12:00'}),
+    ]
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - start) / repeat * 1e6
+
+
+def decode(data):
+    "與伺服器 / 客戶端相同的讀取路徑；圖片欄位都還原成 bytes 才算完成"
+    msg = next(chat_codec.read_packets(io.BytesIO(data)))
+    for key in chat_codec.BLOB_FIELDS:
+        if key in msg: chat_codec.blob(msg, key)
+    return msg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--image-kb', type=int, default=2048, help='整張圖片 (舊協定 type 9) 的大小')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'packet':<16}{'codec':<8}{'bytes':>10}{'encode us':>12}{'decode us':>12}")
+    for name, msg in samples(args.image_kb):
+        repeat = max(args.repeat * 1024 // max(len(str(msg)) // 1024, 1024), 5) # 大封包少跑幾次
+        for codec in (chat_codec.JSON, chat_codec.BINARY):
+            data, enc = timed(lambda: codec.encode(msg), repeat)
+            _, dec = timed(lambda: decode(data), repeat)
+            print(f"{name:<16}{codec.name:<8}{len(data):>10}{enc:>12.1f}{dec:>12.1f}")
+    # 廣播時已編碼好的 json 行轉成 binary 框的成本 (每則訊息只做一次)
+    line = chat_codec.JSON.encode(samples(1)[0][1])
+    _, cost = timed(lambda: chat_codec.BINARY.wrap(line), args.repeat * 100)
+    print(f"wrap json line -> binary: {cost:.2f} us")
@@ -0,0 +1,110 @@
+"""壓縮的頻寬 / CPU 取捨：各種流量在不同 zlib 等級下的壓縮率與每個封包的 CPU 時間
+
+用法: python bench_compression.py --messages 2000 --burst 1 5 20 --levels 1 6 9
+"""
+import argparse
+import base64
+import os
+import random
+import time
+import zlib
+
+import newserver
+
+WORDS = ['hello', '大家好', '今天', '晚餐', '吃什麼', 'ok', '哈哈', 'meeting', '明天', '開會',
+         'image', '好喔', '等等', '?', '!!', 'lol', '我到了', '下班', '週末', 'python']
+NAMES = [f'user{i:03d}' for i in range(500)]
+
+
+def chat_frames(count):
+    rnd = random.Random(1)
+    frames = []
+    for i in range(count):
+        msg = {'type': 5,
+               'nickname': rnd.choice(NAMES[:30]),
+               'room': 'lobby',
+               'message': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12))),
+               'time': f'2025/01/01 12:{i % 60:02d}'}
+        frames.append(newserver.encode_packet(msg))
+    return frames
+
+
+def presence_frames(count):
+    "一份 500 人的完整名單，接著一連串登入 / 離線差異"
+    frames = [newserver.encode_packet({'type': 6, 'users': NAMES, 'seq': 1})]
+    for i in range(count):
+        frames.append(newserver.encode_packet({'type': 6, 'op': ('join', 'leave')[i % 2],
+                                               'nickname': NAMES[i % 500], 'seq': i + 2}))
+    return frames
+
+
+def image_frames(count):
+    "分段圖片：JPEG/PNG 幾乎是亂數，這裡直接用亂數代替"
+    frames = []
+    for seq in range(count):
+        frames.append(newserver.encode_packet({'type': 11, 'id': 'd1', 'seq': seq,
+                                               'data': base64.b64encode(os.urandom(newserver.CHUNK_SIZE)).decode()}))
+    return frames
+
+
+def run(frames, level, burst, kind=newserver.TEXT):
+    """經由 Outbox 壓縮 (與伺服器相同的程式路徑)，回傳 (送出位元組, 每個封包的微秒數)；
+    kind 用 TEXT 強迫圖片分段也壓縮，用來衡量跳過圖片省下多少 CPU"""
+    newserver.COMPRESS_LEVEL = level
+    box = newserver.Outbox(lambda: None)
+    if level: box.enable_compression()
+    inflater = zlib.decompressobj(-15)
+    sent = 0
+    out = []
+    start = time.perf_counter()
+    for i in range(0, len(frames), burst):
+        box.extend([(data, kind) for data in frames[i:i + burst]])
+        for block in box.take_all():
+            sent += len(block)
+            out.append(block)
+    elapsed = time.perf_counter() - start
+    # 確認解得回來
+    if level:
+        restored = b''.join(inflater.decompress(block[5:]) if block[:1] == newserver.ZLIB_MARK else block
+                            for block in out)
+        assert restored == b''.join(frames)
+    return sent, elapsed / len(frames) * 1e6
+
+
+def per_frame_context(frames, level):
+    "對照組：每個封包各自壓縮 (沒有跨封包的串流字典)"
+    return sum(len(zlib.compress(data, level)) for data in frames)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--burst', type=int, nargs='+', default=[1, 5, 20],
+                        help='writer 每次醒來時累積了幾個封包 (一個壓縮區塊)')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 6, 9])
+    parser.add_argument('--chunks', type=int, default=40, help='圖片分段數 (每段 64KB)')
+    args = parser.parse_args()
+
+    workloads = [('chat', chat_frames(args.messages)),
+                 ('presence', presence_frames(args.messages)),
+                 ('history', chat_frames(newserver.MAX_HISTORY_SEND * 5))]
+    print(f"每條連線的壓縮狀態約 {(1 << (-newserver.COMPRESS_WBITS + 2)) + (1 << (newserver.COMPRESS_MEMLEVEL + 9))} bytes "
+          f"(wbits={newserver.COMPRESS_WBITS}, memLevel={newserver.COMPRESS_MEMLEVEL})")
+    print(f"{'workload':<10}{'burst':>6}{'level':>6}{'bytes':>12}{'ratio':>8}{'us/frame':>10}")
+    for name, frames in workloads:
+        raw = sum(len(data) for data in frames)
+        bursts = [len(frames)] if name == 'history' else args.burst # 回放一次送出
+        for burst in bursts:
+            for level in [0] + args.levels:
+                sent, cost = run(frames, level, burst)
+                print(f"{name:<10}{burst:>6}{level:>6}{sent:>12}{sent / raw:>8.1%}{cost:>10.1f}")
+        print(f"{name:<10}{'':>6}{'':>6}{per_frame_context(frames, 6):>12}"
+              f"{per_frame_context(frames, 6) / raw:>8.1%}   (各封包獨立壓縮, level 6)")
+
+    frames = image_frames(args.chunks)
+    raw = sum(len(data) for data in frames)
+    for level in args.levels:
+        skipped, skip_cost = run(frames, level, 1, newserver.CHUNK)
+        forced, cost = run(frames, level, 1)
+        print(f"{'image':<10}{'':>6}{level:>6}  跳過: {skipped / raw:.1%} {skip_cost:.0f}us/段"
+              f"  強制壓縮: {forced / raw:.1%} {cost:.0f}us/段")
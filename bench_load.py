@@ -0,0 +1,464 @@
+"""負載測試：大量無介面的模擬客戶端以真正的協定連上伺服器，量測廣播延遲、吞吐量、登入時間與伺服器記憶體
+
+用法: python bench_load.py --spawn --clients 200 --duration 30 --json result.json
+      python bench_load.py --spawn --server-args "--engine asyncio" --clients 1000 --procs 4 --churn 5
+      python bench_load.py --port 6000 --server-pid 1234 --clients 100 --image-rate 1 --image-kb 512
+--json 的結果是一個 JSON 物件 (設定、各項百分位數、每秒則數、伺服器 RSS、錯誤)，可以存起來比較不同版本。
+延遲以送出端寫在訊息裡的 time.monotonic_ns() 計算，所以模擬客戶端都要在同一台機器上 (--procs 沒有影響)。
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime
+
+import chat_codec
+
+TAG = 'lg' # 量測用訊息的開頭: 'lg <送出時間 ns> xxxx'
+# 量測用圖片: PNG 檔頭 (伺服器只讀寬高) + 標記 + 送出時間 + 亂數
+PNG_HEAD = b'\x89PNG\r\n\x1a\n' + struct.pack('>I4sII', 13, b'IHDR', 64, 64)
+IMAGE_MARK = b'LGTS'
+IMAGE_TIME = struct.Struct('>Q')
+KINDS = ('chat', 'private', 'image')
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+# --- 統計 ---
+class Stats:
+    "一個行程的量測結果；to_dict() 後送回主行程合併"
+
+    def __init__(self):
+        self.latency = {kind: [] for kind in KINDS} # 微秒
+        self.login = []                              # 毫秒：開始連線到收到完整名單 (歷史回放之後)
+        self.sent = dict.fromkeys(KINDS, 0)
+        self.acked = 0     # type 4
+        self.frames = 0    # 收到的封包數 (含歷史回放、名單)
+        self.logins = 0
+        self.errors = {}   # 原因 -> 次數
+        self.cpu = 0.0     # 模擬客戶端自己用掉的 CPU 秒數
+
+    def error(self, reason):
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def percentiles(values, scale=1.0):
+    if not values: return {'count': 0}
+    values = sorted(values)
+    result = {'count': len(values)}
+    for p in PERCENTILES:
+        result[f'p{p:g}'] = round(values[min(len(values) - 1, int(len(values) * p / 100))] * scale, 3)
+    result['max'] = round(values[-1] * scale, 3)
+    return result
+
+
+def text_time(message):
+    "量測用訊息的送出時間，不是的話回傳 None"
+    if not message.startswith(TAG + ' '): return None
+    return int(message.split(' ', 2)[1])
+
+
+def image_payload(size):
+    body = PNG_HEAD + IMAGE_MARK + IMAGE_TIME.pack(time.monotonic_ns())
+    return body + os.urandom(max(size - len(body), 0))
+
+
+def image_time(raw):
+    start = len(PNG_HEAD)
+    if raw[start:start + len(IMAGE_MARK)] != IMAGE_MARK: return None
+    return IMAGE_TIME.unpack_from(raw, start + len(IMAGE_MARK))[0]
+
+
+async def read_packets(reader):
+    "chat_codec.read_packets 的 asyncio 版 (伺服器送來的 json / binary / 壓縮區塊)"
+    inflater = zlib.decompressobj(-15)
+    try:
+        while True:
+            mark = await reader.read(1)
+            if not mark: return
+            if mark == chat_codec.BINARY_MARK:
+                hlen, blen = chat_codec.BINARY_HEADER.unpack(await reader.readexactly(chat_codec.BINARY_HEADER.size))
+                yield chat_codec.decode_binary(await reader.readexactly(hlen), await reader.readexactly(blen))
+            elif mark == chat_codec.ZLIB_MARK:
+                size = int.from_bytes(await reader.readexactly(4), 'big')
+                for msg in chat_codec.split_frames(inflater.decompress(await reader.readexactly(size))):
+                    yield msg
+            else:
+                line = mark + await reader.readline()
+                if not line.endswith(b'\n'): return
+                yield json.loads(line)
+    except asyncio.IncompleteReadError:
+        return
+
+
+# --- 模擬客戶端 ---
+class SimClient:
+    def __init__(self, load, nickname):
+        self.load = load
+        self.nickname = nickname
+        self.writer = None
+        self.codec = chat_codec.JSON
+        self.downloads = {} # 分段圖片的傳輸 id -> 送出時間
+        self.ready = asyncio.Event()
+        self.closing = False # 自己斷線 (churn)，不算錯誤
+
+    async def run(self):
+        "連線、登入、收封包直到斷線；流量由 Load 另外產生"
+        load, stats = self.load, self.load.stats
+        start = time.monotonic()
+        try:
+            reader, self.writer = await asyncio.open_connection(load.args.host, load.args.port,
+                                                                limit=chat_codec.MAX_FRAME_BYTES)
+            self.writer.write(chat_codec.JSON.encode({'type': 1, 'nickname': self.nickname,
+                                                      'features': load.features}))
+            async for msg in read_packets(reader):
+                stats.frames += 1
+                if msg.get('type') == 6 and 'users' in msg and not self.ready.is_set():
+                    stats.login.append((time.monotonic() - start) * 1000)
+                    stats.logins += 1
+                    load.ready.append(self)
+                    self.ready.set()
+                elif not self.on_packet(msg):
+                    break
+        except (OSError, ValueError) as e:
+            stats.error(type(e).__name__)
+        finally:
+            if self in load.ready: load.ready.remove(self)
+            if self.writer: self.writer.close()
+            if not load.stopping and not self.closing: stats.error('disconnected')
+            self.ready.set() # 登入失敗時不要讓等待的人卡住
+
+    def on_packet(self, msg):
+        "回傳 False 代表被伺服器拒絕，結束連線"
+        msg_type = msg.get('type')
+        stats = self.load.stats
+        now = time.monotonic_ns()
+        if msg_type == 2:
+            if 'binary' in msg.get('features', []): self.codec = chat_codec.BINARY
+        elif msg_type == 4:
+            stats.acked += 1
+        elif msg_type == 23: # --features 加上 heartbeat 時伺服器會送 ping
+            self.send({'type': 24})
+        elif msg_type == 5:
+            if msg.get('action') in ('full', 'name_taken'):
+                stats.error(msg['action'])
+                return False
+            sent = None if msg.get('is_history') else text_time(msg.get('message', ''))
+            if sent: stats.latency['chat'].append((now - sent) / 1000)
+        elif msg_type == 7:
+            sent = text_time(msg.get('message', ''))
+            if sent: stats.latency['private'].append((now - sent) / 1000)
+        elif msg_type == 9 and 'image_data' in msg and not msg.get('is_history'):
+            sent = image_time(chat_codec.blob(msg, 'image_data'))
+            if sent: stats.latency['image'].append((now - sent) / 1000)
+        elif msg_type == 10 and not msg.get('is_history'):
+            self.downloads[msg['id']] = None
+        elif msg_type == 11 and msg['id'] in self.downloads and msg['seq'] == 0:
+            self.downloads[msg['id']] = image_time(chat_codec.blob(msg, 'data'))
+        elif msg_type == 12:
+            sent = self.downloads.pop(msg['id'], None)
+            if sent: stats.latency['image'].append((now - sent) / 1000)
+        return True
+
+    def send(self, msgdict):
+        self.writer.write(self.codec.encode(msgdict))
+
+    def send_text(self, kind, target=None):
+        args = self.load.args
+        message = f"{TAG} {time.monotonic_ns()} "
+        message += 'x' * max(args.size - len(message), 0)
+        if kind == 'chat':
+            self.send({'type': 3, 'nickname': self.nickname, 'message': message})
+        else:
+            self.send({'type': 7, 'target': target, 'message': message, 'sender': self.nickname,
+                       'time': datetime.now().strftime('%Y/%m/%d %H:%M')})
+        self.load.stats.sent[kind] += 1
+
+    def send_image(self):
+        self.send({'type': 9, 'nickname': self.nickname, 'image_data': image_payload(self.load.args.image_kb * 1024),
+                   'time': datetime.now().strftime('%Y/%m/%d %H:%M')})
+        self.load.stats.sent['image'] += 1
+
+
+class Load:
+    "一個行程負責的模擬客戶端 (總數的 1/procs)"
+
+    def __init__(self, args, index, count):
+        self.args = args
+        self.index = index
+        self.count = count
+        self.features = [f for f in args.features.split(',') if f]
+        self.stats = Stats()
+        self.ready = [] # 已登入的客戶端
+        self.names = (f"lg{index}_{n}" for n in range(1 << 30))
+        self.tasks = set()
+        self.stopping = False
+
+    def spawn(self):
+        client = SimClient(self, next(self.names))
+        task = asyncio.create_task(client.run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return client
+
+    async def run(self):
+        args = self.args
+        cpu_start = sum(os.times()[:2])
+        # 1. 依 --ramp 的速度連線，等全部登入 (或逾時)
+        clients = []
+        for _ in range(self.count):
+            clients.append(self.spawn())
+            await asyncio.sleep(args.procs / args.ramp)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(c.ready.wait() for c in clients)), args.connect_timeout)
+        except asyncio.TimeoutError:
+            self.stats.error('login_timeout')
+        # 2. 產生流量 --duration 秒
+        started = time.monotonic()
+        deadline = started + args.duration
+        traffic = [asyncio.create_task(self.traffic(client, deadline)) for client in list(self.ready)]
+        if args.churn: traffic.append(asyncio.create_task(self.churn(deadline)))
+        await asyncio.gather(*traffic)
+        # 3. 等還在路上的訊息
+        await asyncio.sleep(args.drain)
+        self.stopping = True
+        for task in list(self.tasks): task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.stats.cpu = sum(os.times()[:2]) - cpu_start
+        return self.stats
+
+    async def traffic(self, client, deadline):
+        "每個客戶端各自以 Poisson 過程送出聊天、私訊與圖片 (圖片的 --image-rate 是全部客戶端合計)"
+        args = self.args
+        rates = [args.rate, args.pm_rate, args.image_rate / args.clients]
+        total = sum(rates)
+        if total <= 0: return
+        while True:
+            await asyncio.sleep(random.expovariate(total))
+            if time.monotonic() >= deadline or client not in self.ready: return
+            kind = random.choices(KINDS, rates)[0]
+            try:
+                if kind == 'image':
+                    client.send_image()
+                elif kind == 'private':
+                    client.send_text(kind, random.choice(self.ready).nickname)
+                else:
+                    client.send_text(kind)
+                await client.writer.drain()
+            except (OSError, RuntimeError):
+                return
+
+    async def churn(self, deadline):
+        "每秒 --churn/procs 次：隨機一個客戶端斷線，換一個新的連上 (登入時間也算在 login 裡)"
+        while True:
+            await asyncio.sleep(random.expovariate(self.args.churn / self.args.procs))
+            if time.monotonic() >= deadline: return
+            if not self.ready: continue
+            victim = random.choice(self.ready)
+            self.ready.remove(victim)
+            victim.closing = True
+            victim.writer.close()
+            client = self.spawn()
+            await client.ready.wait()
+            if client in self.ready:
+                asyncio.create_task(self.traffic(client, deadline))
+
+
+def run_share(args, index, count, results):
+    "在子行程中執行"
+    stats = asyncio.run(Load(args, index, count).run())
+    results.put(stats.to_dict())
+
+
+# --- 伺服器 ---
+def spawn_server(args):
+    "在暫存目錄啟動伺服器 (空的資料庫)，回傳 Popen"
+    workdir = tempfile.mkdtemp(prefix='bench_load_')
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'newserver.py')
+    command = [sys.executable, server, '--port', str(args.port), '--max-clients', str(args.clients * 2 + 10),
+               *shlex.split(args.server_args)]
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    proc = subprocess.Popen(command, cwd=workdir, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            print(f"伺服器已啟動 (pid {proc.pid}，紀錄: {log.name})", file=sys.stderr)
+            return proc
+        except OSError:
+            if proc.poll() is not None: break
+            time.sleep(0.2)
+    proc.kill()
+    sys.exit(f"伺服器無法啟動，請看 {log.name}")
+
+
+def prefill_history(args):
+    "先送 --prefill 則訊息，之後每次登入都要回放歷史"
+    if not args.prefill: return
+    sock = socket.create_connection((args.host, args.port))
+    sock.sendall(chat_codec.JSON.encode({'type': 1, 'nickname': 'lg_prefill', 'features': []}))
+    for i in range(args.prefill):
+        sock.sendall(chat_codec.JSON.encode({'type': 3, 'nickname': 'lg_prefill', 'message': f'history {i} ' + 'x' * args.size}))
+    time.sleep(0.5)
+    sock.close()
+
+
+def process_rss(pid):
+    "pid 與所有子行程 (--workers、縮圖子行程) 的 RSS 合計 (bytes)；非 Linux 時回傳 None"
+    total = 0
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'): total += int(line.split()[1]) * 1024
+        for tid in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{tid}/children') as f:
+                for child in f.read().split():
+                    total += process_rss(int(child)) or 0
+    except OSError:
+        return None
+    return total
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = [] # (秒, MB)
+        self.stop = threading.Event()
+        self.start_time = time.monotonic()
+
+    def run(self):
+        while not self.stop.is_set():
+            rss = process_rss(self.pid)
+            if rss is None: return
+            self.samples.append((round(time.monotonic() - self.start_time, 1), round(rss / (1 << 20), 1)))
+            self.stop.wait(self.interval)
+
+    def summary(self):
+        if not self.samples: return None
+        values = [mb for _, mb in self.samples]
+        return {'start': values[0], 'peak': max(values), 'end': values[-1], 'samples': self.samples}
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def report(args, shares, rss, elapsed):
+    stats = Stats()
+    for share in shares:
+        for kind in KINDS:
+            stats.latency[kind] += share['latency'][kind]
+            stats.sent[kind] += share['sent'][kind]
+        stats.login += share['login']
+        for key in ('acked', 'frames', 'logins', 'cpu'):
+            setattr(stats, key, getattr(stats, key) + share[key])
+        for reason, count in share['errors'].items():
+            stats.errors[reason] = stats.errors.get(reason, 0) + count
+    delivered = {kind: len(stats.latency[kind]) for kind in KINDS}
+    return {
+        'version': git_version(),
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'config': vars(args),
+        'clients': {'target': args.clients, 'logins': stats.logins},
+        'login_ms': percentiles(stats.login),
+        'latency_ms': {kind: percentiles(stats.latency[kind], 0.001) for kind in KINDS},
+        'sent_per_sec': {kind: round(stats.sent[kind] / args.duration, 1) for kind in KINDS},
+        'delivered_per_sec': {kind: round(delivered[kind] / args.duration, 1) for kind in KINDS},
+        'sent': stats.sent,
+        'delivered': delivered,
+        'acked': stats.acked,
+        'frames': stats.frames,
+        'server_rss_mb': rss,
+        'loadgen_cpu': round(stats.cpu / elapsed, 2), # 1.0 = 一顆核心滿載；接近 --procs 時結果受限於模擬端
+        'errors': stats.errors,
+    }
+
+
+def print_summary(result):
+    print(f"登入 {result['clients']['logins']}/{result['clients']['target']}  "
+          f"登入時間 p50 {result['login_ms'].get('p50')} ms  p99 {result['login_ms'].get('p99')} ms")
+    print(f"{'kind':<9}{'sent/s':>9}{'recv/s':>10}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for kind in KINDS:
+        lat = result['latency_ms'][kind]
+        print(f"{kind:<9}{result['sent_per_sec'][kind]:>9}{result['delivered_per_sec'][kind]:>10}"
+              f"{lat.get('p50', '-'):>9}{lat.get('p90', '-'):>9}{lat.get('p99', '-'):>9}{lat.get('max', '-'):>9}")
+    rss = result['server_rss_mb']
+    if rss: print(f"伺服器 RSS: {rss['start']} -> 最高 {rss['peak']} MB")
+    print(f"模擬端 CPU: {result['loadgen_cpu']} 核  錯誤: {result['errors'] or '無'}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6000)
+    parser.add_argument('--spawn', action='store_true', help='自己在暫存目錄啟動 newserver.py (結束時關閉)')
+    parser.add_argument('--server-args', default='', help='--spawn 時傳給伺服器的參數，例如 "--engine asyncio --workers 4"')
+    parser.add_argument('--server-pid', type=int, help='沒有 --spawn 時，要量 RSS 的伺服器 pid')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--procs', type=int, default=1, help='模擬客戶端分散到幾個行程')
+    parser.add_argument('--ramp', type=float, default=200, help='每秒新建幾條連線')
+    parser.add_argument('--connect-timeout', type=float, default=60)
+    parser.add_argument('--duration', type=float, default=20, help='產生流量的秒數')
+    parser.add_argument('--drain', type=float, default=2, help='停止送出後再等幾秒收完')
+    parser.add_argument('--rate', type=float, default=0.2, help='每個客戶端每秒幾則聊天訊息')
+    parser.add_argument('--pm-rate', type=float, default=0.02, help='每個客戶端每秒幾則私訊')
+    parser.add_argument('--image-rate', type=float, default=0, help='全部客戶端合計每秒幾張圖片')
+    parser.add_argument('--image-kb', type=int, default=256)
+    parser.add_argument('--size', type=int, default=60, help='文字訊息的長度')
+    parser.add_argument('--churn', type=float, default=0, help='全部合計每秒幾個客戶端斷線並換新的連上')
+    parser.add_argument('--prefill', type=int, default=10, help='開始前先送幾則訊息當作登入時回放的歷史')
+    parser.add_argument('--features', default='presence_delta,binary',
+                        help='模擬客戶端宣告的功能 (逗號分隔，例如加上 zlib、chunked_images)')
+    parser.add_argument('--json', help='結果寫到這個檔案 ("-" 為標準輸出)')
+    args = parser.parse_args()
+
+    server = spawn_server(args) if args.spawn else None
+    pid = server.pid if server else args.server_pid
+    sampler = RssSampler(pid) if pid else None
+    try:
+        prefill_history(args)
+        if sampler: sampler.start()
+        start = time.monotonic()
+        if args.procs == 1:
+            shares = [asyncio.run(Load(args, 0, args.clients).run()).to_dict()]
+        else:
+            context = multiprocessing.get_context('spawn')
+            results = context.Queue()
+            counts = [args.clients // args.procs + (i < args.clients % args.procs) for i in range(args.procs)]
+            procs = [context.Process(target=run_share, args=(args, i, n, results)) for i, n in enumerate(counts)]
+            for proc in procs: proc.start()
+            shares = [results.get() for _ in procs]
+            for proc in procs: proc.join()
+        elapsed = time.monotonic() - start
+        if sampler: sampler.stop.set()
+        result = report(args, shares, sampler.summary() if sampler else None, elapsed)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    print_summary(result)
+    if args.json == '-':
+        json.dump(result, sys.stdout, indent=1)
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=1)
@@ -0,0 +1,73 @@
+"""全文搜尋的延遲：在 N 則訊息的資料庫上，各種查詢 (常見字 / 罕見字 / 小房間 / 指定發言者) 的 p50 / p99
+
+用法: python bench_search.py --rows 1000000 --repeat 50 --db bench_search.db
+(資料庫已存在且筆數相同時沿用，不重新產生)
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+
+import chat_store
+
+WORDS = ['hello', '大家好', '今天', '晚餐', '吃什麼', 'ok', '哈哈', 'meeting', '明天', '開會',
+         'image', '好喔', '等等', '?', '!!', 'lol', '我到了', '下班', '週末', 'python']
+RARE = '獨角獸 zebra' # 約萬分之五的訊息含有
+
+
+def generate(store, rows):
+    "80% 在大廳，其餘平均分在 20 個小房間；直接寫入 messages 後一次重建索引"
+    rnd = random.Random(1)
+    conn = store.connect()
+    with conn:
+        conn.execute("DELETE FROM messages")
+        batch = []
+        for i in range(rows):
+            room = chat_store.DEFAULT_ROOM if rnd.random() < 0.8 else f'room{rnd.randrange(20)}'
+            message = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12)))
+            if rnd.random() < 0.0005: message += ' ' + RARE
+            batch.append((json.dumps({'type': 5, 'nickname': f'user{rnd.randrange(300)}', 'room': room,
+                                      'message': message, 'time': '2025/01/01 12:00'}), room))
+            if len(batch) == 10000:
+                conn.executemany("INSERT INTO messages (json_content, room) VALUES (?, ?)", batch)
+                batch.clear()
+        conn.executemany("INSERT INTO messages (json_content, room) VALUES (?, ?)", batch)
+    store.rebuild_search_index(conn)
+    conn.close()
+
+
+def timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return result, statistics.median(times), times[min(len(times) - 1, int(len(times) * 0.99))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--db', default='bench_search.db')
+    args = parser.parse_args()
+
+    store = chat_store.MessageStore(args.db, args.db + '.blobs') # 不會寫入圖片
+    store.open()
+    if store.reader.execute("SELECT COUNT(*) FROM messages").fetchone()[0] != args.rows:
+        start = time.perf_counter()
+        generate(store, args.rows)
+        print(f"產生 {args.rows} 則訊息與索引: {time.perf_counter() - start:.1f} 秒, "
+              f"資料庫 {os.path.getsize(args.db) >> 20} MB")
+
+    cases = [('常見詞', '晚餐', None), ('片語', '吃什麼', None), ('兩個詞', '今天 開會', None),
+             ('單一個字', '晚', None), ('英文', 'hello', None), ('罕見詞', 'zebra', None),
+             ('只指定發言者', '', 'user5'), ('詞 + 發言者', '晚餐', 'user5')]
+    print(f"{'query':<14}{'room':<8}{'hits':>6}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, query, sender in cases:
+        for room in (chat_store.DEFAULT_ROOM, 'room3'):
+            hits, p50, p99 = timed(lambda: store.search(room, query, sender), args.repeat)
+            print(f"{name:<14}{room:<8}{len(hits):>6}{p50:>10.2f}{p99:>10.2f}")
@@ -0,0 +1,205 @@
+import asyncio
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+# 多行程模式 (newserver.py --workers N) 的本機訊息匯流排。
+# 每則訊息是一行 JSON 標頭；標頭有 "frame": true 時後面再接一行已編碼好的聊天封包，
+# hub 只解析標頭決定要轉給哪些 worker，封包 bytes 原封不動轉送，不重新編碼。
+
+def encode_header(header):
+    return (json.dumps(header) + '\n').encode('utf-8')
+
+
+class BusClient:
+    """worker 端：連到 hub 的 Unix socket。
+    送出先放進佇列，由專屬執行緒合併寫入 (不會卡住事件迴圈)；
+    收到的訊息在讀取執行緒上交給 dispatch(header, frame)"""
+
+    def __init__(self, path, worker_id, dispatch):
+        self.path = path
+        self.worker_id = worker_id
+        self.dispatch = dispatch
+        self.sock = None
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.requests = {} # 請求編號 -> [Event, 回覆]
+        self.request_ids = itertools.count(1)
+
+    def connect(self, timeout=10):
+        "hub 可能還在啟動，重試到 timeout 為止"
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.path)
+                break
+            except OSError:
+                self.sock.close()
+                if time.monotonic() > deadline: raise
+                time.sleep(0.1)
+        self.send({'op': 'hello', 'worker': self.worker_id})
+        threading.Thread(target=self.write_loop, daemon=True).start()
+        threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def send(self, header, frame=None):
+        data = encode_header(header if frame is None else {**header, 'frame': True})
+        with self.lock:
+            self.pending.append(data)
+            if frame is not None: self.pending.append(frame)
+        self.ready.set()
+
+    def request(self, header, timeout=5):
+        "送出並等待 hub 回覆 (標頭裡的 reply 對應 req)，逾時回傳 None"
+        req = next(self.request_ids)
+        waiter = [threading.Event(), None]
+        self.requests[req] = waiter
+        self.send({**header, 'req': req})
+        waiter[0].wait(timeout)
+        self.requests.pop(req, None)
+        return waiter[1]
+
+    def write_loop(self):
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            with self.lock:
+                data = b''.join(self.pending)
+                self.pending.clear()
+            if data: self.sock.sendall(data)
+
+    def read_loop(self):
+        f = self.sock.makefile('rb')
+        while True:
+            line = f.readline()
+            if not line: break
+            header = json.loads(line)
+            frame = f.readline() if header.get('frame') else None
+            if 'reply' in header:
+                waiter = self.requests.get(header['reply'])
+                if waiter:
+                    waiter[1] = header
+                    waiter[0].set()
+                continue
+            try:
+                self.dispatch(header, frame)
+            except Exception as e:
+                print(f"Bus Error: {e}")
+        # hub (supervisor) 不在了，這個 worker 也無法正常運作
+        print(f"[worker {self.worker_id}] 與 hub 的連線中斷，結束")
+        os._exit(1)
+
+
+class BusHub:
+    """supervisor 端：在 worker 之間轉送訊息，並維護全域名單。
+    users: 暱稱 -> worker (全域不可重複，seq 在這裡遞增，所有 worker 依序收到差異)
+    rooms: 房間 -> 有成員在該房間的 worker，房間訊息只轉給這些 worker"""
+
+    def __init__(self, path, limit):
+        self.path = path
+        self.limit = limit
+        self.workers = {} # worker id -> StreamWriter
+        self.users = {}
+        self.rooms = {}
+        self.seq = 0
+        self.loop = None
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        if os.path.exists(self.path): os.remove(self.path) # 上次沒清掉的 socket 檔
+        server = await asyncio.start_unix_server(self.handle_worker, self.path, limit=self.limit)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_worker(self, reader, writer):
+        hello = json.loads(await reader.readline())
+        worker = hello['worker']
+        if worker in self.workers: # 重啟的 worker 比舊連線的 finally 先連上：舊的使用者先清掉
+            self.drop_users(worker)
+        self.workers[worker] = writer
+        # 新 worker 先拿到目前的全域名單，之後的差異都接在這個 seq 後面
+        writer.write(encode_header({'op': 'roster', 'users': list(self.users), 'seq': self.seq}))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                header = json.loads(line)
+                frame = await reader.readline() if header.get('frame') else None
+                self.route(worker, header, line, frame)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            # worker 結束：它的使用者全部離線 (已經被重啟的新連線取代時，名單歸新連線管)
+            if self.workers.get(worker) is writer:
+                del self.workers[worker]
+                self.drop_users(worker)
+            writer.close()
+
+    def drop_users(self, worker):
+        for nickname in [n for n, w in self.users.items() if w == worker]:
+            del self.users[nickname]
+            self.presence('leave', nickname)
+        for members in self.rooms.values():
+            members.discard(worker)
+
+    def route(self, worker, header, line, frame):
+        op = header['op']
+        if op == 'join':
+            nickname = header['nickname']
+            ok = nickname not in self.users
+            if ok:
+                self.users[nickname] = worker
+                self.presence('join', nickname) # 先送差異再回覆，回覆到時名單副本已包含自己
+            self.send(worker, {'reply': header['req'], 'ok': ok})
+        elif op == 'leave':
+            nickname = header['nickname']
+            if self.users.get(nickname) == worker:
+                del self.users[nickname]
+                self.presence('leave', nickname)
+        elif op == 'sub':
+            self.rooms.setdefault(header['room'], set()).add(worker)
+        elif op == 'unsub':
+            members = self.rooms.get(header['room'])
+            if members:
+                members.discard(worker)
+                if not members: del self.rooms[header['room']]
+        elif op == 'private':
+            target = self.users.get(header['target'])
+            if target is not None: self.forward(target, line, frame)
+        else: # frame / image：房間訊息只給訂閱的 worker，沒有房間的是全體公告
+            room = header.get('room')
+            targets = self.workers if room is None else self.rooms.get(room, ())
+            for target in list(targets):
+                if target != worker: self.forward(target, line, frame)
+
+    def forward(self, worker, line, frame=None):
+        writer = self.workers.get(worker)
+        if writer is None: return
+        writer.write(line)
+        if frame is not None: writer.write(frame)
+
+    def send(self, worker, header):
+        self.forward(worker, encode_header(header))
+
+    def presence(self, change, nickname):
+        self.seq += 1
+        line = encode_header({'op': 'presence', 'change': change, 'nickname': nickname, 'seq': self.seq})
+        for worker in list(self.workers):
+            self.forward(worker, line)
+
+    # --- 給管理員控制台 (其他執行緒) 呼叫 ---
+    def command(self, header):
+        self.loop.call_soon_threadsafe(self.run_command, header)
+
+    def run_command(self, header):
+        if header['op'] == 'kick':
+            worker = self.users.get(header['nickname'])
+            if worker is not None: self.send(worker, header)
+        else: # stop / stats / profile：送給所有 worker
+            for worker in list(self.workers):
+                self.send(worker, header)
@@ -0,0 +1,155 @@
+import asyncio
+import base64
+import json
+import re
+import struct
+import zlib
+
+# 伺服器與客戶端共用的封包編碼。線路上有三種框，第一個 byte 都不同，
+# 讀取端不必知道對方目前用哪一種 (登入前一律是 JSON)：
+#   {...}\n                              json：一行一個封包 (預設，舊版只懂這種)
+#   0x01 + !II(標頭長度, 附件長度) + 標頭 + 附件
+#                                        binary：標頭是不含圖片欄位的 JSON，圖片以原始 bytes 附在後面，
+#                                        不必 base64 (少 33%)，接收端也不必解析好幾 MB 的 JSON 字串
+#   0x00 + !I(長度) + 資料                zlib 壓縮區塊 (只有伺服器送出)，解開後是上面兩種框的序列
+
+ZLIB_MARK = b'\x00'
+BINARY_MARK = b'\x01'
+BINARY_HEADER = struct.Struct('!II')
+BLOB_FIELDS = ('image_data', 'thumb_data', 'data') # json 裡以 base64 字串表示的圖片欄位
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+TYPE_FIELD = re.compile(rb'"type": (\d+)')
+
+
+def blob(msg, key):
+    "取出圖片欄位的原始 bytes (binary 收到的已是 bytes，json 收到的是 base64 字串)"
+    value = msg[key]
+    return value if isinstance(value, bytes) else base64.b64decode(value)
+
+
+class JsonCodec:
+    name = 'json'
+
+    def encode(self, msgdict):
+        "圖片欄位可以直接放 bytes，這裡轉成 base64"
+        if any(isinstance(msgdict.get(key), bytes) for key in BLOB_FIELDS):
+            msgdict = {k: base64.b64encode(v).decode() if isinstance(v, bytes) else v
+                       for k, v in msgdict.items()}
+        return (json.dumps(msgdict) + '\n').encode('utf-8')
+
+    def wrap(self, line):
+        return line
+
+
+class BinaryCodec:
+    name = 'binary'
+
+    def encode(self, msgdict):
+        for key in BLOB_FIELDS:
+            value = msgdict.get(key)
+            if value is None: continue
+            if isinstance(value, str): value = base64.b64decode(value)
+            header = {k: v for k, v in msgdict.items() if k != key}
+            header['blob'] = key # 附件屬於哪個欄位
+            return self.frame(json.dumps(header).encode('utf-8'), value)
+        return self.frame(json.dumps(msgdict).encode('utf-8'))
+
+    def frame(self, header, attachment=b''):
+        return b''.join((BINARY_MARK, BINARY_HEADER.pack(len(header), len(attachment)), header, attachment))
+
+    def wrap(self, line):
+        """已編碼好的 json 行直接包成 binary 框 (不重新解析)；
+        廣播時同一則訊息只包一次，已經是 binary 的原樣回傳"""
+        if line[:1] != b'{': return line
+        return self.frame(line[:-1])
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+
+
+def frame_type(data):
+    """已編碼的框是哪個 type (只看開頭，不解析整個封包)；壓縮區塊或看不出來時回傳 None。
+    json.dumps 依照 dict 的順序輸出，伺服器組的封包 type 都在第一個欄位"""
+    start = 1 + BINARY_HEADER.size if data[:1] == BINARY_MARK else 0
+    match = TYPE_FIELD.search(data, start, start + 64)
+    return int(match.group(1)) if match else None
+
+
+def decode_binary(header, attachment):
+    msg = json.loads(header)
+    key = msg.pop('blob', None)
+    if key: msg[key] = attachment
+    return msg
+
+
+def split_frames(data):
+    "解開後的壓縮區塊：裡面一定是完整的框"
+    i = 0
+    while i < len(data):
+        if data[i] == BINARY_MARK[0]:
+            hlen, blen = BINARY_HEADER.unpack_from(data, i + 1)
+            start = i + 1 + BINARY_HEADER.size
+            yield decode_binary(data[start:start + hlen], data[start + hlen:start + hlen + blen])
+            i = start + hlen + blen
+        else:
+            end = data.index(b'\n', i)
+            yield json.loads(data[i:end])
+            i = end + 1
+
+
+def read_exact(f, size):
+    data = f.read(size)
+    return data if len(data) == size else None
+
+
+def read_packets(f, limit=MAX_FRAME_BYTES, on_bytes=None):
+    """從以 'rb' 開啟的 socket 檔案逐一產生封包 (dict)，連線結束時停止。
+    三種框可以混在一起；壓縮區塊在整條連線共用同一個解壓縮串流。
+    on_bytes(n)：每讀完一個框呼叫一次，n 為線路上的位元組數 (伺服器統計流量用)"""
+    inflater = zlib.decompressobj(-15)
+    while True:
+        mark = f.read(1)
+        if not mark: return
+        if mark == BINARY_MARK:
+            sizes = read_exact(f, BINARY_HEADER.size)
+            if sizes is None: return
+            hlen, blen = BINARY_HEADER.unpack(sizes)
+            if hlen + blen > limit: raise ValueError(f"frame too large: {hlen + blen}")
+            header, attachment = read_exact(f, hlen), read_exact(f, blen)
+            if header is None or attachment is None: return
+            if on_bytes: on_bytes(1 + BINARY_HEADER.size + hlen + blen)
+            yield decode_binary(header, attachment)
+        elif mark == ZLIB_MARK:
+            size = read_exact(f, 4)
+            data = size and read_exact(f, int.from_bytes(size, 'big'))
+            if not data: return
+            if on_bytes: on_bytes(5 + len(data))
+            yield from split_frames(inflater.decompress(data))
+        else:
+            line = mark + f.readline(limit)
+            if not line.endswith(b'\n'):
+                if len(line) > limit: raise ValueError(f"line too large: > {limit}") # 一直不送換行
+                return # 讀到一半斷線
+            if on_bytes: on_bytes(len(line))
+            yield json.loads(line)
+
+
+async def read_packet(reader, limit=MAX_FRAME_BYTES, on_bytes=None):
+    "asyncio 版 (伺服器接收端，客戶端不會送壓縮區塊)：回傳一個封包，連線結束時回傳 None"
+    try:
+        mark = await reader.read(1)
+        if not mark: return None
+        if mark == BINARY_MARK:
+            hlen, blen = BINARY_HEADER.unpack(await reader.readexactly(BINARY_HEADER.size))
+            if hlen + blen > limit: raise ValueError(f"frame too large: {hlen + blen}")
+            header, attachment = await reader.readexactly(hlen), await reader.readexactly(blen)
+            if on_bytes: on_bytes(1 + BINARY_HEADER.size + hlen + blen)
+            return decode_binary(header, attachment)
+        if mark == ZLIB_MARK: raise ValueError("unexpected compressed frame")
+        line = mark + await reader.readline()
+    except asyncio.IncompleteReadError:
+        return None
+    if not line.endswith(b'\n'): return None
+    if on_bytes: on_bytes(len(line))
+    return json.loads(line)
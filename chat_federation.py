@@ -0,0 +1,284 @@
+import hashlib
+import hmac
+import json
+import secrets
+import socket
+import threading
+import time
+from collections import deque, OrderedDict
+
+# 伺服器之間的聯邦連線 (newserver.py --fed-port / --peer)。
+# 每行一個 JSON 事件：
+#   challenge {nonce}                      連線建立時互相送出的隨機值
+#   hello    {node, seen, auth}            收到 challenge 後回覆，seen = 各來源節點已收到的最大序號，
+#                                          auth = HMAC(共用密鑰, 對方的 nonce:本節點名稱)；驗證通過前其他事件一律斷線
+#   msg      {uid, origin, seq, packet}   type 5 聊天訊息
+#   image    {uid, origin, seq, row, data} type 9 圖片 (data 為 base64 原圖)
+#   private  {uid, origin, seq, packet}   type 7 私訊，只送給收件人所在的節點，不轉送也不補送
+#   roster   {node, users}                對方節點上目前的使用者
+#   presence {node, change, nickname}     對方節點的使用者登入 / 離線
+
+FED_LOG_SIZE = 10000   # 保留多少則訊息供斷線後補送
+SEEN_IDS = 100000      # 去重用，記住最近收過的 uid 數量
+RECONNECT_MAX = 30     # 主動連線失敗時最長的重試間隔 (秒)
+CARRIED = ('msg', 'image') # 有 uid、會轉送與補送的事件
+MAX_EVENT_BYTES = 16 * 1024 * 1024 # 一行事件的上限 (圖片 10MB，base64 後約 13MB)
+MAX_HELLO_BYTES = 64 * 1024        # 驗證通過前 (challenge / hello) 的上限
+
+
+def encode_event(event):
+    return (json.dumps(event) + '\n').encode('utf-8')
+
+
+def split_uid(uid):
+    origin, _, seq = uid.rpartition(':')
+    return origin, int(seq)
+
+
+class PeerLink:
+    """與一個節點之間的一條連線。
+    送出先放進佇列由專屬執行緒寫入，讀取在 run() 的執行緒上進行"""
+
+    def __init__(self, federation, sock, address):
+        self.federation = federation
+        self.sock = sock
+        self.address = address
+        self.node = None # 收到 hello 並驗證通過後才知道對方是誰
+        self.nonce = secrets.token_hex(16) # 對方的 hello 要以這個值簽名
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.closed = False
+
+    def send(self, event):
+        self.send_raw(encode_event(event))
+
+    def send_raw(self, data):
+        "data 也可以是回傳 bytes 的函式，在 writer 執行緒上才呼叫 (例如要讀圖片檔的補送)"
+        with self.lock:
+            if self.closed: return
+            self.pending.append(data)
+        self.ready.set()
+
+    def run(self):
+        "阻塞到連線中斷為止"
+        threading.Thread(target=self.write_loop, daemon=True).start()
+        self.send({'op': 'challenge', 'nonce': self.nonce})
+        try:
+            f = self.sock.makefile('rb')
+            while True:
+                limit = MAX_EVENT_BYTES if self.node else MAX_HELLO_BYTES
+                line = f.readline(limit + 1)
+                if not line.endswith(b'\n'):
+                    if len(line) > limit: raise ValueError(f"事件超過 {limit} bytes")
+                    break # 連線結束
+                self.federation.receive(self, line)
+        except (OSError, ValueError, KeyError, TypeError) as e: # 格式不對的事件也中斷連線，不讓執行緒帶著 traceback 結束
+            print(f"[federation] {self.node or self.address}: {e!r}")
+        finally:
+            self.close()
+            self.federation.link_down(self)
+
+    def write_loop(self):
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            with self.lock:
+                items = list(self.pending)
+                self.pending.clear()
+                closed = self.closed
+            if items:
+                try:
+                    self.sock.sendall(b''.join(item() if callable(item) else item for item in items))
+                except OSError:
+                    self.close()
+                    return
+            if closed: return
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.ready.set()
+        try: self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+
+class Federation:
+    """把多台伺服器串成同一個聊天室。
+    每則訊息有全域唯一的 uid (節點名稱:序號)。收到時依 uid 去重，再轉給其他節點，
+    所以就算連線形成迴圈也不會重複或繞圈；自己發出的訊息回到自己時直接丟棄。
+    log 保留最近的訊息，連線 (重新) 建立時依對方 hello 裡的 seen 補送漏掉的部分。
+    名單只在直接相連的節點之間交換，所以每個節點都應該與其他所有節點連線 (full mesh)。
+
+    on_event(event)     處理收到的新訊息 / 名單事件 (在連線的讀取執行緒上呼叫)
+    local_users()       本節點目前的使用者 (在 lock 內呼叫，不能再回頭呼叫 Federation)
+    on_node_down(node)  與某節點的最後一條連線中斷
+    expand(event)       送出前補上不放在 log 裡的資料 (圖片)，回傳新的 dict；可能讀磁碟，不在 lock 內呼叫
+    secret              所有節點共用的密鑰，hello 以它簽名，不知道密鑰的連線無法送入任何事件"""
+
+    def __init__(self, node, on_event, local_users, on_node_down, expand, secret, log_size=FED_LOG_SIZE):
+        self.node = node
+        self.secret = secret.encode('utf-8')
+        self.on_event = on_event
+        self.local_users = local_users
+        self.on_node_down = on_node_down
+        self.expand = expand
+        self.links = set()    # 已完成 hello 的連線
+        self.nodes = {}       # 節點 -> 連線數 (兩邊都設定 --peer 時會有兩條)
+        self.log = deque(maxlen=log_size)
+        self.seen = {}        # 來源節點 -> 已收到的最大序號
+        self.seen_ids = OrderedDict()
+        self.last_seq = 0
+        self.lock = threading.Lock()
+
+    # --- 本節點產生的訊息 ---
+    def stamp(self, packet):
+        """配發 uid 並寫進封包 (所以也會存進資料庫)。
+        序號以微秒時間為底，重新啟動後仍然遞增"""
+        with self.lock:
+            self.last_seq = max(self.last_seq + 1, time.time_ns() // 1000)
+            packet['uid'] = f"{self.node}:{self.last_seq}"
+            self.seen[self.node] = self.last_seq
+        return packet['uid']
+
+    def publish(self, op, uid, **body):
+        "送給所有節點並記錄在 log 裡 (補送用)"
+        event = self.make_event(op, uid, body)
+        data = encode_event(self.expand(event))
+        with self.lock:
+            self.remember(event)
+            for link in self.links:
+                link.send_raw(data)
+
+    def send_to(self, node, op, uid, **body):
+        "只送給某個節點 (私訊)；不記錄在 log，也不會被轉送。兩邊都設定 --peer 時只走其中一條"
+        event = self.make_event(op, uid, body)
+        with self.lock:
+            link = next((link for link in self.links if link.node == node), None)
+            if link is None: return False
+            link.send(event)
+        return True
+
+    def announce(self, change, nickname):
+        "本節點的使用者登入 / 離線"
+        event = encode_event({'op': 'presence', 'node': self.node, 'change': change, 'nickname': nickname})
+        with self.lock:
+            for link in self.links:
+                link.send_raw(event)
+
+    def load(self, events):
+        "啟動時從資料庫載入最近的訊息 (舊到新)，重新連線時才能補送，也不會把已有的訊息再收一次"
+        with self.lock:
+            for event in events:
+                self.remember(event)
+                if event['origin'] == self.node:
+                    self.last_seq = max(self.last_seq, event['seq'])
+
+    def make_event(self, op, uid, body):
+        origin, seq = split_uid(uid)
+        return {'op': op, 'uid': uid, 'origin': origin, 'seq': seq, **body}
+
+    def remember(self, event):
+        "呼叫端持有 lock"
+        self.log.append(event)
+        self.seen_ids[event['uid']] = None
+        if len(self.seen_ids) > SEEN_IDS:
+            self.seen_ids.popitem(last=False)
+        if event['seq'] > self.seen.get(event['origin'], 0):
+            self.seen[event['origin']] = event['seq']
+
+    # --- 連線 ---
+    def sign(self, nonce, node):
+        return hmac.new(self.secret, f"{nonce}:{node}".encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def hello(self, nonce):
+        "回覆對方的 challenge"
+        with self.lock:
+            return {'op': 'hello', 'node': self.node, 'seen': dict(self.seen), 'auth': self.sign(nonce, self.node)}
+
+    def listen(self, host, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(16)
+        print(f"[federation] {self.node} 等待其他節點連線 {host}:{port}")
+        threading.Thread(target=self.accept_loop, args=(sock,), daemon=True).start()
+
+    def accept_loop(self, sock):
+        while True:
+            conn, address = sock.accept()
+            link = PeerLink(self, conn, address)
+            threading.Thread(target=link.run, daemon=True).start()
+
+    def connect(self, host, port):
+        "主動連到另一個節點，中斷後自動重連 (間隔逐步加長)"
+        threading.Thread(target=self.connect_loop, args=(host, port), daemon=True).start()
+
+    def connect_loop(self, host, port):
+        delay = 1
+        while True:
+            try:
+                sock = socket.create_connection((host, port), timeout=5)
+                sock.settimeout(None)
+                delay = 1
+                PeerLink(self, sock, (host, port)).run()
+            except OSError:
+                pass
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    def link_down(self, link):
+        with self.lock:
+            if link not in self.links: return
+            self.links.discard(link)
+            self.nodes[link.node] -= 1
+            last = not self.nodes[link.node]
+            if last: del self.nodes[link.node]
+        print(f"[federation] 與 {link.node} 的連線中斷")
+        if last: self.on_node_down(link.node)
+
+    # --- 收到事件 ---
+    def receive(self, link, line):
+        event = json.loads(line)
+        op = event['op']
+        if op == 'challenge':
+            link.send(self.hello(str(event['nonce'])))
+            return
+        if op == 'hello':
+            if link.node is None: self.link_up(link, event)
+            return
+        if link.node is None:
+            raise ValueError(f"未通過驗證就送出 {op}") # run() 收到後中斷連線
+        if op in CARRIED:
+            if event['origin'] == self.node: return # 自己的訊息繞回來
+            with self.lock:
+                if event['uid'] in self.seen_ids: return
+                # 原樣轉給其他節點 (不重新編碼)，log 裡不留圖片資料
+                self.remember({k: v for k, v in event.items() if k != 'data'})
+                for other in self.links:
+                    if other is not link: other.send_raw(line)
+            self.on_event(event)
+        else:
+            self.on_event(event) # private / roster / presence
+
+    def link_up(self, link, hello):
+        node = str(hello['node'])
+        if not hmac.compare_digest(str(hello.get('auth', '')), self.sign(link.nonce, node)):
+            print(f"[federation] {link.address} 驗證失敗 (密鑰不同)，中斷連線")
+            link.close()
+            return
+        if node == self.node: # 連到自己
+            link.close()
+            return
+        link.node = node
+        seen = hello['seen']
+        with self.lock:
+            # 先排入補送與名單，之後的即時訊息 (含 announce) 才會接在後面；
+            # 補送的圖片要讀檔，排入的是函式，由這條連線的 writer 執行緒在 lock 外展開
+            for event in self.log:
+                if event['origin'] != link.node and event['seq'] > seen.get(event['origin'], 0):
+                    link.send_raw(lambda event=event: encode_event(self.expand(event)))
+            link.send({'op': 'roster', 'node': self.node, 'users': self.local_users()})
+            self.links.add(link)
+            self.nodes[link.node] = self.nodes.get(link.node, 0) + 1
+        print(f"[federation] 已連上 {link.node} ({link.address})")
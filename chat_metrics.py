@@ -0,0 +1,185 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 伺服器的計數器與延遲分佈 (newserver.py 的 /stats 指令與 --metrics-port)。
+# 記錄時只做一次 lock 與幾個整數加法，正式環境可以一直開著；
+# 要看的時候才整理成 Prometheus 文字格式 (render) 或給人看的摘要 (summary)。
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+
+def labels(name, key, extra=''):
+    "Prometheus 的 {label='value'}；key 為 None 代表沒有 label"
+    pairs = [] if key is None else [f'{name}="{key}"']
+    if extra: pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    "只增不減的計數，可以依一個 label 分開 (例如封包 type)"
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {} if label else {None: 0} # label 值 -> 累計；沒有 label 的一開始就輸出 0
+        self.lock = threading.Lock()
+
+    def inc(self, key=None, amount=1):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def add(self, amount, key=None):
+        "位元組數這類一次加很多的計數，可以直接當 callback"
+        self.inc(key, amount)
+
+    def samples(self):
+        with self.lock:
+            return sorted(self.values.items(), key=lambda item: str(item[0]))
+
+    def render(self):
+        return [f"{self.name}{labels(self.label, key)} {value}" for key, value in self.samples()]
+
+    def summary(self):
+        values = self.samples()
+        if self.label is None: return str(values[0][1])
+        return ' '.join(f"{key}={value}" for key, value in values) or '0'
+
+
+class Histogram:
+    "固定 bucket 的分佈 (Prometheus histogram)；只存每個 bucket 的次數與總和"
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label = label
+        self.series = {} # label 值 -> [各 bucket 次數 (最後一格是 +Inf), 總和]
+        if label is None: self.series[None] = [[0] * (len(self.buckets) + 1), 0]
+        self.lock = threading.Lock()
+
+    def observe(self, value, key=None):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][i] += 1
+            series[1] += value
+
+    def samples(self):
+        with self.lock:
+            return sorted(((key, list(counts), total) for key, (counts, total) in self.series.items()),
+                          key=lambda item: str(item[0]))
+
+    def render(self):
+        lines = []
+        for key, counts, total in self.samples():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{labels(self.label, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{labels(self.label, key)} {total}")
+            lines.append(f"{self.name}_count{labels(self.label, key)} {cumulative}")
+        return lines
+
+    def quantile(self, q, counts):
+        "由 bucket 估計分位數 (bucket 內線性內插，與 Prometheus 的 histogram_quantile 相同)"
+        rank = q * sum(counts)
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                if i == len(self.buckets): return self.buckets[-1] # 超過最大的 bucket
+                lower = self.buckets[i - 1] if i else 0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return 0
+
+    def summary(self):
+        "秒數以毫秒顯示"
+        scale, unit = (1000, 'ms') if self.name.endswith('_seconds') else (1, '')
+        parts = []
+        for key, counts, total in self.samples():
+            count = sum(counts)
+            if not count: continue
+            prefix = '' if key is None else f"{key}: "
+            parts.append(f"{prefix}n={count} avg={total / count * scale:.2f}{unit} "
+                         f"p50={self.quantile(0.5, counts) * scale:.2f}{unit} "
+                         f"p99={self.quantile(0.99, counts) * scale:.2f}{unit}")
+        return '; '.join(parts) or 'n=0'
+
+
+class Gauge:
+    "輸出時才呼叫 func 取值 (連線數、佇列長度這類隨時在變的值)"
+    kind = 'gauge'
+
+    def __init__(self, name, help, func):
+        self.name = name
+        self.help = help
+        self.func = func
+
+    def render(self):
+        return [f"{self.name} {self.func()}"]
+
+    def summary(self):
+        return str(self.func())
+
+
+class Metrics:
+    def __init__(self):
+        self.items = []
+
+    def add(self, item):
+        self.items.append(item)
+        return item
+
+    def counter(self, name, help, label=None):
+        return self.add(Counter(name, help, label))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, label=None):
+        return self.add(Histogram(name, help, buckets, label))
+
+    def gauge(self, name, help, func):
+        return self.add(Gauge(name, help, func))
+
+    def render(self):
+        "Prometheus 文字格式 (text/plain; version=0.0.4)"
+        lines = []
+        for item in self.items:
+            lines.append(f"# HELP {item.name} {item.help}")
+            lines.append(f"# TYPE {item.name} {item.kind}")
+            lines.extend(item.render())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        "給管理員控制台看的摘要，一個指標一行"
+        return [f"{item.name}: {item.summary()}" for item in self.items]
+
+    def serve(self, host, port):
+        "在背景執行緒提供 http://host:port/metrics"
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # 抓取很頻繁，不印存取紀錄
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,287 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+# 不必重新啟動就能量測執行中的伺服器 (newserver.py 的 /profile、/cprofile、/mem)。
+# 沒有在量測時不會多任何成本：取樣執行緒、cProfile 與 tracemalloc 都只在指令下達後才啟動。
+
+SAMPLE_INTERVAL = 0.005 # 取樣間隔 (秒)；每次取樣會短暫持有 GIL 走訪所有執行緒的堆疊
+SAMPLE_BUDGET = 0.2     # 取樣本身最多佔用的時間比例，執行緒很多時自動拉長間隔
+REPORT_LINES = 25
+# 3.12 起 cProfile 改用 sys.monitoring：整個行程同時只能啟用一個 Profile (第二個會 ValueError)，
+# 但一個就量得到所有執行緒
+SHARED_PROFILE = sys.version_info >= (3, 12)
+MEMORY_FRAMES = 10      # tracemalloc 每筆配置記錄幾層呼叫 (越多越慢、越佔記憶體)
+
+# 執行緒停在這些函式代表在等待 I/O 或事件
+IDLE_FUNCTIONS = {
+    ('threading.py', 'wait'), ('selectors.py', 'select'), ('socket.py', 'accept'),
+    ('socket.py', 'readinto'), ('queue.py', 'get'), ('base_events.py', '_run_once'),
+}
+
+
+def frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+
+def stack_of(frame):
+    "由外到內的函式名稱"
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    names.reverse()
+    return tuple(names)
+
+
+def is_idle(frame):
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE_FUNCTIONS
+
+
+def thread_cpu_ns(ident):
+    "該執行緒至今用掉的 CPU 時間 (ns)；不支援或執行緒已結束時回傳 None"
+    try:
+        return time.clock_gettime_ns(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+class Sampler:
+    """每隔 interval 記錄所有執行緒當下的堆疊 (不修改被量測的程式，可以量到所有執行緒)。
+    取樣時其他執行緒都不在執行 Python (GIL 在取樣執行緒手上)，停在 Python 程式裡的代表在等 GIL、想用 CPU；
+    停在 IDLE_FUNCTIONS 或上次取樣後完全沒用到 CPU (例如卡在 input()、sleep) 的算閒置"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter() # 堆疊 -> 次數
+        self.samples = 0
+        self.idle = 0
+        self.cpu_time = thread_cpu_ns(threading.get_ident()) is not None # 非 Unix 只看 IDLE_FUNCTIONS
+
+    def run(self, seconds):
+        me = threading.get_ident()
+        last = {} # 執行緒 -> 上次取樣時的 CPU 時間
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            for ident, frame in sys._current_frames().items():
+                if ident == me: continue
+                self.samples += 1
+                busy = not is_idle(frame)
+                if self.cpu_time:
+                    now = thread_cpu_ns(ident)
+                    busy = busy and now is not None and now != last.get(ident)
+                    last[ident] = now
+                if busy:
+                    self.stacks[stack_of(frame)] += 1
+                else:
+                    self.idle += 1
+            spent = time.perf_counter() - start
+            time.sleep(max(self.interval, spent / SAMPLE_BUDGET - spent))
+
+    def report(self, seconds, limit=REPORT_LINES):
+        busy = sum(self.stacks.values())
+        lines = [f"取樣 {seconds} 秒 (每 {self.interval * 1000:g} ms)，共 {self.samples} 筆，閒置 {self.idle} 筆"]
+        if not busy: return lines
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for name in set(stack): # 遞迴時同一個函式只算一次
+                total[name] += count
+        lines.append(f"{'self%':>7}{'total%':>8}  函式 (依 self 排序，百分比以非閒置的 {busy} 筆計算)")
+        for name, count in own.most_common(limit):
+            lines.append(f"{count * 100 / busy:>7.1f}{total[name] * 100 / busy:>8.1f}  {name}")
+        lines.append(f"{'total%':>15}  依 total 排序 (含呼叫的函式)")
+        for name, count in total.most_common(limit):
+            lines.append(f"{count * 100 / busy:>15.1f}  {name}")
+        return lines
+
+    def dump(self, path):
+        "folded stacks 格式 (flamegraph.pl / speedscope 可直接讀取)"
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+
+class CallProfiler:
+    """3.11 以前 cProfile 只能量測啟用它的那條執行緒，所以每條執行緒各用一個，
+    由被量測的程式呼叫 run() 包住要量的部分，結束時再合併。
+    3.12 起 (SHARED_PROFILE) 改由 start() / stop() 啟用整個行程共用的一個，run() 直接呼叫，
+    報表會包含這段期間所有執行緒的呼叫，不只協定處理"""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        "已有其他量測工具 (例如另一個 cProfile 或除錯器) 在執行時回傳 False"
+        if not SHARED_PROFILE: return True
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return False
+        self.profiles.append(profile)
+        return True
+
+    def stop(self):
+        if SHARED_PROFILE and self.profiles: self.profiles[0].disable()
+
+    def run(self, func, *args):
+        if SHARED_PROFILE: return func(*args)
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+        try:
+            profile.enable()
+        except ValueError: # 這條執行緒上已有其他量測工具，略過量測而不是讓封包處理失敗
+            return func(*args)
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+
+    def stats(self):
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles: return None
+        stats = pstats.Stats(profiles[0], stream=io.StringIO())
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def report(self, seconds, limit=REPORT_LINES):
+        stats = self.stats()
+        if stats is None: return [f"cProfile {seconds} 秒：期間沒有收到任何封包"]
+        scope = '整個行程' if SHARED_PROFILE else f"{len(self.profiles)} 條執行緒"
+        lines = [f"cProfile {seconds} 秒，{scope}"]
+        for key in ('cumulative', 'tottime'):
+            stats.stream = io.StringIO()
+            stats.sort_stats(key).print_stats(limit)
+            lines.extend(line for line in stats.stream.getvalue().splitlines() if line.strip())
+        return lines
+
+    def dump(self, path):
+        stats = self.stats()
+        if stats is not None: stats.dump_stats(path)
+
+
+class Profiler:
+    """管理員指令用的量測工具，同一時間只會有一個 CPU 量測在進行。
+    報表交給 output(lines) (例如印在控制台)，完整資料另存成檔案"""
+
+    def __init__(self, output, prefix='profile'):
+        self.output = output
+        self.prefix = prefix     # 檔名開頭，多行程模式下加上 worker 編號
+        self.calls = None        # /cprofile 期間的 CallProfiler，平時為 None
+        self.busy = threading.Lock()
+        self.snapshot = None     # 上一次的 tracemalloc 快照
+
+    def filename(self, ext):
+        return f"{self.prefix}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{ext}"
+
+    def start(self, target, seconds):
+        if not self.busy.acquire(blocking=False):
+            self.output(["已經有量測在進行中"])
+            return
+        threading.Thread(target=target, args=(seconds,), daemon=True).start()
+
+    # --- 取樣 ---
+    def sample(self, seconds):
+        self.start(self.run_sampler, seconds)
+
+    def run_sampler(self, seconds):
+        try:
+            self.output([f"開始取樣 {seconds} 秒..."])
+            sampler = Sampler()
+            sampler.run(seconds)
+            path = self.filename('folded')
+            sampler.dump(path)
+            self.output(sampler.report(seconds) + [f"完整堆疊: {path}"])
+        finally:
+            self.busy.release()
+
+    # --- cProfile ---
+    def profile(self, seconds):
+        self.start(self.run_calls, seconds)
+
+    def run_calls(self, seconds):
+        try:
+            self.output([f"開始 cProfile {seconds} 秒..."])
+            calls = CallProfiler()
+            if not calls.start():
+                self.output(["無法啟動 cProfile：已有其他量測工具在執行"])
+                return
+            self.calls = calls
+            time.sleep(seconds)
+            self.calls = None
+            time.sleep(0.1) # 讓正在 run() 裡的呼叫結束
+            calls.stop()
+            path = self.filename('pstats')
+            calls.dump(path)
+            self.output(calls.report(seconds) + [f"完整資料: {path} (python -m pstats 讀取)"])
+        finally:
+            self.busy.release()
+
+    def run(self, func, *args):
+        "被量測的程式呼叫這個；沒有在量測時直接呼叫 func"
+        calls = self.calls
+        if calls is None: return func(*args)
+        return calls.run(func, *args)
+
+    # --- 記憶體 ---
+    def memory(self, action, limit=REPORT_LINES):
+        if action == 'start':
+            if tracemalloc.is_tracing():
+                self.output(["tracemalloc 已經在記錄中"])
+                return
+            tracemalloc.start(MEMORY_FRAMES)
+            self.snapshot = None
+            self.output(["tracemalloc 開始記錄 (記錄期間配置記憶體會變慢，量完請 /mem stop)"])
+        elif action == 'snap':
+            if not tracemalloc.is_tracing():
+                self.output(["請先 /mem start"])
+                return
+            self.output(self.take_snapshot(limit))
+        elif action == 'stop':
+            tracemalloc.stop()
+            self.snapshot = None
+            self.output(["tracemalloc 已停止"])
+        else:
+            self.output(["格式: /mem start | snap | stop"])
+
+    def take_snapshot(self, limit):
+        "目前配置最多的位置；有上一次的快照時另外列出這段期間的增減"
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"tracemalloc: 目前 {current / 1048576:.1f} MB，最高 {peak / 1048576:.1f} MB"]
+        lines.append("配置最多的位置:")
+        lines.extend(f"  {stat}" for stat in snapshot.statistics('lineno')[:limit])
+        if self.snapshot is not None:
+            lines.append("與上一次快照相比:")
+            diff = snapshot.compare_to(self.snapshot, 'lineno')
+            lines.extend(f"  {stat}" for stat in diff[:limit] if stat.size_diff)
+            # 增加最多的那個位置從哪裡呼叫
+            top = max(diff, key=lambda stat: stat.size_diff, default=None)
+            if top is not None and top.size_diff > 0:
+                lines.append("增加最多的位置的呼叫來源:")
+                for stat in snapshot.filter_traces((tracemalloc.Filter(True, top.traceback[0].filename,
+                                                                       top.traceback[0].lineno),)
+                                                   ).statistics('traceback')[:1]:
+                    lines.extend(f"  {line}" for line in stat.traceback.format())
+        self.snapshot = snapshot
+        return lines
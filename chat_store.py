@@ -0,0 +1,449 @@
+import sqlite3
+import threading
+import queue
+import time
+import itertools
+import hashlib
+import json
+import base64
+import os
+import shutil
+import struct
+import re
+import io
+
+try:
+    from PIL import Image # 只有產生縮圖需要；沒安裝時伺服器不提供縮圖功能
+except ImportError:
+    Image = None
+
+# synchronous 設定：off 最快但斷電可能遺失；normal 在 WAL 下只有斷電才可能遺失最後幾筆；full 每次 commit 都 fsync
+DURABILITY_LEVELS = {'off': 'OFF', 'normal': 'NORMAL', 'full': 'FULL'}
+MIGRATE_BATCH = 100 # 搬移舊圖片時一次讀幾列 (每列可能是好幾 MB 的 base64)
+
+DEFAULT_ROOM = 'lobby' # 沒有指定房間的訊息 (包含舊客戶端與舊資料) 都屬於大廳
+THUMB_SIZE = (300, 300) # 與客戶端聊天室中顯示的大小相同
+HASH_RE = re.compile(r'[0-9a-f]{64}')
+SEARCH_WINDOW = 1000 # 搜尋時只在最近這麼多則符合的訊息中排序 (見 MessageStore.search)
+CJK_RUN = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+BM25_K1, BM25_B = 1.2, 0.75
+ID_TICK = 1024 # 多行程時 id 以毫秒時間為基準，每個 worker 每毫秒可配發這麼多個 id 而不超前時間
+
+
+# --- 圖片寬高 (只讀檔頭，不需要 Pillow) ---
+def image_dimensions(raw):
+    "支援 PNG / GIF / JPEG，無法辨識時回傳 (0, 0)"
+    if raw[:8] == b'\x89PNG\r\n\x1a\n' and len(raw) >= 24:
+        return struct.unpack('>II', raw[16:24])
+    if raw[:6] in (b'GIF87a', b'GIF89a') and len(raw) >= 10:
+        return struct.unpack('<HH', raw[6:10])
+    if raw[:2] == b'\xff\xd8':
+        i = 2
+        while i + 9 < len(raw):
+            if raw[i] != 0xFF:
+                i += 1
+                continue
+            marker = raw[i + 1]
+            if marker == 0xFF or marker == 0x01 or 0xD0 <= marker <= 0xD9:
+                i += 2 if marker != 0xFF else 1
+                continue
+            # SOFn 區段裡有高度與寬度 (C4/C8/CC 不是 SOF)
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                h, w = struct.unpack('>HH', raw[i + 5:i + 9])
+                return w, h
+            i += 2 + struct.unpack('>H', raw[i + 2:i + 4])[0]
+    return 0, 0
+
+
+def image_ref(digest, raw):
+    "訊息列裡代替 image_data 的欄位：雜湊、大小與寬高"
+    width, height = image_dimensions(raw)
+    return {'image_hash': digest, 'image_size': len(raw), 'width': width, 'height': height}
+
+
+# --- 縮圖 (在子行程中執行，不佔用伺服器的 GIL) ---
+def make_thumbnail(raw, max_size=THUMB_SIZE):
+    "回傳 JPEG (有透明度時 PNG) 縮圖，無法處理時回傳 None"
+    if Image is None: return None
+    try:
+        img = Image.open(io.BytesIO(raw))
+        img.draft('RGB', max_size) # JPEG 直接以較低解析度解碼，快很多
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img.save(out, format='PNG', optimize=True)
+        else:
+            img.convert('RGB').save(out, format='JPEG', quality=80)
+        return out.getvalue()
+    except Exception:
+        return None
+
+
+# --- 全文搜尋 (FTS5) ---
+# unicode61 斷詞器把一整串中文當成一個詞，所以寫入前先把中日韓文字拆成兩字一組 (bigram)：
+# 「晚餐吃什麼」-> 晚餐 餐吃 吃什 什麼 麼 (最後一個字單獨再放一次，單字查詢才找得到)
+def split_run(run, tail=True):
+    "一串中日韓文字 -> bigram；tail: 最後一個字單獨再放一次"
+    if len(run) == 1: return f' {run} '
+    grams = [run[i:i + 2] for i in range(len(run) - 1)]
+    return ' ' + ' '.join(grams + [run[-1]] if tail else grams) + ' '
+
+
+def search_text(text):
+    "寫入索引前的斷詞"
+    return CJK_RUN.sub(lambda m: split_run(m.group()), text or '')
+
+
+def query_phrase(term):
+    """使用者輸入的一個詞 -> FTS5 片語 (前後相鄰)。詞尾的中文只用 bigram (可能只是一段話的開頭)，
+    後面還有英數字的中文與索引一樣多放最後一個字；詞尾是單獨一個字時改用前綴查詢"""
+    term = re.sub(r'\W+$', '', term)
+    text = CJK_RUN.sub(lambda m: split_run(m.group(), tail=m.end() < len(term)), term).strip()
+    if not re.search(r'\w', text): return None # 只有標點，斷詞後什麼都不剩
+    last = text.split()[-1]
+    prefix = len(last) == 1 and CJK_RUN.fullmatch(last)
+    return '"' + text.replace('"', '""') + '"' + ('*' if prefix else '')
+
+
+def room_token(room):
+    "房間名稱可能含空白或標點，在索引裡以一個雜湊詞代表"
+    return 'r' + hashlib.blake2b(room.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def match_expression(room, terms, sender=None):
+    "所有詞都要出現 (AND)；使用者的詞只比對暱稱與內文，不會比對到房間欄位"
+    phrases = ['{nickname message} : ' + phrase for phrase in map(query_phrase, terms) if phrase]
+    if sender:
+        phrase = query_phrase(sender)
+        if phrase is None: return None
+        phrases.append('nickname : ' + phrase)
+    if not phrases: return None
+    return f"room : {room_token(room)} AND " + ' AND '.join(phrases)
+
+
+def rank_hits(rows, terms):
+    """[(id, 暱稱與內文, json_content)] -> [(id, json_content)]，相關度高的在前，同分時新的在前。
+    簡化的 BM25：每則都含有所有的詞，IDF 對排序沒有影響，只算詞頻與長度"""
+    terms = [term.lower() for term in terms]
+    hits = []
+    for msg_id, text, json_str in rows:
+        text = (text or '').lower()
+        hits.append(([text.count(term) for term in terms], len(text), msg_id, json_str))
+    average = sum(hit[1] for hit in hits) / len(hits) if hits else 1
+    def score(hit):
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * hit[1] / average)
+        return sum(tf * (BM25_K1 + 1) / (tf + norm) for tf in hit[0])
+    hits.sort(key=lambda hit: (-score(hit), -hit[2]))
+    return [(msg_id, json_str) for _, _, msg_id, json_str in hits]
+
+
+class BlobStore:
+    """以內容雜湊 (sha256) 為檔名的圖片倉庫，同一張圖只存一份。
+    路徑: <root>/<前兩碼>/<雜湊>，縮圖: <root>/thumbs/<前兩碼>/<原圖雜湊>"""
+
+    def __init__(self, root):
+        self.root = root
+        self.pending = {} # 已收到、writer 還沒寫入磁碟的圖片
+        self.lock = threading.Lock()
+
+    def path(self, digest, kind=''):
+        if not HASH_RE.fullmatch(digest): # 雜湊來自客戶端，不能讓它指到其他檔案
+            raise ValueError(f"invalid hash: {digest!r}")
+        return os.path.join(self.root, kind, digest[:2], digest)
+
+    def add(self, raw):
+        "計算雜湊並登記為待寫入，回傳雜湊值"
+        digest = hashlib.sha256(raw).hexdigest()
+        with self.lock:
+            self.pending[digest] = raw
+        return digest
+
+    def write(self, digest):
+        "由 writer 執行緒呼叫：寫入磁碟 (已存在就跳過，達成去重)"
+        with self.lock:
+            raw = self.pending.get(digest)
+        if raw is None: return
+        path = self.path(digest)
+        if not os.path.exists(path):
+            self.write_file(path, raw)
+        with self.lock:
+            self.pending.pop(digest, None)
+
+    def write_file(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path) # 寫完才換名，讀取端不會看到半張圖
+
+    def exists(self, digest):
+        "只檢查有沒有這張圖，不讀取內容"
+        with self.lock:
+            if digest in self.pending: return True
+        try:
+            return os.path.exists(self.path(digest))
+        except ValueError:
+            return False
+
+    def get(self, digest):
+        with self.lock:
+            raw = self.pending.get(digest)
+        if raw is not None: return raw
+        return self.read(digest)
+
+    def read(self, digest, kind=''):
+        try:
+            with open(self.path(digest, kind), 'rb') as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def put_thumb(self, digest, data):
+        self.write_file(self.path(digest, 'thumbs'), data)
+
+    def get_thumb(self, digest):
+        return self.read(digest, 'thumbs')
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class MessageStore:
+    """聊天紀錄資料庫。
+    寫入：放進佇列後立即返回，由專屬的 writer 執行緒用同一條連線批次 commit (group commit)。
+    讀取：另一條連線，WAL 模式下不會被寫入擋住。
+    訊息 id 在放進佇列前就由 allocate_id() 配發 (廣播時已經知道 id，客戶端可以拿來當翻頁游標)；
+    多個行程共用資料庫時，各自取 id_stride 的不同餘數 id_offset，不會重複；
+    這時 id 改以毫秒時間為基準 (見 allocate_id)，不同 worker 配發的 id 才會大致依時間排序，
+    翻頁 (id < before)、登入時回放的歷史環與斷線重連 (id > last_id) 才不會漏掉或排錯另一個 worker 的訊息"""
+
+    def __init__(self, path, blob_dir, durability='normal', batch_size=256, batch_delay=0.005,
+                 id_stride=1, id_offset=0, on_commit=None):
+        self.path = path
+        self.blobs = BlobStore(blob_dir)
+        self.durability = durability
+        self.batch_size = batch_size    # 一次 commit 最多幾筆
+        self.batch_delay = batch_delay  # 第一筆進來後最多等幾秒湊批次
+        self.on_commit = on_commit      # on_commit(筆數, 秒數, 是否成功)，每批 commit 後在 writer 執行緒呼叫
+        self.queue = queue.Queue()
+        self.id_stride = id_stride
+        self.id_offset = id_offset
+        self.ids = None
+        self.last_id = 0
+        self.id_lock = threading.Lock()
+        self.fts = False # SQLite 有 FTS5 時才提供搜尋
+        self.read_lock = threading.Lock()
+        self.reader = None
+        self.writer = None
+
+    # --- 開啟資料庫 ---
+    def open(self, rebuild_search=False):
+        conn = self.connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                json_content TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                room TEXT NOT NULL DEFAULT 'lobby'
+            )
+        ''')
+        self.migrate_rooms(conn)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_room ON messages (room, id)')
+        conn.commit()
+        self.migrate_images(conn)
+        self.fts = self.create_search_index(conn, rebuild_search)
+        start = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM messages").fetchone()[0]
+        start += (self.id_offset - start) % self.id_stride
+        self.ids = itertools.count(start, self.id_stride)
+        self.last_id = start - self.id_stride
+        self.reader = self.connect()
+        self.writer = threading.Thread(target=self.write_loop, args=(conn,), daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={DURABILITY_LEVELS[self.durability]}')
+        return conn
+
+    def migrate_rooms(self, conn):
+        "舊資料庫沒有 room 欄位，原本的訊息都歸到大廳"
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(messages)')]
+        if 'room' not in columns:
+            conn.execute(f"ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT '{DEFAULT_ROOM}'")
+
+    def migrate_images(self, conn):
+        """舊資料庫把整張 base64 圖片存在 json_content 裡，搬到 BlobStore 只留雜湊。
+        以 id 為游標每次讀 MIGRATE_BATCH 列、每批 commit，資料庫再大也只佔一批的記憶體"""
+        query = """SELECT id, json_content FROM messages
+                   WHERE id > ? AND json_content LIKE '{"type": 9,%"image_data"%' ORDER BY id LIMIT ?"""
+        last_id, moved = 0, 0
+        while True:
+            rows = conn.execute(query, (last_id, MIGRATE_BATCH)).fetchall()
+            if not rows: break
+            for row_id, json_str in rows:
+                msg = json.loads(json_str)
+                digest = self.blobs.add(base64.b64decode(msg.pop('image_data')))
+                self.blobs.write(digest)
+                msg.update(image_ref(digest, self.blobs.get(digest)))
+                conn.execute("UPDATE messages SET json_content = ? WHERE id = ?", (json.dumps(msg), row_id))
+            conn.commit()
+            last_id = rows[-1][0]
+            moved += len(rows)
+        if moved: print(f"已將 {moved} 張圖片移出 messages 資料表")
+
+    def create_search_index(self, conn, rebuild=False):
+        """全文搜尋索引 (contentless：只存索引，內容仍在 messages，rowid 即訊息 id)。
+        第一次建立或指定 rebuild 時從既有訊息重建；SQLite 沒有 FTS5 時回傳 False"""
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        try:
+            conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                            room, nickname, message, content='', prefix='1',
+                            tokenize='unicode61 remove_diacritics 2')""")
+        except sqlite3.OperationalError as e:
+            print(f"SQLite 不支援 FTS5，停用搜尋功能: {e}")
+            return False
+        if rebuild or not exists: self.rebuild_search_index(conn)
+        return True
+
+    def rebuild_search_index(self, conn):
+        "斷詞在 Python 裡做，其餘交給 SQLite 一次 INSERT ... SELECT"
+        started = time.monotonic()
+        conn.create_function('search_text', 1, search_text, deterministic=True)
+        conn.create_function('room_token', 1, room_token, deterministic=True)
+        with conn:
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')")
+            count = conn.execute("""INSERT INTO messages_fts (rowid, room, nickname, message)
+                                    SELECT id, room_token(room), search_text(json_extract(json_content, '$.nickname')),
+                                           search_text(json_extract(json_content, '$.message'))
+                                    FROM messages WHERE json_extract(json_content, '$.message') IS NOT NULL""").rowcount
+        if count: print(f"已重建 {count} 則訊息的搜尋索引 ({time.monotonic() - started:.1f} 秒)")
+
+    # --- 寫入 (不會等待 commit) ---
+    def allocate_id(self):
+        """單一行程時依序配發。多行程時取「目前毫秒 * ID_TICK」對齊到自己的餘數，
+        且不小於上一個 id：各 worker 的計數器各走各的，只靠餘數錯開的話，
+        訊息少的 worker 會一直配出比別人舊的 id"""
+        if self.id_stride == 1: return next(self.ids)
+        with self.id_lock:
+            stamp = time.time_ns() // 1_000_000 * ID_TICK * self.id_stride + self.id_offset
+            self.last_id = max(self.last_id + self.id_stride, stamp)
+            return self.last_id
+
+    def append(self, json_str, blob=None, room=DEFAULT_ROOM, msg_id=None, search=None):
+        """blob: 這則訊息引用的圖片雜湊，會在同一批次裡先寫入磁碟。
+        msg_id: allocate_id() 配發的 id (None 時由 SQLite 決定)。
+        search: (暱稱, 內文)，在同一個 transaction 裡加進搜尋索引"""
+        self.queue.put(('insert', (json_str, blob, room, msg_id, search)))
+
+    def flush(self):
+        "等到目前佇列中的訊息都 commit 完成"
+        self.wait_for('flush')
+
+    def clear(self):
+        "送完佇列後刪除所有訊息"
+        self.wait_for('clear')
+
+    def wait_for(self, command):
+        done = threading.Event()
+        self.queue.put((command, done))
+        done.wait()
+
+    # --- writer 執行緒 ---
+    def write_loop(self, conn):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0: break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.write_batch(conn, batch)
+
+    def write_batch(self, conn, batch):
+        waiting = [arg for command, arg in batch if command != 'insert'] # flush / clear 的 Event
+        written = len(batch) - len(waiting)
+        ok = True
+        start = time.perf_counter()
+        try:
+            with conn: # 整批在同一個 transaction 裡，只 commit 一次
+                for command, arg in batch:
+                    self.write_command(conn, command, arg)
+        except Exception as e:
+            # 整批已 rollback；改成一筆一個 transaction 重寫，壞掉的那一筆不會連累同批的其他訊息
+            print(f"儲存失敗: {e}，改為逐筆寫入")
+            for command, arg in batch:
+                try:
+                    with conn:
+                        self.write_command(conn, command, arg)
+                except Exception as e:
+                    ok = False
+                    if command == 'insert':
+                        written -= 1
+                        print(f"儲存失敗，丟棄訊息 id {arg[3]}: {e}")
+                    else:
+                        print(f"{command} 失敗: {e}")
+        if self.on_commit: self.on_commit(written, time.perf_counter() - start, ok)
+        for done in waiting:
+            done.set()
+
+    def write_command(self, conn, command, arg):
+        if command == 'insert':
+            json_str, blob, room, msg_id, search = arg
+            if blob: self.blobs.write(blob)
+            cursor = conn.execute("INSERT INTO messages (id, json_content, room) VALUES (?, ?, ?)",
+                                  (msg_id, json_str, room))
+            if search and self.fts:
+                conn.execute("INSERT INTO messages_fts (rowid, room, nickname, message) VALUES (?, ?, ?, ?)",
+                             (cursor.lastrowid, room_token(room), search_text(search[0]), search_text(search[1])))
+        elif command == 'clear':
+            conn.execute("DELETE FROM messages")
+            if self.fts: conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')")
+            self.blobs.clear()
+
+    # --- 讀取歷史訊息 ---
+    def recent(self, limit=10, room=DEFAULT_ROOM):
+        "[(id, json_content)]，舊到新"
+        query = "SELECT id, json_content FROM (SELECT json_content, id FROM messages WHERE room = ? ORDER BY id DESC LIMIT ?) ORDER BY id ASC"
+        with self.read_lock:
+            return self.reader.execute(query, (room, limit)).fetchall()
+
+    def page(self, room, before=None, limit=50):
+        """id 小於 before 的最近 limit 則 (before 為 None 時從最新的開始)，新到舊。
+        走 idx_messages_room (room, id)，翻到多深都只讀這一頁"""
+        query = "SELECT id, json_content FROM messages WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?"
+        with self.read_lock:
+            return self.reader.execute(query, (room, before if before is not None else 1 << 62, limit)).fetchall()
+
+    def after(self, room, after_id, limit):
+        """id 大於 after_id 的前 limit 則，舊到新 (斷線重連時補上漏掉的訊息)。
+        同樣走 idx_messages_room，只讀缺口這一段"""
+        query = "SELECT id, json_content FROM messages WHERE room = ? AND id > ? ORDER BY id ASC LIMIT ?"
+        with self.read_lock:
+            return self.reader.execute(query, (room, after_id, limit)).fetchall()
+
+    def search(self, room, query, sender=None, window=SEARCH_WINDOW):
+        """房間裡符合 query (空白分隔，全部都要出現) 的訊息 [(id, json_content)]，相關度高的在前。
+        FTS5 的 bm25() 每次都要數過全部符合的訊息 (算 IDF)，常見字在百萬筆時要上百毫秒；
+        這裡只依 rowid 由新到舊取前 window 則 (取夠就停)，再以 rank_hits 排序"""
+        terms = query.split()
+        expr = match_expression(room, terms, sender)
+        if not self.fts or expr is None: return []
+        query = """SELECT messages.id, json_extract(json_content, '$.nickname') || ' ' || json_extract(json_content, '$.message'),
+                          json_content
+                   FROM messages_fts JOIN messages ON messages.id = messages_fts.rowid
+                   WHERE messages_fts MATCH ? ORDER BY messages_fts.rowid DESC LIMIT ?"""
+        with self.read_lock:
+            rows = self.reader.execute(query, (expr, window)).fetchall()
+        return rank_hits(rows, terms)
+
+    def recent_federated(self, limit):
+        "所有房間中最近帶有 uid 的訊息 (聯邦模式)，啟動時用來重建補送紀錄"
+        query = """SELECT json_content FROM (SELECT json_content, id FROM messages
+                   WHERE json_content LIKE '%"uid": %' ORDER BY id DESC LIMIT ?) ORDER BY id ASC"""
+        with self.read_lock:
+            rows = self.reader.execute(query, (limit,)).fetchall()
+        return [row[0] for row in rows]
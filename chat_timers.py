@@ -0,0 +1,56 @@
+import math
+import threading
+import time
+
+# 大量連線共用的計時器 (newserver.py 的 heartbeat 與斷線後延後離開)。
+# 每條連線各開一個計時器 (threading.Timer / loop.call_later) 在上萬條連線時太貴，
+# 這裡用雜湊時間輪：加入與到期都是 O(1)，整個行程只有一條執行緒每 tick 前進一格。
+
+
+class TimerWheel:
+    """slots 個格子排成一圈，每 tick 秒前進一格，到期時在 run() 的執行緒上呼叫加入時給的 callback。
+    超過一圈的延遲記在 rounds，經過時減一，歸零的那一圈才到期。
+    沒有取消：到期時由 callback 自己判斷是否還需要 (例如連線已關閉就不再加入)"""
+
+    def __init__(self, tick=1.0, slots=64):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)] # 每格是 [(callback, 參數), 剩幾圈] 的串列
+        self.current = 0
+        self.lock = threading.Lock()
+
+    def add(self, delay, callback, *args):
+        "delay 秒後呼叫 callback(*args) (以 tick 為單位無條件進位，至少一格)"
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self.lock:
+            index = (self.current + ticks) % len(self.slots)
+            self.slots[index].append([(callback, args), (ticks - 1) // len(self.slots)])
+
+    def advance(self):
+        "前進一格，回傳這一格到期的項目"
+        with self.lock:
+            self.current = (self.current + 1) % len(self.slots)
+            due, pending = [], []
+            for entry in self.slots[self.current]:
+                if entry[1] == 0:
+                    due.append(entry[0])
+                else:
+                    entry[1] -= 1
+                    pending.append(entry)
+            self.slots[self.current] = pending
+        return due
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(slot) for slot in self.slots)
+
+    def run(self):
+        "在目前的執行緒上一直前進 (以 monotonic 對時，不會因為 callback 花的時間而漂移)"
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.tick
+            time.sleep(max(0, next_tick - time.monotonic()))
+            for callback, args in self.advance():
+                try:
+                    callback(*args)
+                except Exception as e:
+                    print(f"計時器錯誤: {e}")
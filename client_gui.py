@@ -3,16 +3,162 @@
 
 
 import tkinter as tk
-from tkinter import scrolledtext, messagebox, filedialog
+from tkinter import scrolledtext, messagebox, filedialog, ttk
 import socket
 import threading
-import json
 import base64
+import hashlib
+import uuid
 import os
+from collections import deque, OrderedDict
 from datetime import datetime
 from plyer import notification
 from PIL import Image, ImageTk 
 import io # 處理 Byte 資料
+import itertools
+import queue
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import chat_codec
+
+# --- 分段圖片傳輸 ---
+CLIENT_FEATURES = ['chunked_images', 'thumbnails', 'presence_delta', 'zlib', 'binary', 'history_pages', 'search', 'heartbeat', 'resume'] # 登入時告訴伺服器本客戶端支援的功能
+CHUNK_SIZE = 64 * 1024 # 每段原始位元組數
+
+DEFAULT_ROOM = 'lobby' # 登入後所在的房間
+ROOM_NAME_MAX = 32 # 與伺服器相同，較長的名稱伺服器會截斷
+
+# --- 畫面更新 ---
+RENDER_INTERVAL = 30 # 毫秒，檢查事件佇列的間隔
+RENDER_BATCH = 200 # 每批最多處理幾個事件，處理完先讓 Tk 喘口氣
+MAX_SCROLLBACK_LINES = 2000 # 聊天室保留的行數
+HISTORY_PAGE_SIZE = 50 # 捲到最上面時一次向伺服器要幾則較舊的訊息 (type 19)
+SEARCH_PAGE_SIZE = 20 # 搜尋結果一次取幾則 (type 21)
+HEARTBEAT_CHECK = 1000 # 毫秒，檢查是否該送 ping (type 23) 或伺服器已沒有回應的間隔
+RECONNECT_DELAY = 0.5 # 秒，斷線後第一次重新連線前等多久，之後每次失敗加倍
+RECONNECT_MAX_DELAY = 30
+LOGOUT_TIMEOUT = 0.5 # 秒，關閉視窗時最多等多久把 type 25 送出
+
+# --- 圖片快取 ---
+IMAGE_CACHE_BYTES = 64 * 1024 * 1024 # 記憶體中保留的原圖總量
+IMAGE_DISK_CACHE = os.path.join(tempfile.gettempdir(), 'chatroom_image_cache') # None = 不寫磁碟
+IMAGE_DISK_CACHE_BYTES = 512 * 1024 * 1024
+DECODE_WORKERS = 2 # 負責解碼、縮放圖片的背景執行緒數
+THUMB_MAX_SIZE = (300, 300)
+
+
+class ImageCache:
+    """原圖快取 (雜湊 -> bytes)：記憶體裡依 LRU 保留到 budget 為止，
+    被擠出去的寫到磁碟快取，之後點開還能從磁碟讀回來。
+    get / put 可能讀寫磁碟，只在背景執行緒 (decoder) 上呼叫"""
+
+    def __init__(self, budget, disk_dir=None, disk_budget=0):
+        self.items = OrderedDict()
+        self.size = 0
+        self.budget = budget
+        self.disk_dir = disk_dir
+        self.disk_budget = disk_budget
+        self.disk_items = OrderedDict() # 磁碟上的檔案，舊的在前
+        self.disk_size = 0
+        self.lock = threading.Lock()
+        if disk_dir:
+            try:
+                os.makedirs(disk_dir, exist_ok=True)
+                for entry in sorted(os.scandir(disk_dir), key=lambda e: e.stat().st_mtime):
+                    self.disk_items[entry.name] = entry.stat().st_size
+                    self.disk_size += entry.stat().st_size
+            except OSError:
+                self.disk_dir = None
+            with self.lock: # 上次執行留下的檔案也受 disk_budget 限制
+                self.trim_disk()
+
+    def put(self, digest, raw):
+        spill = []
+        with self.lock:
+            if digest in self.items:
+                self.items.move_to_end(digest)
+                return
+            self.items[digest] = raw
+            self.size += len(raw)
+            while self.size > self.budget and len(self.items) > 1:
+                old, data = self.items.popitem(last=False)
+                self.size -= len(data)
+                spill.append((old, data))
+        for old, data in spill:
+            self.spill(old, data)
+
+    def get(self, digest):
+        with self.lock:
+            raw = self.items.get(digest)
+            if raw is not None:
+                self.items.move_to_end(digest)
+                return raw
+        if not self.disk_dir or digest not in self.disk_items: return None
+        try:
+            with open(os.path.join(self.disk_dir, digest), 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return None
+        self.put(digest, raw)
+        return raw
+
+    def spill(self, digest, raw):
+        if not self.disk_dir or digest in self.disk_items: return
+        try:
+            with open(os.path.join(self.disk_dir, digest), 'wb') as f:
+                f.write(raw)
+        except OSError:
+            return
+        with self.lock:
+            self.disk_items[digest] = len(raw)
+            self.disk_size += len(raw)
+            self.trim_disk()
+
+    def trim_disk(self):
+        "刪掉最舊的檔案直到不超過 disk_budget (呼叫端持有 lock)"
+        while self.disk_size > self.disk_budget and self.disk_items:
+            old, size = self.disk_items.popitem(last=False)
+            self.disk_size -= size
+            try: os.remove(os.path.join(self.disk_dir, old))
+            except OSError: pass
+
+
+# --- 在背景執行緒執行的圖片處理 ---
+def prepare_thumbnail(data, is_full, cache):
+    "解碼並縮成聊天室顯示用的大小；is_full 時順便把原圖放進快取"
+    raw = base64.b64decode(data) if isinstance(data, str) else data
+    digest = hashlib.sha256(raw).hexdigest()
+    if is_full: cache.put(digest, raw)
+    img = Image.open(io.BytesIO(raw))
+    img.draft('RGB', THUMB_MAX_SIZE) # JPEG 直接用較低解析度解碼
+    img.thumbnail(THUMB_MAX_SIZE, Image.Resampling.LANCZOS)
+    return digest, img
+
+def load_full_image(cache, digest, screen_size):
+    "從快取取出原圖 (冷的時候要讀磁碟) 並縮放；快取沒有時回傳 None"
+    raw = cache.get(digest)
+    return None if raw is None else prepare_full_image(raw, screen_size)
+
+def store_full_image(cache, digest, raw, screen_size):
+    "伺服器送來的原圖：核對雜湊後放進快取 (可能擠出舊圖寫到磁碟) 並縮放；雜湊不符時回傳 None"
+    if hashlib.sha256(raw).hexdigest() != digest: return None
+    cache.put(digest, raw)
+    return prepare_full_image(raw, screen_size)
+
+def prepare_full_image(raw, screen_size):
+    img = Image.open(io.BytesIO(raw))
+    img.load()
+    # 處理過大圖片 (如果原圖比螢幕還大，稍微縮一下，不然視窗會爆開)
+    screen_width, screen_height = screen_size
+    # 如果圖片寬或高超過螢幕的 80%，就縮放
+    if img.width > screen_width * 0.8 or img.height > screen_height * 0.8:
+        ratio = min(screen_width * 0.8 / img.width, screen_height * 0.8 / img.height)
+        new_size = (int(img.width * ratio), int(img.height * ratio))
+        img = img.resize(new_size, Image.Resampling.LANCZOS)
+    return img
 
 # --- 主題設定 ---
 LIGHT_THEME = {'bg': '#f0f0f0', 
@@ -44,14 +190,59 @@ class ChatClient:
         self.sock = None
         self.is_connected = False
         self.target_private_user = None
-        self.image_references = [] # 用來存圖片參照
-        self.image_data_store = {} # 用來存 Base64 原圖資料
+        self.room = DEFAULT_ROOM # 目前所在 (發言、顯示) 的房間
+        self.users = [] # 與 user_listbox 同順序的名單
+        self.presence_seq = None # 最後套用的名單版本，None 代表等待完整名單
+        self.image_ids = itertools.count() # 圖片在聊天室中的位置標記編號
+        self.image_cache = ImageCache(IMAGE_CACHE_BYTES, IMAGE_DISK_CACHE, IMAGE_DISK_CACHE_BYTES) # 原圖 (雜湊 -> bytes)
+        self.decoder = ThreadPoolExecutor(max_workers=DECODE_WORKERS) # Base64 解碼與縮放
+        self.screen_size = (root.winfo_screenwidth(), root.winfo_screenheight())
+        self.server_features = set()
+        self.codec = chat_codec.JSON # 送出用的編碼
+        self.uploads = {}   # 上傳中的圖片 (斷線重連後可從伺服器確認的分段接續)
+        self.downloads = {} # 接收中的分段圖片
+        # 送出佇列：文字優先，圖片分段排在後面，大圖不會卡住聊天
+        self.text_queue = deque()
+        self.bulk_queue = deque() # (上傳 id, data)
+        self.send_lock = threading.Lock()
+        self.send_ready = threading.Event()
+        self.logging_out = False
+        self.logout_sent = threading.Event()
+        self.events = queue.SimpleQueue() # (函式, 參數)，只在 Tk 執行緒上執行
+        self.rendering = False
+        self.history_more = True     # 伺服器上是否還有更舊的訊息
+        self.loading_history = False # 已送出 type 19，等待回覆
+        self.search_query = None  # 最近一次搜尋，較晚到的舊結果不顯示
+        self.search_offset = 0
+        self.search_window = None
+        self.ping_interval = None # 登入時伺服器告知 (伺服器支援 heartbeat 時)
+        self.ping_timeout = None
+        self.last_received = 0    # 最後一次收到封包的時間 (time.monotonic)
+        self.ping_sent = 0        # 送出尚未得到回應的 ping 的時間
+        self.heartbeat_job = None
+        # 斷線重連：重新登入時帶上 resume_token 與目前房間最後看到的訊息 id，伺服器只補漏掉的部分
+        self.server_addr = None
+        self.logged_in = False    # 收到過 type 2，之後的 type 2 都是重新連線
+        self.resume_token = None
+        self.last_id = None
+        self.reconnect_delay = RECONNECT_DELAY
         self.is_dark_mode = True 
         self.current_theme = DARK_THEME
 
         # --- UI 建置 (簡化顯示) ---
         self.top_bar = tk.Frame(root); self.top_bar.pack(side=tk.TOP, fill=tk.X, padx=5, pady=5)
         tk.Button(self.top_bar, text="切換主題", command=self.toggle_theme).pack(side=tk.LEFT)
+        # --- 房間切換 (可以選擇現有房間，或輸入新名稱建立) ---
+        self.lbl_room = tk.Label(self.top_bar, text="房間:"); self.lbl_room.pack(side=tk.LEFT, padx=(15, 2))
+        self.room_box = ttk.Combobox(self.top_bar, values=[DEFAULT_ROOM], width=16); self.room_box.pack(side=tk.LEFT)
+        self.room_box.set(DEFAULT_ROOM)
+        self.room_box.bind("<<ComboboxSelected>>", self.switch_room)
+        self.room_box.bind("<Return>", self.switch_room)
+        tk.Button(self.top_bar, text="切換房間", command=self.switch_room).pack(side=tk.LEFT, padx=2)
+        # --- 搜尋目前房間的訊息 (結果顯示在另一個視窗) ---
+        self.search_box = tk.Entry(self.top_bar, width=20); self.search_box.pack(side=tk.LEFT, padx=(15, 2))
+        self.search_box.bind("<Return>", lambda e: self.search())
+        tk.Button(self.top_bar, text="搜尋", command=self.search).pack(side=tk.LEFT)
         tk.Button(self.top_bar, text="斷線離開", command=self.safe_exit, bg='#ff6666', fg='white').pack(side=tk.RIGHT)
 
         self.login_frame = tk.Frame(root); self.login_frame.pack(pady=50)
@@ -60,6 +251,11 @@ class ChatClient:
         self.main_frame = tk.Frame(root)
         self.chat_area = scrolledtext.ScrolledText(self.main_frame, state='disabled', width=65)
         self.chat_area.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
+        self.chat_area.config(yscrollcommand=self.on_chat_scroll) # 捲到最上面時載入更舊的訊息
+        # 定義標籤樣式 (顏色由 apply_theme 設定)
+        self.chat_area.tag_config("meta", font=("Arial", 9))
+        self.chat_area.tag_config("content", font=("Arial", 11))
+        self.chat_area.tag_config("highlight", font=("Arial", 11, "bold"))
         
         self.right_frame = tk.Frame(self.main_frame); self.right_frame.grid(row=0, column=1, sticky="ns", padx=10)
         self.user_listbox = tk.Listbox(self.right_frame, height=25); self.user_listbox.pack(pady=5, fill=tk.Y)
@@ -75,6 +271,7 @@ class ChatClient:
         self.main_frame.grid_columnconfigure(0, weight=1); self.main_frame.grid_rowconfigure(0, weight=1)
         self.apply_theme()
         self.root.protocol("WM_DELETE_WINDOW", self.safe_exit)
+        self.root.after(RENDER_INTERVAL, self.pump_events)
 
     # --- 登入介面 ---
     def create_login_ui(self):
@@ -90,114 +287,369 @@ class ChatClient:
         self.entry_ip, self.entry_port, self.entry_nickname = self.entries[0], self.entries[1], self.entries[2]
         tk.Button(self.login_frame, text="連線進入", command=self.connect_server, font=("Arial", 12), bg="#4da6ff", fg="white").grid(row=3, column=0, columnspan=2, pady=20, sticky="ew")
     
-    def recv_message(self):
-        f = self.sock.makefile(encoding='utf-8')
-        while self.is_connected:
-            try:
-                text = f.readline()
-                if not text:
+    # --- 接收執行緒：只負責讀取與解析，畫面更新交給 Tk 執行緒 ---
+    def recv_message(self, sock):
+        try:
+            # 伺服器送來的 json、binary 與壓縮區塊都由 chat_codec 解開
+            for msg in chat_codec.read_packets(sock.makefile('rb')):
+                if not self.is_connected or self.sock is not sock: break
+                self.last_received = time.monotonic()
+                if msg.get('type') == 23: # 伺服器的 ping 直接回覆，不經過畫面更新的佇列
+                    self.send_packet({'type': 24})
+                    continue
+                if msg.get('type') == 24: continue # pong：last_received 已更新
+                self.post(self.handle_packet, msg)
+                self.notify_packet(msg)
+        except Exception as e:
+            print(f"[Error] 接收訊息錯誤: {e}")
+        self.post(self.connection_dropped, sock)
+            
+    def notify_packet(self, msg):
+        "桌面通知可能會卡一下，留在接收執行緒發送"
+        msg_type = msg.get('type')
+        sender = msg.get('sender', msg.get('nickname', 'Unknown'))
+        if msg.get('room', self.room) != self.room: return
+        if msg.get('is_history') or msg.get('fetch') or sender == self.nickname or sender == '系統': return # fetch: 點開縮圖索取的原圖
+        if msg_type == 3:
+            self.show_notification(f"來自 {sender}", msg['message'])
+        elif msg_type == 5 and 'action' not in msg:
+            self.show_notification(f"{sender} 說", msg['message'])
+        elif msg_type == 7:
+            self.show_notification(f"私訊: {sender}", msg.get('message', ''))
+        elif msg_type in (9, 10):
+            self.show_notification(f": {sender}", '傳送了一張圖片')
+
+    # --- 事件佇列 (任何執行緒都可以放，Tk 執行緒定時取出) ---
+    def post(self, func, *args):
+        self.events.put((func, args))
+
+    def pump_events(self):
+        """一次處理一批事件：整批只切換一次 state、只捲動一次，
+        大量歷史訊息湧入時畫面不會卡住"""
+        count = 0
+        follow = self.chat_area.yview()[1] >= 0.999 # 正在往上翻閱時不要跳回最下面
+        try:
+            self.rendering = True
+            self.chat_area.config(state='normal')
+            while count < RENDER_BATCH:
+                try:
+                    func, args = self.events.get_nowait()
+                except queue.Empty:
                     break
-                msg = json.loads(text)
-    
-                msg_type = msg.get('type')
-                nickname = msg.get('nickname', 'Unknown')
-                sender = msg.get('sender', nickname)
-                msg_time = msg.get('time', datetime.now().strftime('%Y/%m/%d %H:%M'))
-                is_history = msg.get('is_history', False)
-                
-                notify_content = None # 初始化為 None
+                count += 1
+                try:
+                    func(*args)
+                except Exception as e:
+                    print(f"[Error] 畫面更新錯誤: {e}")
+        finally:
+            self.rendering = False
+            self.finish_render(scroll=count > 0 and follow)
+        # 還有剩就馬上再處理下一批，讓 Tk 有機會處理滑鼠、鍵盤事件
+        self.root.after(1 if count == RENDER_BATCH else RENDER_INTERVAL, self.pump_events)
 
-                if msg_type == 2: # 登入成功
-                    self.append_chat("系統", "登入成功！")
-                
-                if msg_type == 4: continue 
-                
-                # --- 一般廣播 (Type 3) ---
-                if msg_type == 3:
-                    content = msg['message']
-                    self.append_chat(sender, content, time_str=msg_time)
-                    notify_content = content # 
-
-                # --- Type 5: 廣播訊息與系統指令 ---
-                if msg['type'] == 5:
-                    action = msg.get('action')
-                    
-                    # 1. 處理踢人
-                    if action == 'kick':
-                        messagebox.showwarning("通知", "你已被管理員踢出聊天室")
-                        self.safe_exit()
-                        return
-                        
-                    # 2. 處理伺服器關閉
-                    elif action == 'shutdown':
-                        self.append_chat("系統", "伺服器已關閉，程式將在 10 秒後結束...", highlight=True)
-                        self.entry_msg.config(state='disabled')
-                        self.root.after(10000, self.safe_exit)
-                        return
-
-                    # 3. 處理人數已滿
-                    elif action == 'full':
-                        messagebox.showwarning("連線失敗", "伺服器人數已滿，請稍後再試。")
-                        self.safe_exit()
-                        return
-
-                    # 4. 一般聊天訊息 (必須要有這段，不然會收不到訊息)
-                    else:
-                        sender = msg['nickname']
-                        content = msg['message']
-                        msg_time = msg.get('time', datetime.now().strftime('%Y/%m/%d %H:%M'))
-                        self.append_chat(sender, content, time_str=msg_time)
-                        if sender != self.nickname and not is_history:
-                            self.show_notification(f"{sender} 說", content)
- 
-                if msg_type == 6: # 更新名單
-                    self.update_user_list(msg['users'])
-
-                # --- 私訊 (Type 7) ---
-                if msg['type'] == 7:
-                    sender = msg.get('sender', '未知使用者') 
-                    content = msg.get('message', '')
-                    msg_time = msg.get('time', datetime.now().strftime('%Y/%m/%d %H:%M'))
-                    
-                    
-                    self.append_chat(sender, f"[來自 {sender} 的私訊] {content}", time_str=msg_time, highlight=True)
-
-                    if not is_history:
-                        self.show_notification(f"私訊: {sender}", content)
-                # --- 圖片 (Type 9) ---
-                if msg_type == 9:
-                    self.append_chat(sender, "傳送了一張圖片", time_str=msg_time)
-                    self.display_image(msg['image_data'])
-                    notify_content = "傳送了一張圖片"
-                    
-                    if not is_history:
-                        self.show_notification(f": {sender}", '傳送了一張圖片')
-
-                # --- 統一通知判斷 ---
-                if notify_content:
-                    if sender != self.nickname and sender != '系統' and not is_history:
-                        self.show_notification(f"來自 {sender}", notify_content)
-
-            except Exception as e:
-                print(f"[Error] 接收訊息錯誤: {e}")
-                self.root.after(0, lambda: messagebox.showerror("斷線", "與伺服器的連線已中斷"))
-                break
-        self.is_connected = False
+    def finish_render(self, scroll=True):
+        if scroll: # 往上翻閱 (載入較舊的頁) 時不刪最上面的內容
+            self.trim_scrollback()
+            self.chat_area.see(tk.END)
+        self.chat_area.config(state='disabled')
+
+    def trim_scrollback(self):
+        "只保留最後 MAX_SCROLLBACK_LINES 行，刪掉的圖片 Label 一併釋放"
+        lines = int(self.chat_area.index('end-1c').split('.')[0])
+        if lines <= MAX_SCROLLBACK_LINES: return
+        self.delete_chat('1.0', f"{lines - MAX_SCROLLBACK_LINES}.0")
+        self.history_more = True # 刪掉的部分之後可以再向伺服器要回來
+
+    def delete_chat(self, start, end):
+        """刪除一段內容；圖片 Label 與標記一併移除 (標記不會隨文字刪除，留著會指到別的位置)。
+        還沒放上去的圖片 (img_) 與下載中的分段圖片 (dl_) 也取消"""
+        dropped = set()
+        for kind, name, _ in self.chat_area.dump(start, end, window=True, mark=True):
+            if kind == 'window' and name: self.chat_area.nametowidget(name).destroy()
+            if kind == 'mark' and name.startswith(('id_', 'img_', 'dl_')):
+                self.chat_area.mark_unset(name)
+                dropped.add(name)
+        if dropped:
+            self.downloads = {k: dl for k, dl in self.downloads.items() if dl['mark'] not in dropped}
+        self.chat_area.delete(start, end)
+
+    # --- 切換房間 ---
+    def switch_room(self, event=None):
+        room = self.room_box.get().strip()[:ROOM_NAME_MAX] # 與伺服器相同的規則，兩邊的房間名稱才會一致
+        self.room_box.set(room)
+        if not room or room == self.room or not self.is_connected: return
+        self.send_packet({'type': 18, 'room': self.room})
+        self.send_packet({'type': 17, 'room': room}) # 伺服器會回放新房間的歷史
+        self.room = room
+        self.clear_chat()
+        self.root.title(f"聊天室 - {self.nickname} #{room}")
+
+    def clear_chat(self):
+        "清空聊天室；還沒放上去的圖片與下載中的圖片由 delete_chat 一併取消"
+        self.chat_area.config(state='normal')
+        self.delete_chat('1.0', tk.END)
+        self.chat_area.config(state='disabled')
+        self.history_more = True
+        self.loading_history = False
+        self.last_id = None # 接著送來的回放重新決定
+
+    # --- 往前翻歷史 (type 19 / 20) ---
+    def on_chat_scroll(self, first, last):
+        self.chat_area.vbar.set(first, last)
+        if float(first) <= 0.0: self.load_older()
+
+    def oldest_id(self):
+        "聊天室最上面那則訊息的 id (每則有 id 的訊息開頭都有 id_<id> 標記)，當作翻頁游標"
+        mark = self.chat_area.mark_next('1.0')
+        while mark:
+            if mark.startswith('id_'): return int(mark[3:])
+            mark = self.chat_area.mark_next(mark)
+        return None
+
+    def load_older(self):
+        "一次只要一頁；內容還不滿一個畫面時會接著要下一頁"
+        if self.loading_history or not self.history_more or not self.is_connected: return
+        if 'history_pages' not in self.server_features: return
+        before = self.oldest_id()
+        if before is None: return
+        self.loading_history = True
+        self.send_packet({'type': 19, 'room': self.room, 'before': before, 'limit': HISTORY_PAGE_SIZE})
+
+    def prepend_history(self, msg):
+        "把較舊的一頁插在最上面，畫面停在原本看的位置"
+        if msg.get('room') != self.room: return # 已切換房間
+        self.loading_history = False
+        self.history_more = msg.get('more', False)
+        if not msg['messages']: return
+        in_batch = self.rendering
+        if not in_batch: self.chat_area.config(state='normal')
+        top = self.chat_area.yview()[0]
+        before = int(self.chat_area.index('end-1c').split('.')[0])
+        # 原本最上面那則的標記靠左，暫時改成靠右，才會跟著原本的內容往後移
+        pinned = [name for kind, name, _ in self.chat_area.dump('1.0', '1.1', mark=True)
+                  if name.startswith(('id_', 'img_', 'dl_'))]
+        for name in pinned: self.chat_area.mark_gravity(name, tk.RIGHT)
+        self.chat_area.mark_set('page', '1.0') # 預設靠右，插入的內容會依序排在它前面
+        for item in msg['messages']:
+            self.chat_area.mark_set(f"id_{item['id']}", 'page')
+            self.chat_area.mark_gravity(f"id_{item['id']}", tk.LEFT)
+            self.chat_area.insert('page', f"{item.get('nickname', 'Unknown')}  {item.get('time', '')}\n", "meta")
+            if item.get('type') == 9:
+                # 舊圖片不預先下載，點擊時才以 type 14 索取原圖
+                link = f"imglink_{item['image_hash']}"
+                self.chat_area.tag_config(link, underline=True)
+                self.chat_area.tag_bind(link, "<Button-1>", lambda e, h=item['image_hash']: self.open_full_image(h))
+                self.chat_area.insert('page', f"[圖片 {item.get('width', 0)}x{item.get('height', 0)}，點擊開啟]\n\n", ("content", link))
+            else:
+                self.chat_area.insert('page', f"{item.get('message', '')}\n\n", "content")
+        self.chat_area.mark_unset('page')
+        for name in pinned: self.chat_area.mark_gravity(name, tk.LEFT)
+        if top <= 0.0: # 停在插入前最上面那一行
+            added = int(self.chat_area.index('end-1c').split('.')[0]) - before
+            self.chat_area.yview(f"{added + 1}.0")
+        if not in_batch: self.chat_area.config(state='disabled')
+
+    # --- 搜尋訊息 (type 21 / 22) ---
+    def search(self):
+        query = self.search_box.get().strip()
+        if not query or not self.is_connected: return
+        if 'search' not in self.server_features: return messagebox.showinfo("搜尋", "伺服器不支援搜尋")
+        self.search_query = query
+        self.request_search(0)
+
+    def request_search(self, offset):
+        self.send_packet({'type': 21, 'room': self.room, 'query': self.search_query,
+                          'offset': offset, 'limit': SEARCH_PAGE_SIZE})
+
+    def open_search_window(self):
+        theme = self.current_theme
+        self.search_window = tk.Toplevel(self.root)
+        self.search_window.geometry("560x600")
+        self.search_area = scrolledtext.ScrolledText(self.search_window, state='disabled', width=60,
+                                                     bg=theme['text_bg'], fg=theme['text_fg'])
+        self.search_area.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.search_area.tag_config("meta", font=("Arial", 9), foreground=theme['meta_fg'])
+        self.search_area.tag_config("content", font=("Arial", 11), foreground=theme['text_fg'])
+        self.search_area.tag_config("match", foreground=theme['highlight'])
+        self.search_more = tk.Button(self.search_window, text="更多結果",
+                                     command=lambda: self.request_search(self.search_offset))
+        self.search_more.pack(pady=5)
+
+    def show_search_results(self, msg):
+        "相關度高的在前；offset 為 0 時是新的搜尋，否則接在後面"
+        if msg.get('query') != self.search_query or msg.get('room') != self.room: return
+        if self.search_window is None or not self.search_window.winfo_exists():
+            self.open_search_window()
+        self.search_window.title(f"搜尋: {msg['query']} (#{msg['room']})")
+        area = self.search_area
+        area.config(state='normal')
+        if msg.get('offset', 0) == 0:
+            area.delete('1.0', tk.END)
+            if not msg['results']: area.insert(tk.END, "沒有符合的訊息\n", "meta")
+        start = area.index('end-1c')
+        for item in msg['results']:
+            area.insert(tk.END, f"{item.get('nickname', 'Unknown')}  {item.get('time', '')}\n", "meta")
+            area.insert(tk.END, f"{item.get('message', '')}\n\n", "content")
+        for term in msg['query'].split(): # 標出符合的詞
+            index = start
+            while True:
+                index = area.search(term, index, tk.END, nocase=True)
+                if not index: break
+                area.tag_add("match", index, f"{index}+{len(term)}c")
+                index = f"{index}+{len(term)}c"
+        area.config(state='disabled')
+        self.search_offset = msg.get('offset', 0) + len(msg['results'])
+        self.search_more.config(state='normal' if msg.get('more') else 'disabled')
+
+    # --- 處理伺服器送來的封包 (在 Tk 執行緒上執行) ---
+    def handle_packet(self, msg):
+        msg_type = msg.get('type')
+        nickname = msg.get('nickname', 'Unknown')
+        sender = msg.get('sender', nickname)
+        msg_time = msg.get('time', datetime.now().strftime('%Y/%m/%d %H:%M'))
+        if msg_type in (5, 9, 10) and msg.get('room', self.room) != self.room:
+            return # 切換房間途中還在送來的舊房間訊息
+        if msg_type in (5, 9, 10): # 記住看到的最新一則，重新連線時只需要補這之後的
+            msg_id = msg.get('msg_id' if msg_type == 10 else 'id')
+            if msg_id is not None and (self.last_id is None or msg_id > self.last_id): self.last_id = msg_id
+
+        if msg_type == 2: # 登入成功
+            self.server_features = set(msg.get('features', []))
+            if 'binary' in self.server_features: self.codec = chat_codec.BINARY # 之後送出的封包改用 binary
+            self.resume_token = msg.get('resume_token')
+            self.reconnect_delay = RECONNECT_DELAY
+            if self.logged_in:
+                # 伺服器沒有只補缺口 (不支援、漏掉太多，或不在大廳時)，接著送來的是完整的回放
+                if not msg.get('resumed') and (self.room == DEFAULT_ROOM or 'resume' not in self.server_features):
+                    self.clear_chat()
+                self.append_chat("系統", "已重新連線")
+                self.root.title(f"聊天室 - {self.nickname}" + ('' if self.room == DEFAULT_ROOM else f" #{self.room}"))
+                if self.room != DEFAULT_ROOM: # 回到原本的房間 (接手舊連線時本來就在，伺服器只補缺口)
+                    self.send_packet({'type': 18, 'room': DEFAULT_ROOM})
+                    rejoin = {'type': 17, 'room': self.room}
+                    if self.last_id is not None: rejoin['last_id'] = self.last_id
+                    self.send_packet(rejoin)
+            else:
+                self.append_chat("系統", "登入成功！")
+            self.logged_in = True
+            self.resume_uploads()
+            if 'heartbeat' in self.server_features:
+                self.ping_interval, self.ping_timeout = msg['ping_interval'], msg['ping_timeout']
+                if self.heartbeat_job: self.root.after_cancel(self.heartbeat_job)
+                self.heartbeat_job = self.root.after(HEARTBEAT_CHECK, self.check_heartbeat)
+        
+        # --- 一般廣播 (Type 3) ---
+        if msg_type == 3:
+            self.append_chat(sender, msg['message'], time_str=msg_time)
+
+        # --- Type 5: 廣播訊息與系統指令 ---
+        if msg_type == 5:
+            action = msg.get('action')
             
+            # 1. 處理踢人
+            if action == 'kick':
+                self.is_connected = False # 接著的斷線不要重新連線
+                messagebox.showwarning("通知", "你已被管理員踢出聊天室")
+                self.safe_exit()
+                
+            # 2. 處理伺服器關閉
+            elif action == 'shutdown':
+                self.is_connected = False
+                self.append_chat("系統", "伺服器已關閉，程式將在 10 秒後結束...", highlight=True)
+                self.entry_msg.config(state='disabled')
+                self.root.after(10000, self.safe_exit)
+
+            # 3. 處理人數已滿
+            elif action == 'full':
+                if self.logged_in: # 重新連線時遇到：斷線後照常退避重試
+                    self.append_chat("系統", "伺服器人數已滿，稍後再試...")
+                else:
+                    self.is_connected = False
+                    messagebox.showwarning("連線失敗", "伺服器人數已滿，請稍後再試。")
+                    self.safe_exit()
+
+            # 4. 暱稱已被使用
+            elif action == 'name_taken':
+                if self.logged_in: # 重新連線時伺服器還沒清掉舊的連線 (例如多行程模式不保留名額)：退避後再試
+                    self.append_chat("系統", "伺服器還保留著上一次的連線，稍後再試...")
+                else:
+                    self.is_connected = False
+                    messagebox.showwarning("連線失敗", msg['message'])
+                    self.safe_exit()
+
+            # 5. 傳送太快，伺服器暫停接收 (之後送出的會排隊，等伺服器恢復讀取)
+            elif action == 'throttle':
+                self.append_chat("系統", msg['message'], highlight=True)
+                self.entry_msg.config(state='disabled')
+                wait = max(1, msg.get('retry_after', 0)) # 至少停一秒，避免連續貼上
+                self.root.after(int(wait * 1000), lambda: self.entry_msg.config(state='normal'))
+
+            # 6. 一般聊天訊息 (必須要有這段，不然會收不到訊息)
+            else:
+                self.append_chat(msg['nickname'], msg['message'], time_str=msg_time, msg_id=msg.get('id'))
+
+        if msg_type == 6: # 更新名單 (完整名單或差異)
+            self.update_user_list(msg)
+
+        # --- 私訊 (Type 7) ---
+        if msg_type == 7:
+            sender = msg.get('sender', '未知使用者') 
+            content = msg.get('message', '')
+            self.append_chat(sender, f"[來自 {sender} 的私訊] {content}", time_str=msg_time, highlight=True)
+
+        # --- 圖片 (Type 9) ---
+        if msg_type == 9:
+            self.append_chat(sender, "傳送了一張圖片", time_str=msg_time, msg_id=msg.get('id'))
+            if 'thumb_data' in msg: # 伺服器只送縮圖，點開時再索取原圖
+                self.display_image(msg['thumb_data'], image_hash=msg['image_hash'])
+            else:
+                self.display_image(msg['image_data'])
+
+        # --- 分段圖片 (Type 10 開始 / 11 分段 / 12 結束) ---
+        if msg_type == 10:
+            self.begin_download(msg)
+        if msg_type == 11:
+            self.receive_chunk(msg)
+        if msg_type == 12:
+            self.finish_download(msg)
+
+        # --- 較舊的一頁歷史 (Type 20，回覆 type 19) ---
+        if msg_type == 20:
+            self.prepend_history(msg)
+
+        # --- 搜尋結果 (Type 22，回覆 type 21) ---
+        if msg_type == 22:
+            self.show_search_results(msg)
+
+        # --- 進入房間 (Type 17)，順便更新房間列表 ---
+        if msg_type == 17:
+            if msg.get('resumed') is False: self.clear_chat() # 重新連線回到房間，但缺口太大，改送完整回放
+            self.room_box.config(values=msg.get('rooms', [msg['room']]))
+            self.append_chat("系統", f"已進入 #{msg['room']}")
+
+        # --- 上傳進度 (Type 13) ---
+        if msg_type == 13:
+            self.on_upload_ack(msg)
+
+        # --- 索取原圖的回覆 (Type 15，通常改用分段傳送) ---
+        if msg_type == 15:
+            if 'image_data' in msg:
+                self.on_full_image(msg['hash'], chat_codec.blob(msg, 'image_data'))
+            else:
+                self.append_chat("系統", "原圖已不存在")
 
     # --- 內容顯示到聊天視窗 ---
-    def append_chat(self, sender, message, time_str="", highlight=False, is_image=False, image_data=None):
-        self.chat_area.config(state='normal')
+    def append_chat(self, sender, message, time_str="", highlight=False, is_image=False, image_data=None, msg_id=None):
+        in_batch = self.rendering # 在 pump_events 裡時，由整批結束後統一捲動
+        if not in_batch: self.chat_area.config(state='normal')
+        if msg_id is not None: # 翻頁游標 (見 oldest_id)
+            self.chat_area.mark_set(f"id_{msg_id}", 'end-1c')
+            self.chat_area.mark_gravity(f"id_{msg_id}", tk.LEFT)
         
         # 插入標頭 (名字 + 時間)
         if not time_str: time_str = datetime.now().strftime('%Y/%m/%d %H:%M')
         header = f"{sender}  {time_str}\n"
         
-        # 定義標籤樣式
-        self.chat_area.tag_config("meta", foreground=self.current_theme['meta_fg'], font=("Arial", 9))
-        self.chat_area.tag_config("content", foreground=self.current_theme['text_fg'], font=("Arial", 11))
-        self.chat_area.tag_config("highlight", foreground=self.current_theme['highlight'], font=("Arial", 11, "bold"))
-        
         self.chat_area.insert(tk.END, header, "meta")
 
         # 插入內容 (文字或圖片)
@@ -207,72 +659,72 @@ class ChatClient:
             tag = "highlight" if highlight else "content"
             self.chat_area.insert(tk.END, f"{message}\n\n", tag) # 多加一個換行讓版面寬鬆點
 
-        self.chat_area.see(tk.END)
-        self.chat_area.config(state='disabled')
+        if not in_batch: self.finish_render()
 
     # --- 顯示縮圖 ---
-    def display_image(self, b64):
+    def display_image(self, data, index=None, image_hash=None):
+        """data 可以是 Base64 字串或原始 bytes。
+        解碼與縮放交給背景執行緒，完成後才回到 Tk 執行緒建立 PhotoImage。
+        image_hash 不為 None 代表 data 只是縮圖，點開時要向伺服器索取原圖"""
+        if index is None:
+            # 先在目前位置留下標記，解碼完成後插在這裡，順序不會亂
+            index = f"img_{next(self.image_ids)}"
+            self.chat_area.mark_set(index, 'end-1c')
+            self.chat_area.mark_gravity(index, tk.LEFT)
+        future = self.decoder.submit(prepare_thumbnail, data, image_hash is None, self.image_cache)
+        future.add_done_callback(lambda f: self.post(self.place_image, f, index, image_hash))
+
+    def place_image(self, future, index, image_hash):
+        "由 pump_events 呼叫：只剩建立 PhotoImage 與 Label"
+        if index not in self.chat_area.mark_names(): return # 已切換房間
         try:
-            # 1. 將 Base64 轉回 Bytes，再用 PIL 開啟
-            image_bytes = base64.b64decode(b64)
-            img = Image.open(io.BytesIO(image_bytes))
-            
-            # 2. 計算縮圖 (保持長寬比)
-            # 這裡用 thumbnail 方法，比原本的 subsample 更聰明且畫質更好
-            max_size = (300, 300) # 設定最大寬高
-            img_thumb = img.copy() # 複製一份來做縮圖，保留 img 為原圖
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
+            digest, img = future.result()
             tk_img = ImageTk.PhotoImage(img)
+            # 點擊時用的原圖雜湊 (完整圖片已放進 image_cache)
+            image_hash = image_hash or digest
             
-            # 3. 生成唯一 Tag ID (用時間戳記+隨機數，或是簡單的計數)
-            # 這裡我們利用 image_references 的長度來當作唯一 ID
-            img_id = f"img_{len(self.image_references)}"
-            
-            # 4. 存原圖資料 (為了點擊放大時使用)
-            self.image_references.append(tk_img) # 防止被垃圾回收
-            self.image_data_store[img_id] = b64 # 存 Base64 字串
-            # 5. 顯示在聊天室
-            self.chat_area.config(state='normal')
+            # 顯示在聊天室
             # --- 改用 Label 包裝圖片 ---
             # 建立一個 Label，裡面放圖片，並直接設定手指游標 (cursor="hand2")
             # bg="white" 可以依據你的主題調整，或是設為聊天室背景色
             img_label = tk.Label(self.chat_area, image=tk_img, bg=self.current_theme['text_bg'], cursor="hand2")
-            img_label.image = tk_img
+            img_label.image = tk_img # 防止被垃圾回收 (Label 被刪除時一起釋放)
             # 直接綁定點擊事件到這個 Label 上
-            img_label.bind("<Button-1>", lambda e, tag=img_id: self.open_full_image(tag))
-            # 使用 window_create 把這個 Label 塞進聊天室文字框
-            self.chat_area.window_create(tk.END, window=img_label)
-
-            self.chat_area.insert(tk.END, "\n\n") 
-            self.chat_area.see(tk.END)
-            self.chat_area.config(state='disabled')
+            img_label.bind("<Button-1>", lambda e, h=image_hash: self.open_full_image(h))
+            # 插在留下的位置 (標記靠左，所以先插換行再插圖片)
+            self.chat_area.insert(index, "\n\n")
+            self.chat_area.window_create(index, window=img_label)
 
         except Exception as e:
             print(f"圖片顯示錯誤: {e}")
+        finally:
+            self.chat_area.mark_unset(index)
     # --- 點擊圖片放大 ---        
-    def open_full_image(self, img_tag):
-        """點擊圖片後彈出視窗顯示原圖"""
-        b64_data = self.image_data_store.get(img_tag)
-        if not b64_data: return
+    def open_full_image(self, image_hash):
+        """點擊圖片後彈出視窗顯示原圖；查快取 (可能讀磁碟)、解碼與縮放都在背景執行緒進行"""
+        future = self.decoder.submit(load_full_image, self.image_cache, image_hash, self.screen_size)
+        future.add_done_callback(lambda f: self.post(self.on_cached_image, image_hash, f))
+
+    def on_cached_image(self, image_hash, future):
+        if future.exception() is None and future.result() is None:
+            # --- Type 14: 快取沒有，向伺服器索取原圖，收到後 (on_full_image) 再顯示 ---
+            self.send_packet({'type': 14, 'hash': image_hash})
+            return
+        self.open_preview(future)
+
+    def on_full_image(self, image_hash, image_bytes):
+        future = self.decoder.submit(store_full_image, self.image_cache, image_hash, image_bytes, self.screen_size)
+        future.add_done_callback(lambda f: self.post(self.open_preview, f))
+
+    def open_preview(self, future):
         try:
+            img = future.result()
+            if img is None: return # 雜湊不符
+            
             # 建立新視窗 (Toplevel)
             top = tk.Toplevel(self.root)
             top.title("圖片預覽")
             
-            # 讀取原圖
-            image_bytes = base64.b64decode(b64_data)
-            img = Image.open(io.BytesIO(image_bytes))
-            
-            # 處理過大圖片 (如果原圖比螢幕還大，稍微縮一下，不然視窗會爆開)
-            screen_width = self.root.winfo_screenwidth()
-            screen_height = self.root.winfo_screenheight()
-            
-            # 如果圖片寬或高超過螢幕的 80%，就縮放
-            if img.width > screen_width * 0.8 or img.height > screen_height * 0.8:
-                ratio = min(screen_width * 0.8 / img.width, screen_height * 0.8 / img.height)
-                new_size = (int(img.width * ratio), int(img.height * ratio))
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-            
             tk_img = ImageTk.PhotoImage(img)
             
             # 顯示圖片
@@ -300,14 +752,15 @@ class ChatClient:
                        'message': text, 
                        'sender': self.nickname, 
                        'time': current_time}
-                self.sock.sendall((json.dumps(msg)+'\n').encode('utf-8'))
+                self.send_packet(msg)
                 self.append_chat("我", f"[發送私訊給 {self.target_private_user}] {text}", time_str=current_time, highlight=True)
             else:
                 msg = {'type': 3, 
                        'nickname': self.nickname, 
+                       'room': self.room, 
                        'message': text, 
                        'time': current_time}
-                self.sock.sendall((json.dumps(msg)+'\n').encode('utf-8'))
+                self.send_packet(msg)
                 self.append_chat("我", text, time_str=current_time)
             
             self.entry_msg.delete(0, tk.END)
@@ -347,11 +800,16 @@ class ChatClient:
             img_byte_arr = img_byte_arr.getvalue()
             # 3. 轉 Base64
             data = base64.b64encode(img_byte_arr).decode()
-            msg = {'type': 9, 
-                   'nickname': self.nickname, 
-                   'image_data': data, 
-                   'time': current_time}
-            self.sock.sendall((json.dumps(msg)+'\n').encode('utf-8'))
+            if 'chunked_images' in self.server_features:
+                # 分段上傳：排在文字後面慢慢送，斷線後可接續
+                self.start_upload(img_byte_arr, current_time)
+            else:
+                msg = {'type': 9, 
+                       'nickname': self.nickname, 
+                       'room': self.room, 
+                       'image_data': img_byte_arr, # json 編碼時才轉 base64
+                       'time': current_time}
+                self.send_packet(msg)
             self.append_chat("我", "傳送了一張圖片", time_str=current_time, is_image=True, image_data=data)
         except: pass
 
@@ -361,26 +819,248 @@ class ChatClient:
         if not ip or not port or not name: return messagebox.showerror("錯誤", "欄位不可為空")
         self.nickname = name
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.settimeout(5)
-            self.sock.connect((ip, int(port)))
-            self.sock.settimeout(None)
-            self.sock.sendall((json.dumps({'type': 1, 'nickname': name})+'\n').encode('utf-8'))
-            self.is_connected = True
-            threading.Thread(target=self.recv_message, daemon=True).start()
+            self.server_addr = (ip, int(port))
+            self.open_connection()
             self.login_frame.pack_forget()
             self.main_frame.pack(fill=tk.BOTH, expand=True)
             self.root.title(f"聊天室 - {self.nickname}")
         except Exception as e: messagebox.showerror("連線失敗", str(e))
 
-    def update_user_list(self, users):
-        self.user_listbox.delete(0, tk.END)
-        for u in users: self.user_listbox.insert(tk.END, u)
+    def open_connection(self):
+        "連線並送出登入 (type 1)；第一次登入與重新連線共用，可以在任何執行緒呼叫"
+        sock = socket.create_connection(self.server_addr, timeout=5)
+        sock.settimeout(None)
+        self.codec = chat_codec.JSON # 登入一律用 json，收到 type 2 後才可能切換
+        login = {'type': 1, 'nickname': self.nickname, 'features': CLIENT_FEATURES}
+        if self.resume_token: login['resume_token'] = self.resume_token
+        if self.last_id is not None and self.room == DEFAULT_ROOM: login['last_id'] = self.last_id # 其他房間在 type 17 補
+        sock.sendall(self.codec.encode(login))
+        self.last_received = time.monotonic()
+        self.ping_sent = 0
+        with self.send_lock: # 舊的送出執行緒看到 sock 換了就結束
+            self.sock = sock
+        self.is_connected = True
+        threading.Thread(target=self.recv_message, args=(sock,), daemon=True).start()
+        threading.Thread(target=self.send_loop, args=(sock,), daemon=True).start()
+        self.send_ready.set() # 斷線時放回佇列的文字
+
+    # --- 斷線重連：網路短暫中斷時自動接回，伺服器只補漏掉的訊息 ---
+    def connection_dropped(self, sock):
+        "接收執行緒結束時呼叫 (EOF、錯誤或心跳逾時)；主動離開、被踢或已經換了新連線時不處理"
+        if not self.is_connected or self.sock is not sock: return
+        self.is_connected = False
+        self.send_ready.set() # 讓舊的送出執行緒醒來結束
+        self.loading_history = False # 還沒回覆的 type 19 不會來了
+        self.append_chat("系統", "與伺服器的連線中斷，重新連線中...", highlight=True)
+        self.root.title(f"聊天室 - {self.nickname} (重新連線中...)")
+        threading.Thread(target=self.reconnect_loop, daemon=True).start()
+
+    def reconnect_loop(self):
+        """失敗就把等待時間加倍 (最多 RECONNECT_MAX_DELAY)，並加上隨機抖動，
+        伺服器重啟時所有客戶端不會同時湧入；登入成功 (type 2) 時才重設"""
+        while True:
+            time.sleep(self.reconnect_delay * random.uniform(0.5, 1))
+            self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_MAX_DELAY)
+            try:
+                self.open_connection()
+                return
+            except OSError as e:
+                print(f"[Error] 重新連線失敗: {e}")
+
+    # --- 心跳：與伺服器相同的規則，太久沒收到封包就送 ping，仍沒有回應就視為斷線 ---
+    def check_heartbeat(self):
+        if not self.is_connected: return
+        now = time.monotonic()
+        if self.ping_sent and self.last_received < self.ping_sent:
+            if now - self.ping_sent >= self.ping_timeout:
+                self.connection_lost()
+                return
+        elif now - self.last_received >= self.ping_interval:
+            self.ping_sent = now
+            self.send_packet({'type': 23})
+        self.heartbeat_job = self.root.after(HEARTBEAT_CHECK, self.check_heartbeat)
+
+    def connection_lost(self):
+        "伺服器沒有回應 ping (連線可能已半開)：關閉 socket，接收執行緒結束後走重新連線"
+        self.heartbeat_job = None
+        try: self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+    # --- 送出佇列 ---
+    def send_packet(self, msg, upload_id=None):
+        """放進送出佇列；upload_id 不為 None 的是圖片分段，排在文字後面"""
+        data = self.codec.encode(msg)
+        with self.send_lock:
+            if upload_id is None: self.text_queue.append(data)
+            else: self.bulk_queue.append((upload_id, data))
+        self.send_ready.set()
+
+    def send_loop(self, sock):
+        """每一輪先把累積的文字一次送出，再送一段圖片，文字最多只等一個分段。
+        斷線時沒送出去的文字放回佇列，重新連線後由新的送出執行緒補送 (圖片分段由 resume_uploads 接續)"""
+        while self.is_connected:
+            self.send_ready.wait()
+            self.send_ready.clear()
+            while True:
+                with self.send_lock:
+                    if self.sock is not sock: return
+                    is_text = bool(self.text_queue)
+                    if is_text:
+                        data = b''.join(self.text_queue)
+                        self.text_queue.clear()
+                    elif self.bulk_queue:
+                        data = self.bulk_queue.popleft()[1]
+                    else:
+                        break
+                try:
+                    sock.sendall(data)
+                except Exception as e:
+                    print(f"[Error] 發送失敗: {e}")
+                    if is_text:
+                        with self.send_lock: self.text_queue.appendleft(data)
+                    return
+                if self.logging_out and not self.text_queue: self.logout_sent.set() # type 25 已送出
+
+    def logout(self):
+        """關閉視窗前告訴伺服器是主動離開 (type 25)，否則會當成斷線，暱稱被保留 RESUME_GRACE 秒，
+        馬上重新開啟會被拒絕。未送完的圖片分段直接丟掉，最多等 LOGOUT_TIMEOUT 秒送出"""
+        if not (self.is_connected and self.logged_in and self.sock and 'resume' in self.server_features): return
+        with self.send_lock: self.bulk_queue.clear()
+        self.send_packet({'type': 25})
+        self.logging_out = True
+        self.logout_sent.wait(LOGOUT_TIMEOUT)
+
+    # --- 分段上傳 ---
+    def start_upload(self, raw, current_time):
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {'raw': raw,
+                                   'hash': hashlib.sha256(raw).hexdigest(),
+                                   'time': current_time,
+                                   'room': self.room,
+                                   'acked': 0,
+                                   'sending': False,
+                                   'busy': False}
+        self.send_upload_begin(upload_id)
+
+    def send_upload_begin(self, upload_id):
+        """送出 (或重送) Type 10，伺服器會回覆下一個需要的分段編號"""
+        up = self.uploads[upload_id]
+        up['sending'] = False
+        up['busy'] = False
+        with self.send_lock: # 丟掉還沒送出的舊分段，等伺服器回覆後再從正確位置送
+            self.bulk_queue = deque(item for item in self.bulk_queue if item[0] != upload_id)
+        self.send_packet({'type': 10, 
+                          'id': upload_id, 
+                          'nickname': self.nickname, 
+                          'size': len(up['raw']), 
+                          'hash': up['hash'], 
+                          'chunk_size': CHUNK_SIZE, 
+                          'room': up['room'], 
+                          'time': up['time']})
+
+    def resume_uploads(self):
+        "重新登入後，從伺服器最後確認的分段接續未完成的上傳"
+        for upload_id in list(self.uploads):
+            self.send_upload_begin(upload_id)
+
+    def on_upload_ack(self, msg):
+        up = self.uploads.get(msg['id'])
+        if not up: return
+        if msg.get('done'):
+            del self.uploads[msg['id']]
+            self.next_waiting_upload()
+            return
+        if 'error' in msg:
+            if msg['error'] == 'unknown' and up['sending']:
+                self.send_upload_begin(msg['id']) # 伺服器沒有這筆上傳 (例如重啟過)，從頭開始
+            elif msg['error'] == 'busy':
+                up['busy'] = True # 同時上傳太多張，等前面的傳完
+            elif msg['error'] != 'unknown':
+                del self.uploads[msg['id']]
+                self.append_chat("系統", f"圖片上傳失敗 ({msg['error']})")
+                self.next_waiting_upload()
+            return
+        up['acked'] = msg['next']
+        if not up['sending']:
+            up['sending'] = True
+            raw = up['raw']
+            for seq in range(msg['next'], -(-len(raw) // CHUNK_SIZE)):
+                chunk = raw[seq * CHUNK_SIZE:(seq + 1) * CHUNK_SIZE]
+                self.send_packet({'type': 11, 'id': msg['id'], 'seq': seq, 'data': chunk}, upload_id=msg['id'])
+            self.send_packet({'type': 12, 'id': msg['id']}, upload_id=msg['id'])
+
+    def next_waiting_upload(self):
+        "一張上傳結束，輪到因 busy 等待中的下一張"
+        waiting = next((upload_id for upload_id, up in self.uploads.items() if up['busy']), None)
+        if waiting: self.send_upload_begin(waiting)
+
+    # --- 分段下載 ---
+    def begin_download(self, msg):
+        "先顯示文字並留下位置，圖片收完後插在這裡，後面的訊息不必等圖片"
+        if msg.get('fetch'): # 點開縮圖索取的原圖，不顯示在聊天室
+            self.downloads[msg['id']] = {'meta': msg, 'parts': [], 'next': msg.get('start', 0), 'mark': None}
+            return
+        sender = msg.get('nickname', 'Unknown')
+        self.append_chat(sender, "傳送了一張圖片", time_str=msg.get('time', ''), msg_id=msg.get('msg_id'))
+        mark = f"dl_{msg['id']}"
+        self.chat_area.mark_set(mark, 'end-1c')
+        self.chat_area.mark_gravity(mark, tk.LEFT)
+        self.downloads[msg['id']] = {'meta': msg, 'parts': [], 'next': 0, 'mark': mark}
+
+    def receive_chunk(self, msg):
+        dl = self.downloads.get(msg['id'])
+        if not dl: return
+        if msg['seq'] != dl['next']: # 分段遺失 (伺服器因佇列過滿丟棄)，放棄這張圖
+            if dl['mark']: self.chat_area.mark_unset(dl['mark'])
+            del self.downloads[msg['id']]
+            return
+        dl['parts'].append(chat_codec.blob(msg, 'data'))
+        dl['next'] += 1
+
+    def finish_download(self, msg):
+        dl = self.downloads.pop(msg['id'], None)
+        if not dl: return
+        raw = b''.join(dl['parts'])
+        if dl['meta'].get('fetch'):
+            return self.on_full_image(dl['meta']['hash'], raw)
+        if hashlib.sha256(raw).hexdigest() == dl['meta']['hash']:
+            self.display_image(raw, index=dl['mark']) # 標記在圖片放好後才移除
+        else:
+            self.chat_area.mark_unset(dl['mark'])
+
+    def update_user_list(self, msg):
+        """完整名單 (有 users) 直接重建；差異 (op) 只增刪一列。
+        seq 跳號代表漏收，先忽略之後的差異並向伺服器索取完整名單 (type 16)"""
+        if 'users' in msg:
+            self.presence_seq = msg.get('seq')
+            self.users = list(msg['users'])
+            self.user_listbox.delete(0, tk.END)
+            for u in self.users: self.user_listbox.insert(tk.END, u)
+            if self.target_private_user and (self.target_private_user not in self.users):
+                self.private_user_left()
+            return
+        if self.presence_seq is None or msg['seq'] <= self.presence_seq: return # 等完整名單 / 已包含在名單裡
+        if msg['seq'] != self.presence_seq + 1:
+            self.presence_seq = None
+            self.send_packet({'type': 16})
+            return
+        self.presence_seq = msg['seq']
+        name = msg['nickname']
+        if msg['op'] == 'join':
+            self.users.append(name)
+            self.user_listbox.insert(tk.END, name)
+        elif name in self.users:
+            index = self.users.index(name)
+            del self.users[index]
+            self.user_listbox.delete(index)
+            if name == self.target_private_user:
+                self.private_user_left()
+
+    def private_user_left(self):
         # --- 當私訊對象離開時自動換回廣播 ---
-        if self.target_private_user and (self.target_private_user not in users):
-            self.target_private_user = None 
-            self.lbl_status.config(text="模式: 廣播 (自動切換)", fg=self.current_theme['fg'])
-            self.append_chat("系統", "私訊對象已離線")
+        self.target_private_user = None 
+        self.lbl_status.config(text="模式: 廣播 (自動切換)", fg=self.current_theme['fg'])
+        self.append_chat("系統", "私訊對象已離線")
 
     # --- 切換主題 ---
     def toggle_theme(self):
@@ -393,10 +1073,11 @@ class ChatClient:
         theme = self.current_theme
         self.root.config(bg=theme['bg'])
         for w in [self.top_bar, self.login_frame, self.main_frame, self.right_frame, self.bottom_frame]: w.config(bg=theme['bg'])
-        for w in [self.entry_ip, self.entry_port, self.entry_nickname, self.entry_msg]: w.config(bg=theme['text_bg'], fg=theme['text_fg'], insertbackground=theme['text_fg'])
+        for w in [self.entry_ip, self.entry_port, self.entry_nickname, self.entry_msg, self.search_box]: w.config(bg=theme['text_bg'], fg=theme['text_fg'], insertbackground=theme['text_fg'])
         for w in self.login_frame.winfo_children(): 
             if isinstance(w, tk.Label): w.config(bg=theme['bg'], fg=theme['fg'])
         self.lbl_status.config(bg=theme['bg'], fg=theme['fg'])
+        self.lbl_room.config(bg=theme['bg'], fg=theme['fg'])
         self.chat_area.config(bg=theme['text_bg'], fg=theme['text_fg'])
         self.user_listbox.config(bg=theme['list_bg'], fg=theme['text_fg'])
         self.chat_area.tag_config("meta", foreground=theme['meta_fg'])
@@ -422,6 +1103,7 @@ class ChatClient:
     
     # --- 安全關閉程式 ---
     def safe_exit(self):
+        self.logout()
         self.is_connected = False
         if self.sock: 
             try: self.sock.close() 
@@ -1,81 +1,909 @@
 import socket
 import threading
+import asyncio
+import argparse
 import json
+import base64
+import hashlib
+import itertools
 import time
-import sqlite3
+import zlib
 from datetime import datetime
 import os
+import re
+import secrets
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import chat_store
+from chat_bus import BusClient, BusHub
+from chat_codec import JSON, BINARY, ZLIB_MARK, blob, frame_type, read_packets, read_packet
+from chat_federation import Federation, FED_LOG_SIZE
+from chat_metrics import Metrics, SIZE_BUCKETS
+from chat_profiler import Profiler
+from chat_timers import TimerWheel
+from chat_store import MessageStore, DURABILITY_LEVELS, DEFAULT_ROOM, image_ref, make_thumbnail
 
 BIND_IP = '0.0.0.0'
 BIND_PORT = 6000
-MAX_HISTORY_SEND = 10
+MAX_HISTORY_SEND = 10 # 登入時回放的訊息數 (--history)，更早的由客戶端以 type 19 分頁索取
+HISTORY_PAGE_SIZE = 50 # type 19 每頁最多幾則
+SEARCH_PAGE_SIZE = 20 # type 21 每頁最多幾則結果
+HISTORY_MAX_BYTES = 64 * 1024 * 1024 # 歷史環的記憶體上限 (圖片很大時以此為準)
+PROFILE_SECONDS = 10 # /profile、/cprofile 沒指定秒數時量測多久
 MAX_CLIENTS = 10
 DB_NAME = 'chat_record.db'
+BLOB_DIR = 'chat_blobs' # 圖片依內容雜湊存放的目錄
+
+# asyncio 引擎設定
+LISTEN_BACKLOG = 1024
+MAX_LINE_BYTES = 16 * 1024 * 1024 # 單行上限 (客戶端圖片 10MB，base64 後約 13MB)
+
+# 送出佇列設定 (收得慢的客戶端)
+OUTBOX_MAX_FRAMES = 1000
+OUTBOX_MAX_BYTES = 64 * 1024 * 1024
+SLOW_CLIENT_POLICY = 'drop_images' # drop_oldest / drop_images / disconnect
+IOV_MAX = 1024 # 單次 sendmsg 最多幾段 buffer (Linux 上限)
+
+# 封包種類：佇列滿時先丟誰，以及 writer 的送出順序
+TEXT, IMAGE, CHUNK = 0, 1, 2 # 文字/控制、整張圖片 (舊協定)、圖片分段
+CHUNK_BURST = 256 * 1024     # writer 每輪在文字之後最多送出多少分段資料
+
+# 分段圖片傳輸 (type 10~13)
+SERVER_FEATURES = ['chunked_images', 'presence_delta', 'binary', 'history_pages', 'resume'] # binary: 登入後改用 chat_codec.BINARY
+CHUNK_SIZE = 64 * 1024               # 每段原始位元組數
+MAX_IMAGE_BYTES = 10 * 1024 * 1024   # 與客戶端的 10MB 限制相同
+UPLOAD_TTL = 600                     # 停下來的上傳保留幾秒 (連線仍在時可接續；離線即丟棄，見 leave_client)
+MAX_UPLOADS = 3                      # 每個使用者同時進行中的上傳數
+THUMB_WORKERS = 2                    # 產生縮圖的子行程數
+
+# 壓縮 (登入時協商 'zlib')：伺服器送出的文字封包經每條連線自己的 deflate 串流壓縮，
+# 跨封包共用字典，重複的 "type"、"nickname" 等欄位幾乎不佔空間。圖片本身已壓縮過，不再壓
+COMPRESS_LEVEL = 6      # 0 = 不提供壓縮；小封包下 6 與 1 的 CPU 相近但壓得更小 (bench_compression.py)
+COMPRESS_WBITS = -12    # raw deflate、4KB 視窗；每條連線的壓縮狀態約 32KB
+COMPRESS_MEMLEVEL = 5   # 區塊格式見 chat_codec
+
+# 心跳 (登入時協商 'heartbeat'，type 23 ping / 24 pong)：半開的連線 (筆電闔上、NAT 逾時)
+# 讀取端不會發現，仍佔著名額也仍在收廣播。一段時間沒收到任何封包就送 ping，再等不到回應就中斷
+PING_INTERVAL = 30 # 秒，沒收到任何封包多久後送 ping (0 = 不送)
+PING_TIMEOUT = 15  # 秒，送出 ping 後多久沒收到任何封包就中斷連線
+TIMER_SLOTS = 64   # 時間輪的格子數 (每格 1 秒)
+
+# 流量限制：每條連線各自的 token bucket。超過時照常處理這個封包，但暫停讀取該連線直到額度回補，
+# 資料留在對方的 TCP 緩衝區 (自然回壓到客戶端)，不會堆在伺服器上；並送出 type 5 action 'throttle' 通知
+RATE_MESSAGES = 10                  # 每秒封包數 (圖片分段不計；0 = 不限制，以下同)
+RATE_TEXT_BYTES = 64 * 1024         # 圖片以外的封包每秒位元組數
+RATE_IMAGE_BYTES = 2 * 1024 * 1024  # 圖片 (type 9 與分段上傳) 每秒位元組數
+RATE_BURST = 3                      # 封包數與文字可以一次用掉幾秒份的額度 (貼上多行、登入時的一連串請求)
+RATE_IMAGE_BURST = 2 * MAX_LINE_BYTES # 連續兩張最大的圖片不必等待
+IMAGE_TYPES = {9, 10, 11, 12}
+
+# 斷線重連 (登入時協商 'resume')：客戶端登入時帶上最後看到的訊息 id 與上次拿到的 resume_token，
+# 只補回漏掉的那一段；斷線後名額與房間保留一段時間，期間重新連上不廣播離開/加入。
+# 使用者自己關閉視窗時客戶端先送 type 25，伺服器立即釋放暱稱，不當成斷線保留
+RESUME_GRACE = 30     # 秒，斷線後保留多久 (0 = 立即離開；多行程模式下不保留，見 remove_client)
+RESUME_MAX_GAP = 500  # 漏掉超過這麼多則就改送一般的回放 (最近 MAX_HISTORY_SEND 則)
+
+# 房間 (type 17 加入 / 18 離開)
+ROOM_NAME_MAX = 32
+MAX_ROOM_RINGS = 256 # 記憶體中保留歷史環的房間數，其餘需要時再從資料庫載入
+
+# 多行程模式 (--workers N)：N 個 worker 以 SO_REUSEPORT 共用同一個 port，
+# 彼此透過 supervisor 上的 hub (Unix socket) 轉送廣播、名單與私訊
+BUS_PATH = 'chat_bus.sock'
+
+# 資料庫：所有寫入交給 store 的 writer 執行緒批次 commit
+DB_DURABILITY = 'normal' # off / normal / full
+DB_COMMIT_DELAY = 0.005  # 湊批次最多等幾秒
+store = None
+bus = None    # 多行程模式下 worker 連到 hub 的 BusClient
+roster = None # 多行程模式下全域名單的副本
+federation = None # 聯邦模式下與其他節點之間的 Federation
+
+# --- 歷史環 ---
+class HistoryRing:
+    """最近 N 則訊息，已經編碼好並帶有 is_history 標籤，登入時整段直接送出。
+    圖片只記住訊息列 (雜湊)，回放時才讀取圖片，不把整張 base64 放在記憶體裡。"""
+
+    def __init__(self, size, max_bytes):
+        self.entries = deque() # (data, image_row)，圖片的 data 為 None
+        self.size = size
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def append(self, data, image_row=None):
+        with self.lock:
+            self.entries.append((data, image_row))
+            self.nbytes += len(data) if data else 0
+            while len(self.entries) > self.size or (self.nbytes > self.max_bytes and len(self.entries) > 1):
+                old, _ = self.entries.popleft()
+                self.nbytes -= len(old) if old else 0
+
+    def frames(self):
+        with self.lock:
+            return list(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
 
-client_list = []
+class RoomHistory:
+    """每個房間一個歷史環；最近用過的 MAX_ROOM_RINGS 個留在記憶體，
+    其餘在有人加入或發言時才從資料庫載入"""
 
-# 資料庫鎖：防止多執行緒同時寫入導致資料遺失
-db_lock = threading.Lock() 
+    def __init__(self, max_rooms):
+        self.rings = OrderedDict()
+        self.max_rooms = max_rooms
+        self.lock = threading.Lock()
+
+    def get(self, room):
+        with self.lock:
+            ring = self.rings.get(room)
+            if ring is None:
+                ring = self.rings[room] = load_ring(room)
+                if len(self.rings) > self.max_rooms:
+                    self.rings.popitem(last=False)
+            else:
+                self.rings.move_to_end(room)
+            return ring
+
+    def peek(self, room):
+        "只取已在記憶體中的歷史環 (不從資料庫載入)"
+        with self.lock:
+            return self.rings.get(room)
+
+    def discard(self, room):
+        with self.lock:
+            self.rings.pop(room, None)
+
+    def clear(self):
+        with self.lock:
+            self.rings.clear()
+
+history = RoomHistory(MAX_ROOM_RINGS)
+
+def mark_history(data):
+    """在已編碼的封包尾端補上 is_history 標籤 (不必重新 json.loads / dumps)"""
+    return data[:-2] + b', "is_history": true}\n'
+
+MSG_ID = re.compile(rb'"id": (\d+)') # 字串內的引號會被跳脫，只會對到欄位名稱
+
+def entry_id(entry):
+    "歷史環項目的訊息 id"
+    data, image_row = entry
+    if image_row is not None: return image_row['id']
+    return int(MSG_ID.search(data).group(1))
+
+def stored_entry(msg_id, json_str):
+    "資料庫的一列轉成歷史環項目"
+    msg = json.loads(json_str)
+    msg['id'] = msg_id # 舊資料的 json 裡沒有 id
+    if 'image_hash' in msg: return None, msg
+    return mark_history(encode_packet(msg)), None
 
 # --- 初始化資料庫 ---
-def init_db():
-    with db_lock:
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                json_content TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        conn.commit()
-        conn.close()
-    print(f"資料庫 {DB_NAME} 連線成功")
+def init_db(id_stride=1, id_offset=0, rebuild_search=False):
+    "多行程模式下每個 worker 以不同的 id_offset 配發訊息 id"
+    global store, history
+    store = MessageStore(DB_NAME, BLOB_DIR, durability=DB_DURABILITY, batch_delay=DB_COMMIT_DELAY,
+                         id_stride=id_stride, id_offset=id_offset, on_commit=record_commit)
+    store.open(rebuild_search)
+    if store.fts: SERVER_FEATURES.append('search')
+    # 用資料庫最近的訊息預熱大廳的歷史環
+    history = RoomHistory(MAX_ROOM_RINGS)
+    for data, row in history.get(DEFAULT_ROOM).frames():
+        if row and thumb_pool and store.blobs.get_thumb(row['image_hash']) is None:
+            raw = store.blobs.get(row['image_hash']) # 舊圖片補做縮圖
+            if raw: request_thumbnail(row, raw)
+    print(f"資料庫 {DB_NAME} 連線成功 (WAL, synchronous={DB_DURABILITY})")
+
+def load_ring(room):
+    "從資料庫載入某個房間最近的訊息"
+    ring = HistoryRing(MAX_HISTORY_SEND, HISTORY_MAX_BYTES)
+    for msg_id, json_str in get_recent_messages(MAX_HISTORY_SEND, room):
+        ring.append(*stored_entry(msg_id, json_str))
+    return ring
 
 # --- 儲存訊息 ---
-def save_message(json_str):
-    try:
-        with db_lock: #確保寫入時不會被其他人打斷
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            c.execute("INSERT INTO messages (json_content) VALUES (?)", (json_str,))
-            conn.commit()
-            conn.close()
-    except Exception as e:
-        print(f"儲存失敗: {e}")
+def save_message(json_str, blob=None, room=DEFAULT_ROOM, msg_id=None, search=None):
+    "放進寫入佇列後立即返回，不在接收執行緒上等 fsync"
+    store.append(json_str, blob, room, msg_id, search)
+
+# 先放進歷史環再寫入：房間的歷史環若要從資料庫載入，才不會連這一則也讀到而重複
+def archive_message(msgdict):
+    """配發訊息 id (客戶端翻頁的游標) 後編碼，寫入資料庫並放進歷史環；
+    回傳編碼好的廣播封包"""
+    room = msgdict.get('room', DEFAULT_ROOM)
+    msgdict['id'] = store.allocate_id()
+    data = encode_packet(msgdict)
+    history.get(room).append(mark_history(data))
+    save_message(json.dumps(msgdict), room=room, msg_id=msgdict['id'],
+                 search=(msgdict['nickname'], msgdict['message']))
+    return data
+
+def archive_image(row, digest):
+    "圖片訊息：資料庫與歷史環都只記雜湊，圖片本身交給 BlobStore"
+    room = row.get('room', DEFAULT_ROOM)
+    row['id'] = store.allocate_id()
+    history.get(room).append(None, row)
+    save_message(json.dumps(row), blob=digest, room=room, msg_id=row['id'])
+
+# --- 組出歷史回放 ---
+def history_frames(client, room=DEFAULT_ROOM):
+    return entry_frames(client, history.get(room).frames())
+
+def entry_frames(client, entries):
+    frames = []
+    for data, image_row in entries:
+        if image_row is None:
+            frames.append((data, TEXT))
+        else:
+            frames.extend(image_frames(image_format(client), image_row, is_history=True, codec=client.codec))
+    return frames
+
+def resume_frames(client, room, last_id):
+    """斷線重連：只回放 id 大於 last_id (客戶端最後看到的一則) 的訊息。
+    缺口還在歷史環裡就不查資料庫；比歷史環長時從資料庫讀，超過 RESUME_MAX_GAP 則回傳 None，
+    由呼叫端改送一般的回放。last_id 比最新一則還新 (資料庫清空過) 時同樣回傳 None"""
+    entries = history.get(room).frames()
+    if not entries or entry_id(entries[-1]) < last_id: return None
+    if entry_id(entries[0]) <= last_id:
+        missed = [entry for entry in entries if entry_id(entry) > last_id]
+    else:
+        store.flush() # 寫入佇列裡的幾則還沒 commit，先等它們進資料庫
+        rows = get_messages_after(room, last_id, RESUME_MAX_GAP + 1)
+        if rows is None or len(rows) > RESUME_MAX_GAP: return None
+        missed = [stored_entry(msg_id, json_str) for msg_id, json_str in rows]
+    return entry_frames(client, missed)
+
+# --- 圖片封包 ---
+def image_format(client):
+    "thumb: 只送縮圖 (點開才索取原圖)；chunked: 分段送原圖；legacy: 一整個 type 9"
+    if 'thumbnails' in client.features: return 'thumb'
+    if 'chunked_images' in client.features: return 'chunked'
+    return 'legacy'
+
+def image_frames(fmt, row, raw=None, b64=None, is_history=False, codec=JSON):
+    "組出某種格式、某種編碼的圖片封包；raw 為 None 時才去 BlobStore 讀取"
+    if fmt == 'thumb':
+        thumb = store.blobs.get_thumb(row['image_hash'])
+        if thumb is not None:
+            msgdict = {'type': 9,
+                       'id': row.get('id'),
+                       'nickname': row['nickname'],
+                       'room': row.get('room', DEFAULT_ROOM),
+                       'thumb_data': thumb,
+                       **{k: row[k] for k in ('image_hash', 'image_size', 'width', 'height')},
+                       'time': row['time']}
+            if is_history: msgdict['is_history'] = True
+            return [(codec.encode(msgdict), IMAGE)]
+        fmt = 'chunked' # 沒有縮圖 (沒裝 Pillow 或不是圖片) 就改送原圖
+    if raw is None:
+        raw = store.blobs.get(row['image_hash'])
+        if raw is None: return [] # 圖片檔遺失就略過
+    if fmt == 'chunked':
+        header = {'msg_id': row.get('id'), # type 10 的 id 是傳輸編號
+                  'nickname': row['nickname'],
+                  'room': row.get('room', DEFAULT_ROOM),
+                  'hash': row['image_hash'],
+                  'width': row['width'],
+                  'height': row['height'],
+                  'time': row['time']}
+        if is_history: header['is_history'] = True
+        return chunk_frames(header, raw, codec=codec)
+    msgdict = {'type': 9,
+               'id': row.get('id'),
+               'nickname': row['nickname'],
+               'room': row.get('room', DEFAULT_ROOM),
+               'image_data': b64 if b64 and codec is JSON else raw, # 上傳者送來的 base64 可以直接沿用
+               'time': row['time']}
+    if is_history: msgdict['is_history'] = True
+    return [(codec.encode(msgdict), IMAGE)]
+
+transfer_ids = itertools.count(1)
+
+def chunk_frames(header, raw, start=0, codec=JSON):
+    """type 10 開頭排在文字佇列 (客戶端先留位置)，分段與結尾排在分段佇列，
+    不會擋住後面的文字訊息。start 用於從中斷處接續下載"""
+    transfer_id = f"d{next(transfer_ids)}"
+    begin = {'type': 10, 'id': transfer_id, 'size': len(raw), 'start': start, **header}
+    frames = [(codec.encode(begin), TEXT)]
+    for seq in range(start, -(-len(raw) // CHUNK_SIZE)):
+        chunk = {'type': 11,
+                 'id': transfer_id,
+                 'seq': seq,
+                 'data': raw[seq * CHUNK_SIZE:(seq + 1) * CHUNK_SIZE]}
+        frames.append((codec.encode(chunk), CHUNK))
+    frames.append((codec.encode({'type': 12, 'id': transfer_id}), CHUNK))
+    return frames
+
+def broadcast_image(row, raw=None, exclude=None, b64=None, formats=('thumb', 'chunked', 'legacy'),
+                    archive=False, relay=True):
+    "每種格式 (與編碼) 只編碼一次，所有相同的客戶端共用同一份 bytes；只送給圖片所在房間的成員"
+    room = row.get('room', DEFAULT_ROOM)
+    by_format = {}
+    for client in clients.members(room):
+        if client is exclude: continue
+        fmt = image_format(client)
+        if fmt not in formats: continue
+        key = (fmt, client.codec.name)
+        if key not in by_format:
+            by_format[key] = image_frames(fmt, row, raw, b64, codec=client.codec)
+        send_many(client, by_format[key])
+    # 其他 worker 只收到訊息列，自己從 BlobStore 讀圖 (發布前已寫入磁碟)
+    if relay and bus:
+        bus.send({'op': 'image', 'room': room, 'row': row, 'formats': list(formats), 'archive': archive})
+
+# --- 縮圖 ---
+thumb_pool = None # ProcessPoolExecutor，沒有 Pillow 時為 None
+
+def start_thumbnailer():
+    global thumb_pool
+    if chat_store.Image is None:
+        print("未安裝 Pillow，不產生縮圖 (客戶端會收到原圖)")
+        return
+    thumb_pool = ProcessPoolExecutor(max_workers=THUMB_WORKERS,
+                                     mp_context=multiprocessing.get_context('spawn'))
+    SERVER_FEATURES.append('thumbnails')
+
+def request_thumbnail(row, raw, exclude=None):
+    "在子行程產生縮圖，完成後送給支援縮圖的客戶端 (每張圖只做一次)"
+    if thumb_pool is None or store.blobs.get_thumb(row['image_hash']) is not None:
+        broadcast_image(row, raw, exclude=exclude, formats=('thumb',))
+        return
+    future = thumb_pool.submit(make_thumbnail, raw)
+    def done(future):
+        try:
+            thumb = future.result()
+            if thumb: store.blobs.put_thumb(row['image_hash'], thumb)
+        except Exception as e:
+            errors.inc('thumbnail')
+            print(f"縮圖失敗: {e}")
+        broadcast_image(row, raw, exclude=exclude, formats=('thumb',))
+    future.add_done_callback(done)
 
 # --- 讀取歷史訊息 ---
-def get_recent_messages(limit=10):
-    "讀取歷史訊息 (加入鎖保護)"
+def get_recent_messages(limit=10, room=DEFAULT_ROOM):
+    "讀取歷史訊息"
     messages = []
     try:
-        with db_lock:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            query = f"SELECT json_content FROM (SELECT json_content, id FROM messages ORDER BY id DESC LIMIT ?) ORDER BY id ASC"
-            c.execute(query, (limit,))
-            rows = c.fetchall()
-            messages = [row[0] for row in rows]
-            conn.close()
+        messages = store.recent(limit, room)
     except Exception as e:
+        errors.inc('db_read')
         print(f"讀取失敗: {e}")
     return messages
 
-# --- Type 6: 更新名單 ---
-def broadcast_user_list():
-    nicknames = [c['nickname'] for c in client_list]
-    msgdict = {'type': 6, 
-               'users': nicknames}
-    data = (json.dumps(msgdict) + '\n').encode('utf-8')
-    for client in client_list:
-        try: client['socket'].sendall(data)
-        except: pass
+def get_messages_after(room, after_id, limit):
+    "讀取失敗時回傳 None"
+    try:
+        return store.after(room, after_id, limit)
+    except Exception as e:
+        errors.inc('db_read')
+        print(f"讀取失敗: {e}")
+        return None
+
+def get_history_page(room, before, limit):
+    try:
+        return store.page(room, before, limit)
+    except Exception as e:
+        errors.inc('db_read')
+        print(f"讀取失敗: {e}")
+        return []
+
+def search_messages(room, query, sender=None):
+    try:
+        return store.search(room, query, sender)
+    except Exception as e:
+        errors.inc('db_read')
+        print(f"搜尋失敗: {e}")
+        return []
+
+# --- 封包編碼 ---
+def encode_packet(msgdict):
+    return (json.dumps(msgdict) + '\n').encode('utf-8')
+
+# --- 效能統計 (/stats 與 --metrics-port) ---
+# 每個封包只多一兩次計數 (一次 lock + 整數加法)，佇列長度等在查看時才計算
+metrics = Metrics()
+frames_in = metrics.counter('chat_frames_received_total', '收到的封包數', 'type')
+bytes_in = metrics.counter('chat_received_bytes_total', '收到的位元組數 (線路上的大小)')
+handle_seconds = metrics.histogram('chat_handle_seconds', '處理一個收到的封包所需時間', label='type')
+frames_out = metrics.counter('chat_frames_sent_total', '放進送出佇列的封包數 (一則廣播依收件人數計算)', 'type')
+frames_dropped = metrics.counter('chat_frames_dropped_total', '送出佇列已滿而丟掉的封包數')
+bytes_out = metrics.counter('chat_sent_bytes_total', '寫入 socket 的位元組數 (壓縮後)')
+write_seconds = metrics.histogram('chat_write_seconds', '一次合併寫入 (sendmsg / writelines + drain) 所需時間')
+db_commit_seconds = metrics.histogram('chat_db_commit_seconds', '資料庫每批寫入到 commit 完成的時間')
+db_batch_size = metrics.histogram('chat_db_batch_size', '每批 commit 的訊息數', SIZE_BUCKETS)
+login_replay_seconds = metrics.histogram('chat_login_replay_seconds', '登入時組出並放入歷史回放的時間')
+errors = metrics.counter('chat_errors_total', '錯誤次數 (connection / db_write / db_read / slow_client / thumbnail)', 'where')
+evictions = metrics.counter('chat_heartbeat_evictions_total', '沒有回應 ping 而中斷的連線數')
+throttles = metrics.counter('chat_throttled_total', '超過流量限制而暫停讀取的次數 (連續超過只算一次)')
+throttle_seconds = metrics.counter('chat_throttled_seconds_total', '因流量限制暫停讀取的總秒數')
+metrics.gauge('chat_clients_connected', '目前在線人數', lambda: len(clients))
+metrics.gauge('chat_clients_max', '在線人數上限 (--max-clients)', lambda: MAX_CLIENTS)
+metrics.gauge('chat_outbox_bytes', '所有連線送出佇列中的位元組數', lambda: sum(c.outbox.size for c in clients))
+metrics.gauge('chat_outbox_max_bytes', '送出佇列最長的連線佇列中的位元組數',
+              lambda: max((c.outbox.size for c in clients), default=0))
+metrics.gauge('chat_outbox_max_frames', '送出佇列最長的連線佇列中的封包數',
+              lambda: max((len(c.outbox.frames) + len(c.outbox.chunks) for c in clients), default=0))
+
+def type_label(msg_type):
+    "只用協定裡的 type 當 label，客戶端亂送的值歸到 other (label 種類不會無限增加)"
+    return msg_type if isinstance(msg_type, int) and 0 < msg_type < 100 else 'other'
+
+def record_commit(count, seconds, ok):
+    "MessageStore 的 on_commit (在 writer 執行緒上)"
+    if count:
+        db_commit_seconds.observe(seconds)
+        db_batch_size.observe(count)
+    if not ok: errors.inc('db_write')
+
+def record_write(frames, start):
+    write_seconds.observe(time.perf_counter() - start)
+    bytes_out.add(sum(map(len, frames)))
+
+def print_lines(lines):
+    "控制台輸出；多行程模式下加上 worker 編號，各 worker 的輸出混在一起也分得出來"
+    prefix = f'[worker {bus.worker_id}] ' if bus else ''
+    for line in lines:
+        print(prefix + line)
+
+# --- 量測 (/profile、/cprofile、/mem)，沒有下指令時不影響效能 ---
+profiler = Profiler(print_lines)
+
+def profiler_command(cmd):
+    "/profile [秒數]、/cprofile [秒數]、/mem start|snap|stop；控制台與 bus 共用"
+    name, _, arg = cmd.partition(' ')
+    if name == '/mem':
+        profiler.memory(arg.strip())
+        return
+    try:
+        seconds = float(arg) if arg.strip() else PROFILE_SECONDS
+    except ValueError:
+        print_lines([f"格式錯誤，請輸入: {name} 秒數"])
+        return
+    if name == '/profile': profiler.sample(seconds)
+    else: profiler.profile(seconds) # /cprofile
+
+def start_metrics_server(host, port):
+    try:
+        metrics.serve(host, port)
+        print(f"統計資料: http://{host}:{port}/metrics")
+    except OSError as e:
+        print(f"無法開啟統計資料的 port {port}: {e}")
+
+# --- 送出佇列 ---
+class Outbox:
+    """每個連線一個有上限的送出佇列，由該連線自己的 writer 取出並寫入 socket。
+    廣播的人只負責放進佇列，不會被收得慢的客戶端卡住。"""
+
+    def __init__(self, wakeup):
+        self.frames = deque() # (data, kind)，文字與整張圖片
+        self.chunks = deque() # 圖片分段，排在文字後面慢慢送
+        self.size = 0         # 佇列中的位元組數
+        self.lock = threading.Lock()
+        self.wakeup = wakeup  # 通知 writer 有新資料
+        self.closed = False
+        self.flush_on_close = True
+        self.dropped = 0
+        self.deflater = None  # 協商壓縮後才建立，只有 writer 會用到
+
+    def enable_compression(self):
+        if self.deflater is None:
+            self.deflater = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, COMPRESS_WBITS, COMPRESS_MEMLEVEL)
+
+    def put(self, data, kind=TEXT):
+        """放入一個封包；回傳 False 代表依照 disconnect 政策應中斷此連線"""
+        return self.extend([(data, kind)])
+
+    def extend(self, frames):
+        """一次放入多個封包 (只喚醒 writer 一次，讓它們合併成一次寫入)"""
+        with self.lock:
+            if self.closed: return True
+            for data, kind in frames:
+                if self.is_full(len(data)):
+                    if not self.make_room(len(data)): return False
+                lane = self.chunks if kind == CHUNK else self.frames
+                lane.append((data, kind))
+                self.size += len(data)
+        self.wakeup()
+        return True
+
+    def make_room(self, incoming):
+        "佇列已滿時依照 SLOW_CLIENT_POLICY 騰出空間 (呼叫時需持有 lock)"
+        if SLOW_CLIENT_POLICY == 'disconnect':
+            return False
+        if SLOW_CLIENT_POLICY == 'drop_images':
+            # 先丟最舊的圖片 (分段優先)，文字訊息盡量保留
+            while self.chunks and self.is_full(incoming):
+                self.drop(self.chunks)
+            for frame in list(self.frames):
+                if not self.is_full(incoming): break
+                if frame[1] == IMAGE:
+                    self.frames.remove(frame)
+                    self.size -= len(frame[0])
+                    self.dropped += 1
+                    frames_dropped.inc()
+        # drop_oldest (或沒有圖片可丟時)：從最舊的開始丟
+        while (self.frames or self.chunks) and self.is_full(incoming):
+            self.drop(self.frames if self.frames else self.chunks)
+        return True
+
+    def drop(self, lane):
+        data, _ = lane.popleft()
+        self.size -= len(data)
+        self.dropped += 1
+        frames_dropped.inc()
+
+    def is_full(self, incoming):
+        return (len(self.frames) + len(self.chunks) >= OUTBOX_MAX_FRAMES
+                or self.size + incoming > OUTBOX_MAX_BYTES)
+
+    def take_all(self):
+        """取出所有文字封包，再加上最多 CHUNK_BURST 的圖片分段；
+        剩下的分段留到下一輪，期間新來的文字會先送"""
+        with self.lock:
+            frames = list(self.frames)
+            self.frames.clear()
+            budget = CHUNK_BURST
+            while self.chunks and budget > 0:
+                frame = self.chunks.popleft()
+                frames.append(frame)
+                budget -= len(frame[0])
+            self.size -= sum(len(data) for data, _ in frames)
+        if self.deflater is None:
+            return [data for data, _ in frames]
+        return self.compress(frames) # 在 writer 上壓縮，不佔用 lock
+
+    def compress(self, frames):
+        """連續的文字封包合成一個壓縮區塊 (只 flush 一次)；
+        圖片與分段本身是 JPEG/PNG (json 時再包一層 base64)，壓縮效益低，原樣送出"""
+        out, run = [], []
+        for data, kind in frames:
+            if kind == TEXT:
+                run.append(data)
+                continue
+            if run:
+                out.append(self.deflate(run))
+                run = []
+            out.append(data)
+        if run: out.append(self.deflate(run))
+        return out
+
+    def deflate(self, run):
+        block = self.deflater.compress(b''.join(run)) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        return ZLIB_MARK + len(block).to_bytes(4, 'big') + block
+
+    def close(self, flush=True):
+        "flush=True 時 writer 會先送完佇列再關閉連線"
+        with self.lock:
+            self.closed = True
+            self.flush_on_close = flush
+            if not flush:
+                self.frames.clear()
+                self.chunks.clear()
+                self.size = 0
+        self.wakeup()
+
+# --- 流量限制 ---
+class TokenBucket:
+    """每秒回補 rate、最多累積 burst。可以扣成負的：超過額度的那個封包照常處理，
+    由呼叫的人暫停讀取，等額度回到 0 以上"""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def charge(self, amount, now):
+        "扣掉 amount，回傳要等幾秒額度才回到 0 以上 (0 = 不必等；rate 為 0 時不限制)"
+        if not self.rate: return 0
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate) - amount
+        self.stamp = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+# --- 連線與名單 ---
+class Session:
+    """一條連線的狀態 (兩種引擎共用)。用 __slots__ 讓上萬條連線也不佔太多記憶體"""
+    __slots__ = ('nickname', 'features', 'rooms', 'codec', 'socket', 'outbox', 'writer', 'loop',
+                 'last_seen', 'ping_sent', 'frame_bytes', 'messages', 'text_bytes', 'image_bytes',
+                 'throttled_until', 'resume_token', 'pending')
+
+    def __init__(self, sock, outbox, writer=None, loop=None):
+        self.nickname = ''       # 登入 (type 1) 前為空字串
+        self.features = set()
+        self.rooms = set()       # 加入的房間，由 SessionRegistry 維護
+        self.codec = JSON        # 送出用的編碼，登入時協商
+        self.socket = sock
+        self.outbox = outbox
+        self.writer = writer     # asyncio 引擎才有
+        self.loop = loop
+        self.last_seen = time.monotonic() # 最後一次收到封包的時間
+        self.ping_sent = 0                # 送出尚未得到回應的 ping 的時間
+        self.frame_bytes = 0              # 剛讀到的封包在線路上的大小
+        self.messages = TokenBucket(RATE_MESSAGES, RATE_MESSAGES * RATE_BURST)
+        self.text_bytes = TokenBucket(RATE_TEXT_BYTES, RATE_TEXT_BYTES * RATE_BURST)
+        self.image_bytes = TokenBucket(RATE_IMAGE_BYTES, RATE_IMAGE_BURST)
+        self.throttled_until = 0          # 最近一次暫停讀取到這個時間
+        self.resume_token = None          # 登入時發給支援 resume 的客戶端，重新連線時憑此接手
+        self.pending = None               # asyncio 引擎：交給執行緒池、還沒做完的處理 (見 defer)
+
+    def received(self, nbytes):
+        "chat_codec 讀完一個框時呼叫"
+        self.frame_bytes = nbytes
+        bytes_in.add(nbytes)
+
+class SessionRegistry:
+    """已登入的連線，依暱稱或 socket 查詢都是 O(1)。
+    修改時由 lock 保護並重建 sessions，廣播直接走訪這份唯讀的 tuple，不必複製也不必上鎖。
+    rooms: 房間 -> 成員 tuple，房間內廣播只走訪成員，成本與房間人數成正比。
+    每次名單變動 seq 加一，on_change(op, nickname, seq) 在 lock 內呼叫，所以通知的順序與 seq 一致。
+    房間第一個人進入 / 最後一個人離開時呼叫 on_room(room, active)。
+    remote: 聯邦模式下其他節點的使用者 (暱稱 -> 節點)，一起編入 seq 與名單；
+    只有本節點的連線變動才另外呼叫 on_local(op, nickname) 通知其他節點"""
+
+    def __init__(self, on_change=None, on_room=None):
+        self.by_name = {}
+        self.by_socket = {}
+        self.sessions = ()
+        self.rooms = {}
+        self.remote = {}
+        self.seq = 0
+        self.on_change = on_change
+        self.on_room = on_room
+        self.on_local = None
+        self.lock = threading.Lock()
+
+    def add(self, session, nickname):
+        "登入；暱稱已被其他連線使用時回傳 False"
+        with self.lock:
+            owner = self.by_name.get(nickname)
+            if owner is not None and owner is not session or nickname in self.remote:
+                return False
+            if self.by_name.get(session.nickname) is session: # 同一條連線重新登入
+                del self.by_name[session.nickname]
+            if session.nickname: self.changed('leave', session.nickname, local=True)
+            session.nickname = nickname
+            self.by_name[nickname] = session
+            self.by_socket[session.socket] = session
+            self.sessions = tuple(self.by_name.values())
+            self.changed('join', nickname, local=True)
+            return True
+
+    def remove(self, session):
+        "回傳 True 代表這次呼叫真的移除了 (踢人與斷線只會有一方廣播離開)"
+        with self.lock:
+            if self.by_name.get(session.nickname) is not session:
+                return False
+            del self.by_name[session.nickname]
+            self.by_socket.pop(session.socket, None)
+            self.sessions = tuple(self.by_name.values())
+            for room in list(session.rooms):
+                self.leave_room(session, room)
+            self.changed('leave', session.nickname, local=True)
+            return True
+
+    def replace(self, old, new):
+        """同一個使用者換了一條連線：new 接手 old 的暱稱與房間。
+        名單沒有變化，seq 不動也不通知，其他人看不到離開/加入"""
+        with self.lock:
+            if self.by_name.get(old.nickname) is not old:
+                return False
+            new.nickname = old.nickname
+            new.rooms, old.rooms = old.rooms, set()
+            self.by_name[new.nickname] = new
+            self.by_socket.pop(old.socket, None)
+            self.by_socket[new.socket] = new
+            self.sessions = tuple(self.by_name.values())
+            for room in new.rooms:
+                self.rooms[room] = tuple(new if s is old else s for s in self.rooms[room])
+            return True
+
+    def add_remote(self, nickname, node):
+        "其他節點的使用者登入 (重複通知時不再變動)"
+        with self.lock:
+            if nickname in self.remote or nickname in self.by_name: return
+            self.remote[nickname] = node
+            self.changed('join', nickname)
+
+    def remove_remote(self, nickname):
+        with self.lock:
+            if self.remote.pop(nickname, None) is not None:
+                self.changed('leave', nickname)
+
+    def set_remote(self, node, users):
+        "某節點送來完整名單：先移除它原本的使用者，再逐一加入"
+        self.drop_node(node)
+        for nickname in users:
+            self.add_remote(nickname, node)
+
+    def drop_node(self, node):
+        with self.lock:
+            for nickname in [n for n, owner in self.remote.items() if owner == node]:
+                del self.remote[nickname]
+                self.changed('leave', nickname)
+
+    def join_room(self, session, room):
+        "回傳 False 代表已經在房間裡 (或尚未登入)"
+        with self.lock:
+            if room in session.rooms or self.by_name.get(session.nickname) is not session:
+                return False
+            session.rooms.add(room)
+            members = self.rooms.get(room, ())
+            self.rooms[room] = members + (session,)
+            if not members and self.on_room: self.on_room(room, True)
+            return True
+
+    def leave_room(self, session, room):
+        "不上鎖，呼叫端 (remove / leave) 要先持有 lock"
+        if room not in session.rooms: return False
+        session.rooms.discard(room)
+        members = tuple(s for s in self.rooms.get(room, ()) if s is not session)
+        if members: self.rooms[room] = members
+        else:
+            self.rooms.pop(room, None) # 沒人的房間不保留
+            if self.on_room: self.on_room(room, False)
+        return True
+
+    def leave(self, session, room):
+        with self.lock:
+            return self.leave_room(session, room)
+
+    def members(self, room):
+        return self.rooms.get(room, ())
+
+    def room_names(self):
+        return sorted(self.rooms)
+
+    def changed(self, op, nickname, local=False):
+        self.seq += 1
+        if self.on_change: self.on_change(op, nickname, self.seq)
+        if local and self.on_local: self.on_local(op, nickname)
+
+    def snapshot(self):
+        "(seq, 暱稱列表)，兩者一致"
+        with self.lock:
+            return self.seq, [s.nickname for s in self.sessions] + list(self.remote)
+
+    def get(self, nickname):
+        return self.by_name.get(nickname)
+
+    def find_socket(self, sock):
+        return self.by_socket.get(sock)
+
+    def nicknames(self):
+        return [s.nickname for s in self.sessions]
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(self.sessions)
+
+# --- 傳送給單一客戶端 ---
+def send_to(client, data, kind=TEXT):
+    """放進該連線的送出佇列；佇列滿且政策為 disconnect 時中斷連線"""
+    send_many(client, [(data, kind)])
+
+def send_many(client, frames):
+    "frames: [(data, kind), ...]，例如登入時的回放；json 行依這個連線的編碼轉換"
+    for data, _ in frames:
+        frames_out.inc(type_label(frame_type(data)))
+    enqueue(client, frames)
+
+def enqueue(client, frames):
+    "send_many 不計入統計的部分 (deliver 一則廣播只計一次)"
+    if client.codec is not JSON:
+        frames = [(client.codec.wrap(data), kind) for data, kind in frames]
+    if not client.outbox.extend(frames):
+        errors.inc('slow_client')
+        print(f"[{client.nickname}] 接收過慢，中斷連線")
+        close_client(client, flush=False)
+
+# --- 合併寫入 ---
+def send_frames(sock, frames):
+    """用 sendmsg (writev) 把多個封包合成一次系統呼叫送出，並處理只送出一部分的情況"""
+    if not hasattr(sock, 'sendmsg'): # Windows 沒有 sendmsg
+        sock.sendall(b''.join(frames))
+        return
+    views = [memoryview(data) for data in frames]
+    i = 0
+    while i < len(views):
+        sent = sock.sendmsg(views[i:i + IOV_MAX])
+        while sent:
+            n = views[i].nbytes
+            if sent >= n:
+                sent -= n
+                i += 1
+            else:
+                views[i] = views[i][sent:]
+                sent = 0
+
+def running_in(loop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+# --- 會阻塞的處理 (資料庫讀取、hub 往返、磁碟 I/O) ---
+def defer(client, func, *args):
+    """thread 引擎直接在這條連線的執行緒上呼叫 func(*args)。
+    asyncio 引擎交給執行緒池，event loop 不會被卡住 (其他連線照常收送)；
+    讀取迴圈等它完成才讀下一個封包，同一條連線的封包仍依序處理。func 裡只能用 thread-safe 的函式"""
+    loop = client.loop
+    if loop is None or not running_in(loop):
+        func(*args)
+        return
+    client.pending = loop.run_in_executor(None, profiler.run, func, *args) # 執行緒池上的處理也列入 /cprofile
+
+# --- 關閉單一客戶端 ---
+def close_client(client, flush=True):
+    """關閉連線；reader 收到 EOF 後會走正常的離線清理"""
+    client.outbox.close(flush)
+    if flush: return
+    writer = client.writer
+    if writer is None:
+        # thread 引擎：writer 可能正卡在 sendall，直接 shutdown 讓兩邊都醒來
+        try: client.socket.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+    elif running_in(client.loop):
+        writer.transport.abort()
+    else:
+        client.loop.call_soon_threadsafe(writer.transport.abort)
+
+# --- 廣播 ---
+def broadcast(data, exclude=None, kind=TEXT, room=None, archive=False):
+    """room 為 None 時送給所有人 (系統公告)，否則只送給該房間的成員。
+    多行程模式下同時轉給其他 worker，archive 代表對方也要放進歷史環"""
+    deliver(data, exclude, kind, room)
+    if bus: bus.send({'op': 'frame', 'room': room, 'kind': kind, 'archive': archive}, data)
+
+def deliver(data, exclude=None, kind=TEXT, room=None):
+    "只送給這個行程裡的連線；binary 客戶端共用同一份轉換後的 bytes"
+    wrapped = None
+    sent = 0
+    for client in (clients if room is None else clients.members(room)):
+        if client is exclude: continue
+        if client.codec is BINARY:
+            if wrapped is None: wrapped = BINARY.wrap(data)
+            enqueue(client, [(wrapped, kind)])
+        else:
+            enqueue(client, [(data, kind)])
+        sent += 1
+    if sent: frames_out.inc(type_label(frame_type(data)), sent)
+
+# --- Type 6: 名單變動 ---
+def publish_presence(op, nickname, seq):
+    """只送出差異 {op: join/leave, nickname, seq}；由 registry 在 lock 內呼叫
+    (多行程模式下由 hub 依序送來)。
+    剛登入的人另外收到完整名單 (presence_packet)，不支援差異的舊客戶端每次收到完整名單"""
+    delta = encode_packet({'type': 6, 'op': op, 'nickname': nickname, 'seq': seq})
+    full = None
+    for client in clients:
+        if client.nickname == nickname and op == 'join': continue
+        if 'presence_delta' in client.features:
+            send_to(client, delta)
+        else:
+            if full is None:
+                users = list(roster.users) if roster else [c.nickname for c in clients] + list(clients.remote)
+                full = encode_packet({'type': 6, 'users': users})
+            send_to(client, full)
+
+def presence_packet():
+    "完整名單，登入時或客戶端發現 seq 跳號 (type 16) 時送出"
+    seq, nicknames = (roster or clients).snapshot()
+    return encode_packet({'type': 6, 'users': nicknames, 'seq': seq})
+
+clients = SessionRegistry(on_change=publish_presence)
         
 # --- 踢人處理 ---
 def kick_client_by_name(target_name):
-    global client_list
-    target_client = next((c for c in client_list if c['nickname'] == target_name), None)
+    target_client = clients.get(target_name)
     if target_client:
         print(f"踢除: {target_name}")
         try:
@@ -85,24 +913,19 @@ def kick_client_by_name(target_name):
             'message': '你已被踢出聊天室',
             'action': 'kick' 
         }
-            target_client['socket'].sendall((json.dumps(kick_packet) + '\n').encode('utf-8'))
-            time.sleep(0.1)
-            target_client['socket'].close()
+            send_to(target_client, encode_packet(kick_packet))
+            close_client(target_client) # 送完踢除通知後才關閉
             
         except :
             pass
             
             
-        if target_client in client_list: client_list.remove(target_client)
-        broadcast_user_list()
+        if not clients.remove(target_client): return # 已經自行離線
         
         sys_msg = {'type': 5, 
                    'nickname': '系統', 
                    'message': f'{target_name} 已被踢出'}
-        data = (json.dumps(sys_msg)+'\n').encode('utf-8')
-        for c in client_list:
-            try: c['socket'].sendall(data)
-            except: pass
+        broadcast(encode_packet(sys_msg))
             
 # --- 管理員控制台 ---
 def admin_console():
@@ -111,6 +934,10 @@ def admin_console():
     print("--- 管理員控制台啟動 ---")
     print("指令: /kick <名字>  (踢人)")
     print("指令: /list         (查看名單)")
+    print("指令: /stats        (效能統計)")
+    print("指令: /profile [秒數]   (取樣所有執行緒，找出耗 CPU 的函式)")
+    print("指令: /cprofile [秒數]  (以 cProfile 量測協定處理)")
+    print("指令: /mem start|snap|stop (tracemalloc 記憶體快照，snap 會與上一次比較)")
     print("指令: /stop         (關閉伺服器)")
     
     while True:
@@ -124,18 +951,17 @@ def admin_console():
                 else:
                     print("格式錯誤，請輸入: /kick 名字")
             if cmd == '/list':
-                print([c['nickname'] for c in client_list])
+                print(clients.nicknames())
+            if cmd == '/stats':
+                print_lines(metrics.summary())
+            if cmd.split(' ', 1)[0] in ('/profile', '/cprofile', '/mem'):
+                profiler_command(cmd)
             if cmd == '/stop':
                 print("正在清除歷史紀錄...")
-                # 連線資料庫並刪除所有資料
-                with db_lock:
-                    conn = sqlite3.connect(DB_NAME)
-                    c = conn.cursor()
-                    c.execute("DELETE FROM messages") # 刪除所有訊息
-                   
-                    conn.commit()
-                    conn.close()
-                    print("歷史紀錄已清除。")
+                # 先把寫入佇列送完，再刪除所有訊息
+                store.clear()
+                history.clear()
+                print("歷史紀錄已清除。")
                 
                 print("正在關閉伺服器...")
                 # 1. 廣播通知
@@ -144,166 +970,929 @@ def admin_console():
                            'message': '伺服器即將關閉，請自行離線。',
                            'action': 'shutdown'
                         }
-                data = (json.dumps(sys_msg)+'\n').encode('utf-8')
-                for c in client_list:
-                    try: c['socket'].sendall(data)
-                    except: pass
+                broadcast(encode_packet(sys_msg))
+                time.sleep(0.5) # 讓各連線的 writer 有時間把通知送出
                 
                 # 2. 強制結束程式 (包含所有執行緒)
                 print("伺服器關閉。")
                 os._exit(0)
             
+        except EOFError:
+            # 背景執行 (沒有 stdin) 時不再讀取指令
+            return
         except Exception as e:
             print(f"Console Error: {e}")
 
-def recv_message(new_sock, sockname):
-    global client_list
-    nickname = ''
+# --- 協定處理 (兩種引擎共用) ---
+def login(client, message):
+    "Type 1 的處理；asyncio 引擎在執行緒池上執行 (見 defer)"
+    nickname = message['nickname']
+    # 客戶端宣告支援的功能 (舊客戶端沒有這個欄位)
+    client.features = set(message.get('features', [])) & set(SERVER_FEATURES)
+    # 之後 (包含 type 2 回覆) 送出的文字都可能是壓縮區塊；客戶端宣告 zlib 時已準備好解壓
+    if 'zlib' in client.features: client.outbox.enable_compression()
+    resumed = take_over(client, nickname, message.get('resume_token'))
+    if not resumed:
+        if not claim_nickname(client, nickname) or not clients.add(client, nickname):
+            print(f"拒絕登入 {nickname}: 暱稱已被使用")
+            send_to(client, name_taken_packet(nickname))
+            close_client(client) # 送完通知後才關閉
+            return
+        clients.join_room(client, DEFAULT_ROOM) # 登入後先進大廳
+    welcome = {'type': 2, 'features': sorted(client.features)}
+    if 'heartbeat' in client.features:
+        welcome.update(ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT) # 客戶端用同樣的間隔偵測伺服器
+        timers.add(PING_INTERVAL, check_heartbeat, client)
+    else:
+        enable_keepalive(client.socket) # 舊客戶端不會回 pong，改由核心偵測
+
+    # 回放歷史紀錄 (歷史環裡已是帶 is_history 標籤的封包，不必查資料庫)；
+    # 重新連線且帶了 last_id 時只補漏掉的那一段，客戶端依 resumed 決定要不要清空畫面
+    start = time.perf_counter()
+    frames = None
+    if DEFAULT_ROOM not in client.rooms: frames = [] # 接手的連線已離開大廳
+    elif message.get('last_id') is not None: frames = resume_frames(client, DEFAULT_ROOM, int(message['last_id']))
+    if 'resume' in client.features:
+        client.resume_token = secrets.token_urlsafe(16) # 每次登入換新，用過的不能再接手
+        welcome.update(resume_token=client.resume_token, resumed=frames is not None)
+    send_to(client, encode_packet(welcome))
+    if 'binary' in client.features: client.codec = BINARY # type 2 仍是 json，之後才切換
+    send_many(client, history_frames(client) if frames is None else frames) # 整段回放合併成一次寫入
+    login_replay_seconds.observe(time.perf_counter() - start)
+
+    send_to(client, presence_packet()) # 其他人已在 add() 時收到差異
+    if resumed:
+        print(f'{nickname} 重新連線')
+        return
+
+    sys_msg = {'type': 5,
+               'nickname': '系統',
+               'room': DEFAULT_ROOM,
+               'message': f'{nickname} 加入了聊天室'}
+    broadcast(encode_packet(sys_msg), room=DEFAULT_ROOM)
+
+def enter_room(client, room, last_id):
+    "Type 17 的處理；asyncio 引擎在執行緒池上執行"
+    # 重新連線後回到原本的房間時帶 last_id；接手的連線已經在房間裡，只補漏掉的訊息
+    joined = clients.join_room(client, room)
+    if not joined and (last_id is None or room not in client.rooms): return
+    frames = None if last_id is None else resume_frames(client, room, int(last_id))
+    reply = {'type': 17, 'room': room, 'rooms': clients.room_names()}
+    if last_id is not None: reply['resumed'] = frames is not None
+    send_to(client, encode_packet(reply))
+    send_many(client, history_frames(client, room) if frames is None else frames)
+    if not joined: return
+    sys_msg = {'type': 5,
+               'nickname': '系統',
+               'room': room,
+               'message': f'{client.nickname} 進入了 #{room}'}
+    broadcast(encode_packet(sys_msg), exclude=client, room=room)
+
+def send_full_image(client, message):
+    "Type 14 的處理；asyncio 引擎在執行緒池上執行"
+    raw = store.blobs.get(message['hash'])
+    if raw is None:
+        send_to(client, encode_packet({'type': 15, 'hash': message['hash'], 'error': 'not_found'}))
+    elif 'chunked_images' in client.features:
+        send_many(client, chunk_frames({'hash': message['hash'], 'fetch': True}, raw, message.get('from', 0),
+                                       codec=client.codec))
+    else:
+        # --- Type 15: 原圖 (不支援分段的客戶端) ---
+        reply = {'type': 15, 'hash': message['hash'], 'image_data': raw}
+        send_to(client, client.codec.encode(reply), IMAGE)
+
+def history_page(client, room, before, limit):
+    "Type 19 的處理，回覆 type 20；asyncio 引擎在執行緒池上執行"
+    rows = get_history_page(room, before, limit + 1) # 多讀一則判斷還有沒有更舊的
+    page = []
+    for msg_id, json_str in reversed(rows[:limit]):
+        msg = json.loads(json_str)
+        msg['id'] = msg_id
+        page.append(msg) # 圖片只有雜湊與寬高，客戶端點開時再以 type 14 索取
+    # --- Type 20: 一頁歷史 (舊到新) ---
+    send_to(client, encode_packet({'type': 20, 'room': room, 'messages': page, 'more': len(rows) > limit}))
+
+def search_page(client, room, query, sender, limit, offset):
+    "Type 21 的處理，回覆 type 22；asyncio 引擎在執行緒池上執行"
+    hits = search_messages(room, query, sender)
+    results = []
+    for msg_id, json_str in hits[offset:offset + limit]:
+        msg = json.loads(json_str)
+        msg['id'] = msg_id
+        results.append(msg)
+    # --- Type 22: 搜尋結果 ---
+    send_to(client, encode_packet({'type': 22, 'room': room, 'query': query, 'offset': offset,
+                                   'results': results, 'more': len(hits) > offset + limit}))
+
+def handle_message(client, message):
+    """處理一個已解析的封包，client 為此連線的 Session"""
+    # --- Type 1: 登入 (多行程模式要等 hub 確認暱稱，重新連線可能要讀資料庫，不在 event loop 上做) ---
+    if message['type'] == 1:
+        defer(client, login, client, message)
+
+    # --- Type 3 :訊息處理 ---
+    if message['type'] == 3:
+        # 1. 回傳 Type 4 給發送者
+        send_to(client, encode_packet({'type': 4}))
+        room = message.get('room', DEFAULT_ROOM)
+        if room not in client.rooms: return # 不在房間裡不能發言
+
+        # 2. 準備轉發給其他人的 Type 5 封包
+        # 取得當前時間並格式化
+        current_time = datetime.now().strftime('%Y/%m/%d %H:%M')
+
+        # --- Type 5 :廣播訊息 ---
+        msgdict = {
+            'type': 5,
+            'nickname': message['nickname'],
+            'room': room,
+            'message': message['message'],
+            'time': current_time  # 將時間加入封包
+        }
+        if federation: federation.stamp(msgdict) # 全域唯一的 uid，其他節點以此去重
+        data = archive_message(msgdict)
+
+        # 廣播給房間裡的其他人
+        broadcast(data, exclude=client, room=room, archive=True)
+        if federation: federation.publish('msg', msgdict['uid'], packet=msgdict)
+
+    # --- Type 7: 私訊 ---
+    if message['type'] == 7:
+        message['time'] = datetime.now().strftime('%Y/%m/%d %H:%M')
+        target = message['target']
+
+        other = clients.get(target)
+        if other is not None:
+            send_to(other, encode_packet(message))
+        elif bus: # 對方可能在其他 worker
+            bus.send({'op': 'private', 'target': target}, encode_packet(message))
+        elif federation and target in clients.remote: # 只送給對方所在的節點
+            federation.send_to(clients.remote[target], 'private', federation.stamp(message), packet=message)
+
+    # --- Type 9: 收到圖片訊息 ---
+    if message['type'] == 9:
+        room = message.get('room', DEFAULT_ROOM)
+        if room not in client.rooms: return
+        raw = blob(message, 'image_data')
+        b64 = message['image_data'] if isinstance(message['image_data'], str) else None
+        defer(client, publish_image, client, message['nickname'], raw, b64, room) # 雜湊與寫入磁碟
+
+    # --- Type 10: 分段上傳開始 (同一個 id 再送一次代表接續上傳) ---
+    if message['type'] == 10:
+        defer(client, begin_upload, client, message) # 查 BlobStore 是否已有這張圖
+
+    # --- Type 11: 分段資料 ---
+    if message['type'] == 11:
+        send_to(client, encode_packet(receive_chunk(client, message)))
+
+    # --- Type 12: 分段上傳結束 ---
+    if message['type'] == 12:
+        defer(client, finish_upload, client, message) # 核對雜湊、多行程模式下寫入磁碟
+
+    # --- Type 14: 點開縮圖時索取原圖 (from: 從第幾段開始，用於接續) ---
+    if message['type'] == 14:
+        defer(client, send_full_image, client, message) # 讀取原圖並切段
+
+    # --- Type 16: 名單 seq 跳號時重新索取完整名單 ---
+    if message['type'] == 16:
+        send_to(client, presence_packet())
+
+    # --- Type 17: 加入房間 (回覆目前的房間列表，並回放該房間的歷史) ---
+    if message['type'] == 17:
+        room = str(message.get('room', '')).strip()[:ROOM_NAME_MAX]
+        if not room: return
+        defer(client, enter_room, client, room, message.get('last_id')) # 回放可能要讀資料庫
+
+    # --- Type 18: 離開房間 ---
+    if message['type'] == 18:
+        room = message.get('room')
+        if not clients.leave(client, room): return
+        send_to(client, encode_packet({'type': 18, 'room': room}))
+        sys_msg = {'type': 5,
+                   'nickname': '系統',
+                   'room': room,
+                   'message': f'{client.nickname} 離開了 #{room}'}
+        broadcast(encode_packet(sys_msg), room=room)
+
+    # --- Type 19: 往前翻歷史 (以訊息 id 為游標，before 為客戶端目前最舊的一則) ---
+    if message['type'] == 19:
+        room = message.get('room', DEFAULT_ROOM)
+        if room not in client.rooms: return
+        limit = max(1, min(int(message.get('limit', HISTORY_PAGE_SIZE)), HISTORY_PAGE_SIZE))
+        defer(client, history_page, client, room, message.get('before'), limit) # 查資料庫
+
+    # --- Type 23: 客戶端的 ping，回覆 Type 24 (收到 pong 不必處理，last_seen 已更新) ---
+    if message['type'] == 23:
+        send_to(client, PONG_PACKET)
+
+    # --- Type 25: 客戶端主動結束 (關閉視窗)：不保留名額，馬上廣播離開 ---
+    if message['type'] == 25:
+        client.resume_token = None # remove_client 看到沒有 token 就不等 RESUME_GRACE
+        close_client(client)
+
+    # --- Type 21: 搜尋房間裡的訊息 (依相關度排序，以 offset 分頁) ---
+    if message['type'] == 21:
+        room = message.get('room', DEFAULT_ROOM)
+        if room not in client.rooms: return
+        query = str(message.get('query', ''))
+        limit = max(1, min(int(message.get('limit', SEARCH_PAGE_SIZE)), SEARCH_PAGE_SIZE))
+        offset = max(0, int(message.get('offset', 0)))
+        defer(client, search_page, client, room, query, message.get('sender'), limit, offset) # 全文搜尋與排序
+
+def publish_image(client, nickname, raw, b64=None, room=DEFAULT_ROOM):
+    "存檔並廣播一張圖片 (type 9 與分段上傳共用)"
+    current_time = datetime.now().strftime('%Y/%m/%d %H:%M')
+    # 資料庫只存雜湊、大小與寬高，圖片存進 BlobStore (相同的圖只存一次)
+    digest = store.blobs.add(raw)
+    row = {'type': 9,
+           'nickname': nickname,
+           'room': room,
+           **image_ref(digest, raw),
+           'time': current_time}
+    if federation: federation.stamp(row)
+    archive_image(row, digest)
+    if bus: store.blobs.write(digest) # 其他 worker 要從磁碟讀取，不能等 writer 批次寫入
+
+    # 廣播給其他人：舊客戶端馬上收到原圖，支援縮圖的客戶端等縮圖做好再送
+    broadcast_image(row, raw, exclude=client, b64=b64, formats=('chunked', 'legacy'), archive=True)
+    request_thumbnail(row, raw, exclude=client)
+    if federation: federation.publish('image', row['uid'], row=row) # 原圖在送出時才從 BlobStore 附上
+
+# --- 分段上傳 ---
+uploads = {} # (暱稱, 上傳 id) -> 上傳狀態，使用者離線時丟棄
+uploads_lock = threading.Lock()
+
+def begin_upload(client, message):
+    """回覆下一個需要的分段編號；已有相同雜湊的圖片時直接跳到最後 (不必再傳)。
+    asyncio 引擎在執行緒池上執行 (見 defer)"""
+    key = (client.nickname, message['id'])
+    now = time.monotonic()
+    known = store.blobs.exists(message['hash']) # 只看檔案在不在，不讀內容，也不佔著 uploads_lock
+    with uploads_lock:
+        for old in [k for k, u in uploads.items() if now - u['updated'] > UPLOAD_TTL]:
+            del uploads[old]
+        upload = uploads.get(key)
+        if upload is None:
+            error = None
+            if message['size'] > MAX_IMAGE_BYTES:
+                error = 'too_large'
+            elif sum(1 for nickname, _ in uploads if nickname == client.nickname) >= MAX_UPLOADS:
+                error = 'busy' # 客戶端等其他張傳完再重送 type 10
+            if error:
+                send_to(client, encode_packet({'type': 13, 'id': message['id'], 'error': error}))
+                return
+            upload = {'size': message['size'],
+                      'hash': message['hash'],
+                      'chunk_size': message.get('chunk_size', CHUNK_SIZE),
+                      'data': bytearray(),
+                      'next': 0,
+                      'known': known,
+                      'room': message.get('room', DEFAULT_ROOM),
+                      'time': message.get('time')}
+            uploads[key] = upload
+        upload['updated'] = now
+        if upload['known']:
+            next_seq = -(-upload['size'] // upload['chunk_size']) # 伺服器已有這張圖
+        else:
+            next_seq = upload['next']
+    send_to(client, encode_packet({'type': 13, 'id': message['id'], 'next': next_seq}))
+
+def receive_chunk(client, message):
+    key = (client.nickname, message['id'])
+    with uploads_lock:
+        upload = uploads.get(key)
+        if upload is None:
+            return {'type': 13, 'id': message['id'], 'error': 'unknown'}
+        if message['seq'] == upload['next']:
+            chunk = blob(message, 'data')
+            if len(upload['data']) + len(chunk) > upload['size']: # 超過宣告的大小 (begin 時已確認不超過上限)
+                del uploads[key]
+                return {'type': 13, 'id': message['id'], 'error': 'too_large'}
+            upload['data'] += chunk
+            upload['next'] += 1
+            upload['updated'] = time.monotonic()
+        # 重複或跳號的分段不收，回報目前進度讓客戶端從這裡接續
+        return {'type': 13, 'id': message['id'], 'next': upload['next']}
+
+def drop_uploads(nickname):
+    "使用者離線：丟掉他還沒傳完的圖片"
+    with uploads_lock:
+        for key in [key for key in uploads if key[0] == nickname]:
+            del uploads[key]
+
+def finish_upload(client, message):
+    key = (client.nickname, message['id'])
+    with uploads_lock:
+        upload = uploads.pop(key, None)
+    if upload is None:
+        send_to(client, encode_packet({'type': 13, 'id': message['id'], 'error': 'unknown'}))
+        return
+    raw = store.blobs.get(upload['hash']) if upload['known'] else bytes(upload['data'])
+    if raw is None or len(raw) != upload['size'] or hashlib.sha256(raw).hexdigest() != upload['hash']:
+        reply = {'type': 13, 'id': message['id'], 'error': 'hash'}
+    else:
+        if upload['room'] in client.rooms: # 上傳途中離開了房間就不發布
+            publish_image(client, client.nickname, raw, room=upload['room'])
+        reply = {'type': 13, 'id': message['id'], 'done': True}
+    send_to(client, encode_packet(reply))
+
+def handle_packet(client, message):
+    "兩種引擎的讀取迴圈呼叫這裡：handle_message 加上收到的封包數與處理時間"
+    msg_type = type_label(message.get('type'))
+    frames_in.inc(msg_type)
+    client.last_seen = time.monotonic() # 任何封包都代表連線還活著
+    start = time.perf_counter()
     try:
-        while True:
-            f = new_sock.makefile(encoding='utf-8')
-            text = f.readline()
-            if not text: break
-            
-            message = json.loads(text)
-            
-            # --- Type 1: 登入 ---
-            if message['type'] == 1:
-                nickname = message['nickname']   
-                client_list.append({'nickname': nickname, 'socket': new_sock})
-                new_sock.sendall((json.dumps({'type': 2}) + '\n').encode('utf-8'))
-                time.sleep(0.05)
-                
-                # 回放歷史紀錄 (加入 is_history 標籤)
-                recent_history = get_recent_messages(MAX_HISTORY_SEND)
-                for json_str in recent_history:
-                    # 需要把儲存的 JSON 字串解開，標籤，再包裝
-                    hist_msg = json.loads(json_str)
-                    hist_msg['is_history'] = True 
-                    new_sock.sendall((json.dumps(hist_msg) + '\n').encode('utf-8'))
-                
-                time.sleep(0.1)
-                broadcast_user_list()
-                time.sleep(0.05)
-                
-                sys_msg = {'type': 5, 
-                           'nickname': '系統', 
-                           'message': f'{nickname} 加入了聊天室'}
-                broadcast_data = (json.dumps(sys_msg) + '\n').encode('utf-8')
-                for c in client_list:
-                    try: c['socket'].sendall(broadcast_data)
-                    except: pass
-
-            # --- Type 3 :訊息處理 ---
-            if message['type'] == 3:
-                # 1. 回傳 Type 4 給發送者 
-                new_sock.sendall((json.dumps({'type': 4}) + '\n').encode('utf-8'))
-                
-                # 2. 準備轉發給其他人的 Type 5 封包
-                # 取得當前時間並格式化
-                current_time = datetime.now().strftime('%Y/%m/%d %H:%M')
-                
-                # --- Type 5 :廣播訊息 ---
-                msgdict = {
+        profiler.run(handle_message, client, message) # /cprofile 期間才會量測
+    finally:
+        handle_seconds.observe(time.perf_counter() - start, msg_type)
+
+def throttle(client, message):
+    """依剛處理完的封包扣除額度，回傳讀取下一個封包前要暫停幾秒。
+    開始暫停時通知客戶端；持續超過 (上次暫停結束後 RATE_BURST 秒內又超過) 不重複通知"""
+    now = time.monotonic()
+    if message.get('type') in IMAGE_TYPES:
+        delay = client.image_bytes.charge(client.frame_bytes, now)
+        if message['type'] != 11: # 一張圖片算一則訊息，分段不另外計算
+            delay = max(delay, client.messages.charge(1, now))
+    else:
+        delay = max(client.messages.charge(1, now), client.text_bytes.charge(client.frame_bytes, now))
+    if not delay: return 0
+    if now > client.throttled_until + RATE_BURST:
+        throttles.inc()
+        send_to(client, encode_packet({'type': 5,
+                                       'nickname': '系統',
+                                       'message': '傳送太快，伺服器暫時放慢接收你的訊息',
+                                       'action': 'throttle',
+                                       'retry_after': round(delay, 1)}))
+    client.throttled_until = now + delay
+    throttle_seconds.add(delay)
+    return delay
+
+# --- 離線清理 (兩種引擎共用) ---
+def remove_client(client):
+    """支援 resume 的客戶端斷線時先保留名額與房間 RESUME_GRACE 秒 (期間照常收廣播，送不出去就丟掉)，
+    期間重新連上由 take_over 接手，其他人看不到離開/加入。
+    多行程模式下重新連線多半會分到別的 worker，hub 上的暱稱還在會被拒絕，所以不保留"""
+    if client.resume_token and RESUME_GRACE and bus is None and clients.get(client.nickname) is client:
+        timers.add(RESUME_GRACE, leave_client, client)
+        return
+    leave_client(client)
+
+def take_over(client, nickname, token):
+    """resume_token 與目前使用這個暱稱的連線相符：新連線接手它的暱稱與房間。
+    舊連線可能是保留中的，也可能還沒被發現斷線 (半開)，一併中斷"""
+    old = clients.get(nickname)
+    if old is None or old is client or client.nickname or not token or not old.resume_token: return False
+    if not secrets.compare_digest(old.resume_token, str(token)): return False
+    if not clients.replace(old, client): return False
+    close_client(old, flush=False)
+    return True
+
+def leave_client(client):
+    "已經被接手 (或被踢) 時 remove() 回傳 False，不會重複廣播"
+    rooms = list(client.rooms) # remove() 會清空
+    if clients.remove(client): # 名單差異在 remove() 裡送出
+        # 在他待過的房間廣播離開訊息
+        nickname = client.nickname
+        if nickname:
+            drop_uploads(nickname)
+            print(f'{nickname} 離開了')
+            for room in rooms:
+                sys_msg = {
                     'type': 5,
-                    'nickname': message['nickname'],
-                    'message': message['message'],
-                    'time': current_time  # 將時間加入封包
-                }
-                save_message(json.dumps(msgdict))
-                
-                data = (json.dumps(msgdict) + '\n').encode('utf-8')
-                # 廣播給其他人
-                for client in client_list:
-                    if client['socket'] != new_sock:
-                        try: client['socket'].sendall(data)
-                        except: pass
-            
-            # --- Type 7: 私訊 ---
-            if message['type'] == 7:
-                message['time'] = datetime.now().strftime('%Y/%m/%d %H:%M')
-                target = message['target']
-                
-                pm_data = (json.dumps(message) + '\n').encode('utf-8')
-            
-                for client in client_list:
-                    if client['nickname'] == target:
-                        try: 
-                            client['socket'].sendall(pm_data)
-                        except: 
-                            pass
-                        break
-                    
-            # --- Type 9: 收到圖片訊息 ---
-            if message['type'] == 9:
-                current_time = datetime.now().strftime('%Y/%m/%d %H:%M')
-                msgdict = {
-                    'type': 9,
-                    'nickname': message['nickname'],
-                    'image_data': message['image_data'],
-                    'time': current_time
+                    'nickname': '系統',
+                    'room': room,
+                    'message': f'{nickname} 離開了聊天室',
+                    'time': datetime.now().strftime('%Y/%m/%d %H:%M')
                 }
-                save_message(json.dumps(msgdict))
-                data = (json.dumps(msgdict) + '\n').encode('utf-8')
-                
-                # 廣播給其他人
-                for client in client_list:
-                    if client['socket'] != new_sock:
-                        try: client['socket'].sendall(data)
-                        except: pass
+                broadcast(encode_packet(sys_msg), room=room)
+
+# --- 心跳：由一個時間輪檢查所有連線，不必每條連線一個計時器 ---
+PING_PACKET = encode_packet({'type': 23})
+PONG_PACKET = encode_packet({'type': 24})
+timers = TimerWheel(1.0, TIMER_SLOTS)
+
+def check_heartbeat(client):
+    """時間輪到期時呼叫 (心跳執行緒)：期間有收到封包就延後檢查，
+    閒置太久送 ping，ping 之後仍然沒有任何封包就中斷連線，由讀取端走正常的離線流程"""
+    if client.outbox.closed: return # 已離線，不再排入時間輪
+    now = time.monotonic()
+    if client.ping_sent and client.last_seen < client.ping_sent:
+        waited = now - client.ping_sent
+        if waited < PING_TIMEOUT:
+            timers.add(PING_TIMEOUT - waited, check_heartbeat, client)
+            return
+        evictions.inc()
+        print(f"[{client.nickname}] {PING_INTERVAL + PING_TIMEOUT} 秒沒有回應，中斷連線")
+        close_client(client, flush=False)
+        return
+    idle = now - client.last_seen
+    if idle < PING_INTERVAL:
+        client.ping_sent = 0
+        timers.add(PING_INTERVAL - idle, check_heartbeat, client)
+        return
+    client.ping_sent = now
+    send_to(client, PING_PACKET)
+    timers.add(PING_TIMEOUT, check_heartbeat, client)
+
+def enable_keepalive(sock):
+    "不支援 heartbeat 的客戶端：開啟 TCP keepalive，同樣的時間內由核心偵測對方是否還在"
+    if not PING_INTERVAL: return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'): # Linux
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, PING_INTERVAL)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, PING_TIMEOUT // 3))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    except OSError:
+        pass
+
+# --- 人數已滿通知 ---
+def reject_packet():
+    reject_msg = {
+        'type': 5,
+        'nickname': '系統',
+        'message': '伺服器人數已滿，連線被拒絕。',
+        'action': 'full'
+    }
+    return encode_packet(reject_msg)
+
+# --- 暱稱重複通知 ---
+def name_taken_packet(nickname):
+    msgdict = {
+        'type': 5,
+        'nickname': '系統',
+        'message': f'暱稱 {nickname} 已有人使用，請換一個。',
+        'action': 'name_taken'
+    }
+    return encode_packet(msgdict)
+
+# === Thread 引擎：每個連線一條讀取執行緒 + 一條送出執行緒 ===
+def recv_message(new_sock, sockname):
+    ready = threading.Event()
+    client = Session(new_sock, Outbox(ready.set))
+    threading.Thread(target=send_loop, args=(client, ready), daemon=True).start()
+    try:
+        for message in read_packets(new_sock.makefile('rb'), MAX_LINE_BYTES, client.received):
+            handle_packet(client, message)
+            delay = throttle(client, message)
+            if delay: time.sleep(delay) # 這段時間不讀取，資料留在核心的緩衝區
 
     except (ConnectionResetError, ConnectionAbortedError):
-        print(f"[{nickname or sockname}] 已斷線 (正常離線)")
+        print(f"[{client.nickname or sockname}] 已斷線 (正常離線)")
     except Exception as e:
+        errors.inc('connection')
         print(f"Err: {e}")
     finally:
-        dead = next((c for c in client_list if c['socket'] == new_sock), None)
-        if dead: 
-            client_list.remove(dead)
-            # 1. 更新名單
-            broadcast_user_list()
-            
-            # 2. 廣播離開訊息
-            if nickname:
-                print(f'{nickname} 離開了')
-                sys_msg = {
-                    'type': 5, 
-                    'nickname': '系統', 
-                    'message': f'{nickname} 離開了聊天室',
-                    'time': datetime.now().strftime('%Y/%m/%d %H:%M')
-                }
-                data = (json.dumps(sys_msg)+'\n').encode('utf-8')
-                for c in client_list:
-                    try: c['socket'].sendall(data)
-                    except: pass
-        
+        remove_client(client)
+        client.outbox.close(flush=False)
         new_sock.close()
 
-if __name__ == '__main__':
-    init_db()
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind((BIND_IP, BIND_PORT))
-    sock.listen(5)
-    print(f'Server listening at {BIND_IP}:{BIND_PORT}')
-    threading.Thread(target=admin_console, daemon=True).start()
+def send_loop(client, ready):
+    """把送出佇列的資料寫進 socket，只有這條執行緒會被慢的客戶端卡住"""
+    outbox, sock = client.outbox, client.socket
+    try:
+        while True:
+            ready.wait()
+            ready.clear()
+            # 分段資料沒送完前不等待；每一輪都會先送新來的文字
+            frames = outbox.take_all()
+            while frames:
+                start = time.perf_counter()
+                send_frames(sock, frames)
+                record_write(frames, start)
+                frames = outbox.take_all()
+            if outbox.closed:
+                break
+        sock.shutdown(socket.SHUT_RDWR) # 讓 reader 收到 EOF，走正常離線流程
+    except OSError:
+        pass
+
+def serve_threads(sock):
     while True:
         c, a = sock.accept()
-        if len(client_list) >= MAX_CLIENTS:
+        if len(clients) >= MAX_CLIENTS:
             print(f"拒絕連線 {a}: 伺服器已滿")
             
             try:
-                reject_msg = {
-                    'type': 5,
-                    'nickname': '系統',
-                    'message': '伺服器人數已滿，連線被拒絕。',
-                    'action': 'full' 
-                }
-                c.sendall((json.dumps(reject_msg) + '\n').encode('utf-8'))
+                c.sendall(reject_packet())
                 time.sleep(0.1)
             except: pass
             
             c.close()
             continue
         threading.Thread(target=recv_message, args=(c, a), daemon=True).start()
-        
\ No newline at end of file
+        
+# === asyncio 引擎：單一事件迴圈處理所有連線 ===
+async def handle_connection(reader, writer):
+    sockname = writer.get_extra_info('peername')
+    if len(clients) >= MAX_CLIENTS:
+        print(f"拒絕連線 {sockname}: 伺服器已滿")
+        writer.write(reject_packet())
+        writer.close() # close() 會先送完緩衝區的資料
+        return
+
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    def wakeup():
+        if running_in(loop): ready.set()
+        else: loop.call_soon_threadsafe(ready.set) # 從管理員執行緒呼叫時
+
+    client = Session(writer.get_extra_info('socket'), Outbox(wakeup), writer, loop)
+    sender = asyncio.create_task(drain_outbox(client, ready))
+    try:
+        while True:
+            message = await read_packet(reader, MAX_LINE_BYTES, client.received)
+            if message is None: break
+            handle_packet(client, message)
+            if client.pending is not None: # 等 defer 交出去的處理完成 (期間不讀這條連線)
+                pending, client.pending = client.pending, None
+                await pending
+            delay = throttle(client, message)
+            if delay: await pause_reading(writer.transport, delay)
+
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+        print(f"[{client.nickname or sockname}] 已斷線 (正常離線)")
+    except Exception as e:
+        errors.inc('connection')
+        print(f"Err: {e}")
+    finally:
+        remove_client(client)
+        client.outbox.close(flush=False)
+        sender.cancel()
+        writer.transport.abort()
+
+async def pause_reading(transport, delay):
+    """StreamReader 自己的緩衝區還會繼續收資料，所以直接暫停 transport。
+    StreamReader 因緩衝區已滿而暫停時 transport 已經不在讀取，不去動它"""
+    paused = transport.is_reading()
+    if paused: transport.pause_reading()
+    await asyncio.sleep(delay)
+    if paused and not transport.is_closing(): transport.resume_reading()
+
+async def drain_outbox(client, ready):
+    """asyncio 版的 writer：送出佇列 -> transport，並等待對方收完 (drain)"""
+    outbox, writer = client.outbox, client.writer
+    try:
+        while True:
+            await ready.wait()
+            ready.clear()
+            # writelines 會把累積的封包合併成一次寫入 (3.12 起直接用 sendmsg)
+            frames = outbox.take_all()
+            while frames:
+                start = time.perf_counter()
+                writer.writelines(frames)
+                await writer.drain()
+                record_write(frames, start)
+                await asyncio.sleep(0) # 讓其他連線有機會先放入文字訊息
+                frames = outbox.take_all()
+            if outbox.closed:
+                break
+        writer.close()
+    except (ConnectionError, OSError):
+        writer.close()
+
+async def serve_asyncio(sock):
+    server = await asyncio.start_server(handle_connection, sock=sock,
+                                        limit=MAX_LINE_BYTES, backlog=LISTEN_BACKLOG)
+    async with server:
+        await server.serve_forever()
+
+def raise_fd_limit():
+    """盡量提高可開啟的檔案數量，讓單一行程可以撐住上萬條連線"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass # Windows 或權限不足時維持原本設定
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='TCP 聊天室伺服器')
+    parser.add_argument('--host', default=BIND_IP)
+    parser.add_argument('--port', type=int, default=BIND_PORT)
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='thread: 每個連線一條執行緒 / asyncio: 單一事件迴圈')
+    parser.add_argument('--max-clients', type=int, default=MAX_CLIENTS,
+                        help='同時在線人數上限')
+    parser.add_argument('--outbox-limit', type=int, default=OUTBOX_MAX_BYTES // (1024 * 1024),
+                        help='每個連線送出佇列上限 (MB)')
+    parser.add_argument('--slow-policy', choices=['drop_oldest', 'drop_images', 'disconnect'],
+                        default=SLOW_CLIENT_POLICY, help='送出佇列滿時的處理方式')
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=COMPRESS_LEVEL,
+                        help='zlib 壓縮等級 (0 = 不提供壓縮)')
+    parser.add_argument('--ping-interval', type=int, default=PING_INTERVAL,
+                        help='沒收到封包多少秒後送 ping (0 = 關閉心跳)')
+    parser.add_argument('--ping-timeout', type=int, default=PING_TIMEOUT,
+                        help='送出 ping 後多少秒沒有回應就中斷連線')
+    parser.add_argument('--rate-messages', type=float, default=RATE_MESSAGES,
+                        help='每條連線每秒最多幾個封包 (0 = 不限制)')
+    parser.add_argument('--rate-text-kb', type=float, default=RATE_TEXT_BYTES / 1024,
+                        help='每條連線每秒最多幾 KB 的文字封包 (0 = 不限制)')
+    parser.add_argument('--rate-image-kb', type=float, default=RATE_IMAGE_BYTES / 1024,
+                        help='每條連線每秒最多幾 KB 的圖片 (0 = 不限制)')
+    parser.add_argument('--resume-grace', type=int, default=RESUME_GRACE,
+                        help='支援 resume 的客戶端斷線後保留名額幾秒，期間重新連線不廣播離開/加入 (0 = 不保留)')
+    parser.add_argument('--history', type=int, default=MAX_HISTORY_SEND,
+                        help='登入時回放的歷史訊息數')
+    parser.add_argument('--thumb-workers', type=int, default=THUMB_WORKERS,
+                        help='產生縮圖的子行程數 (0 = 不產生縮圖)')
+    parser.add_argument('--durability', choices=list(DURABILITY_LEVELS), default=DB_DURABILITY,
+                        help='資料庫 synchronous 等級 (off 最快 / full 每批 fsync)')
+    parser.add_argument('--reindex', action='store_true',
+                        help='啟動時重建全文搜尋索引 (沒有索引的舊資料庫第一次啟動時會自動建立)')
+    parser.add_argument('--commit-delay', type=float, default=DB_COMMIT_DELAY * 1000,
+                        help='批次 commit 最多等待的毫秒數')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='以 Prometheus 文字格式提供統計資料的 HTTP port (0 = 不開啟；多行程模式下 worker N 使用 port + N)')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help='統計資料 HTTP 伺服器綁定的位址 (預設只有本機可以讀取)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker 行程數 (>1 時以 SO_REUSEPORT 共用 port，--max-clients 為每個 worker 的上限)')
+    parser.add_argument('--bus', default=BUS_PATH,
+                        help='多行程模式下 worker 之間轉送訊息的 Unix socket 路徑')
+    parser.add_argument('--node', default=None,
+                        help='聯邦模式下這個節點的名稱 (全域唯一，預設為 主機名稱:port)')
+    parser.add_argument('--fed-port', type=int, default=0,
+                        help='接受其他節點連線的 port (0 = 不接受)')
+    parser.add_argument('--fed-host', default='127.0.0.1',
+                        help='接受其他節點連線綁定的位址 (預設只有本機；跨主機時指定內部網路的介面)')
+    parser.add_argument('--fed-secret', default=os.environ.get('CHAT_FED_SECRET'),
+                        help='所有節點共用的密鑰，節點之間以它驗證 (也可以用環境變數 CHAT_FED_SECRET，不會出現在行程列表)')
+    parser.add_argument('--peer', action='append', default=[], metavar='HOST:PORT',
+                        help='主動連線的節點 (可重複指定；每個節點都應與其他所有節點相連)')
+    args = parser.parse_args()
+    if args.workers > 1 and (args.fed_port or args.peer):
+        parser.error('聯邦模式 (--fed-port / --peer) 只支援單一行程 (--workers 1)')
+    if (args.fed_port or args.peer) and not args.fed_secret:
+        parser.error('聯邦模式需要 --fed-secret (或環境變數 CHAT_FED_SECRET)')
+    return args
+
+def apply_args(args):
+    global MAX_CLIENTS, MAX_HISTORY_SEND, OUTBOX_MAX_BYTES, SLOW_CLIENT_POLICY
+    global DB_DURABILITY, DB_COMMIT_DELAY, THUMB_WORKERS, BUS_PATH, COMPRESS_LEVEL
+    global PING_INTERVAL, PING_TIMEOUT, RATE_MESSAGES, RATE_TEXT_BYTES, RATE_IMAGE_BYTES, RESUME_GRACE
+    MAX_CLIENTS = args.max_clients
+    MAX_HISTORY_SEND = args.history
+    OUTBOX_MAX_BYTES = args.outbox_limit * 1024 * 1024
+    SLOW_CLIENT_POLICY = args.slow_policy
+    DB_DURABILITY = args.durability
+    DB_COMMIT_DELAY = args.commit_delay / 1000
+    THUMB_WORKERS = args.thumb_workers
+    BUS_PATH = args.bus
+    COMPRESS_LEVEL = args.compress_level
+    if COMPRESS_LEVEL: SERVER_FEATURES.append('zlib')
+    PING_INTERVAL = args.ping_interval
+    PING_TIMEOUT = args.ping_timeout
+    if PING_INTERVAL: SERVER_FEATURES.append('heartbeat')
+    RATE_MESSAGES = args.rate_messages
+    RATE_TEXT_BYTES = args.rate_text_kb * 1024
+    RATE_IMAGE_BYTES = args.rate_image_kb * 1024
+    RESUME_GRACE = args.resume_grace
+
+def serve(args, worker_id=None):
+    if THUMB_WORKERS > 0: start_thumbnailer()
+    if worker_id is None: init_db(rebuild_search=args.reindex)
+    else: init_db(args.workers, worker_id) # 各 worker 的訊息 id 不會重複
+    if args.fed_port or args.peer: start_federation(args)
+    if args.metrics_port: start_metrics_server(args.metrics_host, args.metrics_port + (worker_id or 0))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if worker_id is not None: # 每個 worker 各自 listen，由核心分配新連線
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((args.host, args.port))
+    name = args.engine if worker_id is None else f'{args.engine}, worker {worker_id}'
+    print(f'Server listening at {args.host}:{args.port} ({name})')
+    if worker_id is None: # 多行程模式下控制台在 supervisor
+        threading.Thread(target=admin_console, daemon=True).start()
+    if PING_INTERVAL or RESUME_GRACE:
+        threading.Thread(target=timers.run, daemon=True).start()
+    if args.engine == 'asyncio':
+        raise_fd_limit()
+        sock.listen(LISTEN_BACKLOG)
+        sock.setblocking(False)
+        asyncio.run(serve_asyncio(sock))
+    else:
+        sock.listen(5)
+        serve_threads(sock)
+
+# === 多行程模式：worker ===
+class Roster:
+    "全域名單的副本，依 hub 送來的差異更新 (hub 已依 seq 排好順序)"
+
+    def __init__(self):
+        self.users = {} # 暱稱 -> None，保留登入順序
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def reset(self, users, seq):
+        with self.lock:
+            self.users = dict.fromkeys(users)
+            self.seq = seq
+
+    def apply(self, change, nickname, seq):
+        with self.lock:
+            if change == 'join': self.users[nickname] = None
+            else: self.users.pop(nickname, None)
+            self.seq = seq
+
+    def snapshot(self):
+        with self.lock:
+            return self.seq, list(self.users)
+
+def run_worker(args, worker_id):
+    "在子行程中執行：連上 hub 後照常提供服務，名單變動與房間訂閱改由 hub 協調"
+    global bus, roster
+    apply_args(args)
+    roster = Roster()
+    clients.on_change = forward_presence
+    clients.on_room = subscribe_room
+    profiler.prefix = f'profile-worker{worker_id}' # 報表檔名
+    bus = BusClient(BUS_PATH, worker_id, handle_bus)
+    bus.connect()
+    serve(args, worker_id)
+
+def claim_nickname(client, nickname):
+    "多行程模式下先向 hub 登記暱稱 (全域不可重複)；單一行程時交給 registry 檢查"
+    if bus is None or clients.get(nickname) is client: return True
+    reply = bus.request({'op': 'join', 'nickname': nickname})
+    return bool(reply and reply['ok'])
+
+def forward_presence(op, nickname, seq):
+    "登入已在 claim_nickname 登記；離線通知 hub，差異由 hub 編號後送給所有 worker"
+    if op == 'leave': bus.send({'op': 'leave', 'nickname': nickname})
+
+def subscribe_room(room, active):
+    """這個 worker 的房間有人 / 沒人了，通知 hub 要不要轉送該房間的訊息。
+    沒訂閱期間歷史環不會更新，丟掉，下次從資料庫重新載入"""
+    history.discard(room)
+    bus.send({'op': 'sub' if active else 'unsub', 'room': room})
+
+def handle_bus(header, frame):
+    "在 bus 讀取執行緒上處理 hub 送來的訊息，只送給本行程的連線，不再轉回 hub"
+    op = header['op']
+    if op == 'roster':
+        roster.reset(header['users'], header['seq'])
+    elif op == 'presence':
+        roster.apply(header['change'], header['nickname'], header['seq'])
+        publish_presence(header['change'], header['nickname'], header['seq'])
+    elif op == 'frame':
+        ring = history.peek(header['room']) if header['archive'] else None
+        if ring: ring.append(mark_history(frame))
+        deliver(frame, kind=header['kind'], room=header['room'])
+    elif op == 'image':
+        ring = history.peek(header['room']) if header['archive'] else None
+        if ring: ring.append(None, header['row'])
+        broadcast_image(header['row'], formats=header['formats'], relay=False)
+    elif op == 'private':
+        other = clients.get(header['target'])
+        if other is not None: send_to(other, frame)
+    elif op == 'kick':
+        kick_client_by_name(header['nickname'])
+    elif op == 'stats':
+        print_lines(metrics.summary())
+    elif op == 'profile':
+        profiler_command(header['cmd'])
+    elif op == 'stop':
+        history.clear()
+        sys_msg = {'type': 5,
+                   'nickname': '系統',
+                   'message': '伺服器即將關閉，請自行離線。',
+                   'action': 'shutdown'}
+        deliver(encode_packet(sys_msg))
+        time.sleep(0.5) # 讓各連線的 writer 有時間把通知送出
+        store.flush()
+        os._exit(0)
+
+# === 聯邦模式：多台伺服器 (節點) 互相轉送 ===
+def start_federation(args):
+    """本節點的訊息、圖片、私訊與名單變動都送給其他節點；
+    連線中斷後重新連上時，由對方補送這段期間漏掉的訊息"""
+    global federation
+    node = args.node or f'{socket.gethostname()}:{args.port}'
+    federation = Federation(node, handle_federated, clients.nicknames, clients.drop_node, expand_event, args.fed_secret)
+    federation.load(federated_events())
+    clients.on_local = federation.announce
+    if args.fed_port: federation.listen(args.fed_host, args.fed_port)
+    for peer in args.peer:
+        host, port = peer.rsplit(':', 1)
+        federation.connect(host, int(port))
+
+def federated_events():
+    "資料庫裡最近帶有 uid 的訊息，重新啟動後仍能補送給其他節點，也能認出已收過的訊息"
+    events = []
+    for json_str in store.recent_federated(FED_LOG_SIZE):
+        msg = json.loads(json_str)
+        if msg['type'] == 9:
+            events.append(federation.make_event('image', msg['uid'], {'row': msg}))
+        else:
+            events.append(federation.make_event('msg', msg['uid'], {'packet': msg}))
+    return events
+
+def expand_event(event):
+    "圖片事件送出前附上原圖 (補送紀錄與資料庫都只記雜湊)"
+    if event['op'] != 'image': return event
+    raw = store.blobs.get(event['row']['image_hash'])
+    return {**event, 'data': base64.b64encode(raw).decode() if raw else None}
+
+def handle_federated(event):
+    "在聯邦連線的讀取執行緒上處理其他節點送來的事件 (已去重)，只送給本節點的連線"
+    op = event['op']
+    if op == 'msg':
+        packet = event['packet']
+        data = archive_message(packet) # id 換成本節點配發的
+        deliver(data, room=packet.get('room', DEFAULT_ROOM))
+    elif op == 'image':
+        if not event.get('data'): return # 對方的圖片檔遺失
+        row, raw = event['row'], base64.b64decode(event['data'])
+        digest = store.blobs.add(raw)
+        if digest != row['image_hash']: return
+        archive_image(row, digest)
+        broadcast_image(row, raw, b64=event['data'], formats=('chunked', 'legacy'))
+        request_thumbnail(row, raw)
+    elif op == 'private':
+        other = clients.get(event['packet']['target'])
+        if other is not None: send_to(other, encode_packet(event['packet']))
+    elif op == 'roster':
+        clients.set_remote(event['node'], event['users'])
+    elif op == 'presence':
+        if event['change'] == 'join': clients.add_remote(event['nickname'], event['node'])
+        else: clients.remove_remote(event['nickname'])
+
+# === 多行程模式：supervisor ===
+def run_supervisor(args):
+    """啟動 hub 與 N 個 worker；worker 意外結束時重新啟動。
+    控制台指令經由 hub 轉給持有該使用者的 worker"""
+    global store
+    # 先在這裡開啟一次資料庫，完成 schema 遷移後 worker 才同時開啟
+    store = MessageStore(DB_NAME, BLOB_DIR, durability=DB_DURABILITY, batch_delay=DB_COMMIT_DELAY)
+    store.open(args.reindex)
+    hub = BusHub(BUS_PATH, MAX_LINE_BYTES)
+    context = multiprocessing.get_context('spawn')
+    workers = {}
+    stopping = threading.Event()
+
+    def start_worker(worker_id):
+        worker = context.Process(target=run_worker, args=(args, worker_id))
+        worker.start()
+        workers[worker_id] = worker
+
+    def watch_workers():
+        while not stopping.wait(1):
+            for worker_id, worker in list(workers.items()):
+                if worker.exitcode is not None and not stopping.is_set():
+                    print(f"worker {worker_id} 已結束 (exit {worker.exitcode})，重新啟動")
+                    start_worker(worker_id)
+
+    for worker_id in range(args.workers):
+        start_worker(worker_id)
+    print(f'Supervisor: {args.workers} 個 worker 共用 {args.host}:{args.port}，bus: {BUS_PATH}')
+    threading.Thread(target=watch_workers, daemon=True).start()
+    threading.Thread(target=supervisor_console, args=(hub, workers, stopping), daemon=True).start()
+    asyncio.run(hub.serve())
+
+def supervisor_console(hub, workers, stopping):
+    print("--- 管理員控制台啟動 (supervisor) ---")
+    print("指令: /kick <名字>  (踢人)")
+    print("指令: /list         (查看名單)")
+    print("指令: /stats        (各 worker 的效能統計)")
+    print("指令: /profile、/cprofile [秒數]、/mem start|snap|stop (在每個 worker 上量測)")
+    print("指令: /stop         (關閉伺服器)")
+
+    while True:
+        try:
+            cmd = input()
+
+            if cmd.startswith('/kick '):
+                hub.command({'op': 'kick', 'nickname': cmd.split(' ', 1)[1].strip()})
+            if cmd == '/list':
+                print(list(hub.users))
+            if cmd == '/stats':
+                hub.command({'op': 'stats'})
+            if cmd.split(' ', 1)[0] in ('/profile', '/cprofile', '/mem'):
+                hub.command({'op': 'profile', 'cmd': cmd})
+            if cmd == '/stop':
+                print("正在關閉伺服器...")
+                stopping.set()
+                hub.command({'op': 'stop'}) # 各 worker 通知自己的連線後結束
+                for worker in workers.values():
+                    worker.join(5)
+                print("正在清除歷史紀錄...")
+                store.clear()
+                print("伺服器關閉。")
+                os._exit(0)
+
+        except EOFError:
+            return
+        except Exception as e:
+            print(f"Console Error: {e}")
+
+if __name__ == '__main__':
+    args = parse_args()
+    apply_args(args)
+    if args.workers > 1:
+        run_supervisor(args)
+    else:
+        serve(args)